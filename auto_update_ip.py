@@ -12,38 +12,93 @@ Version: 2.0.0
 """
 
 import argparse
+import hashlib
+import importlib
+import importlib.util
+import ipaddress
 import json
 import logging
 import os
+import queue
+import re
+import select
+import signal
+import socket
+import struct
 import sys
-from datetime import datetime
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 from pathlib import Path
 from typing import List, Dict, Optional, Tuple
+from urllib.parse import parse_qs, urlsplit
 
 import requests
+from requests.adapters import HTTPAdapter
 
-# Google Cloud (optional imports)
 try:
-    from google.cloud import compute_v1
-    from google.oauth2 import service_account
-    GCP_AVAILABLE = True
-except ImportError:
-    GCP_AVAILABLE = False
+    import fcntl
+except ImportError:  # Windows: dùng lock file O_EXCL
+    fcntl = None
 
-try:
-    from googleapiclient import discovery
-    from googleapiclient.errors import HttpError
-    GOOGLE_API_AVAILABLE = True
-except ImportError:
-    GOOGLE_API_AVAILABLE = False
+# SDK của các provider là optional và chỉ được import khi một provider đã cấu
+# hình thực sự cần đến (xem _lazy_import), để lần chạy "IP không đổi" chỉ
+# phải import requests. Truy cập từ bên ngoài (auto_update_ip.boto3, ...)
+# đi qua __getattr__ của module.
+_LAZY_IMPORTS = {
+    'compute_v1': ('google.cloud.compute_v1', None),
+    'service_account': ('google.oauth2.service_account', None),
+    'discovery': ('googleapiclient.discovery', None),
+    'auth_requests': ('google.auth.transport.requests', None),
+    'HttpError': ('googleapiclient.errors', 'HttpError'),
+    'network_security_v1': ('google.cloud.network_security_v1', None),
+    'field_mask_pb2': ('google.protobuf.field_mask_pb2', None),
+    'boto3': ('boto3', None),
+    'ClientError': ('botocore.exceptions', 'ClientError'),
+}
 
-# AWS (optional imports)
-try:
-    import boto3
-    from botocore.exceptions import ClientError
-    AWS_AVAILABLE = True
-except ImportError:
-    AWS_AVAILABLE = False
+# Cờ *_AVAILABLE được tính bằng find_spec, không import SDK
+_SDK_MODULES = {
+    'GCP_AVAILABLE': ('google.cloud.compute_v1', 'google.oauth2'),
+    'GOOGLE_API_AVAILABLE': ('googleapiclient',),
+    'NETWORK_SECURITY_AVAILABLE': ('google.cloud.network_security_v1',),
+    'AWS_AVAILABLE': ('boto3', 'botocore'),
+}
+
+
+def _lazy_import(name: str):
+    """Import (một lần) module/attribute SDK đã khai báo trong _LAZY_IMPORTS"""
+    if name not in globals():
+        module_name, attr = _LAZY_IMPORTS[name]
+        module = importlib.import_module(module_name)
+        globals()[name] = getattr(module, attr) if attr else module
+    return globals()[name]
+
+
+def _sdk_available(flag: str) -> bool:
+    """Kiểm tra SDK đã được cài đặt mà không import nó"""
+    if flag not in globals():
+        try:
+            available = all(
+                importlib.util.find_spec(module) is not None for module in _SDK_MODULES[flag]
+            )
+        except ImportError:
+            available = False
+        globals()[flag] = available
+    return globals()[flag]
+
+
+def __getattr__(name: str):
+    if name in _LAZY_IMPORTS:
+        try:
+            return _lazy_import(name)
+        except ImportError as e:
+            raise AttributeError(f"module {__name__!r} has no attribute {name!r} ({e})")
+    if name in _SDK_MODULES:
+        return _sdk_available(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
 
 
 class Config:
@@ -82,8 +137,42 @@ class Config:
         gcp = data.get('gcp', {})
         if not isinstance(gcp, dict):
             raise ValueError("Section 'gcp' phải là object")
-        if 'project_id' not in gcp:
+        projects = gcp.get('projects', [])
+        if not isinstance(projects, list):
+            raise ValueError("gcp.projects phải là array")
+        if 'project_id' not in gcp and not projects:
             raise ValueError("Missing required field: gcp.project_id")
+        if 'project_id' not in gcp:
+            # Không có project ở cấp gcp để giữ các target này (không kế thừa vào gcp.projects)
+            stray = [
+                key for key in GCPUpdater.PROJECT_KEYS
+                if key not in ('project_id', 'projects') and gcp.get(key)
+            ]
+            if stray:
+                raise ValueError(
+                    f"gcp.{', gcp.'.join(stray)} cần gcp.project_id hoặc phải khai báo trong từng "
+                    f"block của gcp.projects"
+                )
+        
+        blocks = ([gcp] if 'project_id' in gcp else []) + projects
+        project_ids = []
+        for block in blocks:
+            if not isinstance(block, dict):
+                raise ValueError("Project trong gcp.projects phải là object")
+            if 'project_id' not in block:
+                raise ValueError("Project trong gcp.projects thiếu 'project_id'")
+            project_ids.append(block['project_id'])
+            self._validate_firewall_selectors(block.get('firewall_selectors', []))
+            self._validate_address_groups(block.get('address_groups', []))
+        duplicates = sorted({p for p in project_ids if project_ids.count(p) > 1})
+        if duplicates:
+            raise ValueError(f"gcp.projects bị trùng project_id: {', '.join(duplicates)}")
+        
+        tag = gcp.get('sql_auto_ip_tag')
+        if tag is not None and not re.fullmatch(r'[A-Za-z0-9][A-Za-z0-9_.-]*', str(tag)):
+            raise ValueError("gcp.sql_auto_ip_tag chỉ được chứa chữ, số, '_', '.', '-'")
+        if gcp.get('sql_auto_ip_retention_hours', 0) < 0:
+            raise ValueError("gcp.sql_auto_ip_retention_hours phải >= 0")
         
         # Validate AWS section
         aws = data.get('aws', {})
@@ -92,6 +181,9 @@ class Config:
         if 'region' not in aws:
             raise ValueError("Missing required field: aws.region")
         
+        if aws.get('update_mode', 'revoke_authorize') not in ('revoke_authorize', 'modify'):
+            raise ValueError("aws.update_mode phải là 'revoke_authorize' hoặc 'modify'")
+        
         # Validate security groups structure
         for sg_list in ['security_groups_ssh', 'security_groups_mysql']:
             if sg_list in aws:
@@ -102,6 +194,52 @@ class Config:
                         raise ValueError(f"Security group trong {sg_list} phải là object")
                     if 'group_id' not in sg:
                         raise ValueError(f"Security group trong {sg_list} thiếu 'group_id'")
+        
+        prefix_lists = aws.get('prefix_lists', [])
+        if not isinstance(prefix_lists, list):
+            raise ValueError("aws.prefix_lists phải là array")
+        for prefix_list in prefix_lists:
+            if not isinstance(prefix_list, dict) or 'prefix_list_id' not in prefix_list:
+                raise ValueError("Prefix list trong aws.prefix_lists phải là object có 'prefix_list_id'")
+        
+        # Validate daemon section
+        daemon = data.get('daemon', {})
+        if not isinstance(daemon, dict):
+            raise ValueError("Section 'daemon' phải là object")
+        min_interval = daemon.get('min_interval', 30)
+        max_interval = daemon.get('max_interval', 900)
+        if min_interval <= 0 or max_interval < min_interval:
+            raise ValueError("daemon: cần 0 < min_interval <= max_interval")
+        if daemon.get('backoff_factor', 2.0) < 1:
+            raise ValueError("daemon.backoff_factor phải >= 1")
+    
+    @staticmethod
+    def _validate_address_groups(address_groups):
+        if not isinstance(address_groups, list):
+            raise ValueError("gcp.address_groups phải là array")
+        for group in address_groups:
+            if not isinstance(group, dict) or 'name' not in group:
+                raise ValueError("Address group trong gcp.address_groups phải là object có 'name'")
+            if not isinstance(group.get('firewall_policies', []), list):
+                raise ValueError("address_groups[].firewall_policies phải là array")
+    
+    @staticmethod
+    def _validate_firewall_selectors(selectors):
+        if not isinstance(selectors, list):
+            raise ValueError("gcp.firewall_selectors phải là array")
+        for selector in selectors:
+            if not isinstance(selector, dict) or not selector:
+                raise ValueError("Selector trong gcp.firewall_selectors phải là object khác rỗng")
+            unknown = set(selector) - set(GCPUpdater.SELECTOR_KEYS)
+            if unknown:
+                raise ValueError(f"Selector có trường không hỗ trợ: {', '.join(sorted(unknown))}")
+            if 'name_regex' in selector:
+                try:
+                    re.compile(selector['name_regex'])
+                except re.error as e:
+                    raise ValueError(f"gcp.firewall_selectors: name_regex không hợp lệ: {e}")
+            if 'target_tags' in selector and not isinstance(selector['target_tags'], list):
+                raise ValueError("gcp.firewall_selectors: target_tags phải là array")
     
     @property
     def gcp(self) -> dict:
@@ -114,6 +252,255 @@ class Config:
     @property
     def ip_cache_file(self) -> str:
         return self._data.get('ip_cache_file', 'last_known_ip.txt')
+    
+    @property
+    def ip_detection(self) -> dict:
+        return self._data.get('ip_detection', {})
+    
+    @property
+    def watch(self) -> dict:
+        return self._data.get('watch', {})
+    
+    @property
+    def daemon(self) -> dict:
+        return self._data.get('daemon', {})
+    
+    @property
+    def lock(self) -> dict:
+        return self._data.get('lock', {})
+
+
+class StateStore:
+    """
+    Trạng thái giữa các lần chạy, lưu dạng JSON (ghi atomic) trong ip_cache_file:
+    IP đã áp dụng đầy đủ lần gần nhất và, cho từng target (firewall rule,
+    Cloud SQL instance, security group), IP đã áp dụng thành công và thời điểm,
+    cùng kết quả discovery (target resolve từ selector) kèm thời điểm resolve.
+    File cache dạng text cũ (chỉ chứa IP) được đọc như trạng thái chưa có target.
+    """
+    
+    VERSION = 1
+    
+    def __init__(self, path: str, logger: logging.Logger):
+        self.path = path
+        self.logger = logger
+        self._data = {'version': self.VERSION, 'ip': None, 'targets': {}, 'discovery': {}}
+        self._dirty = False
+        # Các updater có thể đánh dấu target từ nhiều thread
+        self._lock = threading.Lock()
+    
+    def load(self):
+        """Đọc lại trạng thái từ file (file chưa tồn tại = trạng thái rỗng)"""
+        self._data = {'version': self.VERSION, 'ip': None, 'targets': {}, 'discovery': {}}
+        self._dirty = False
+        try:
+            with open(self.path, 'r', encoding='utf-8') as f:
+                content = f.read().strip()
+        except FileNotFoundError:
+            self.logger.debug("Không tìm thấy file cache IP")
+            return
+        
+        try:
+            data = json.loads(content)
+        except ValueError:
+            data = None
+        if isinstance(data, dict):
+            self._data.update(data)
+            self._data.setdefault('targets', {})
+            self._data.setdefault('discovery', {})
+        elif content:
+            # Định dạng cũ: file text chỉ chứa IP
+            self._data['ip'] = content
+    
+    @property
+    def ip(self) -> Optional[str]:
+        return self._data.get('ip')
+    
+    @ip.setter
+    def ip(self, value: str):
+        self._data['ip'] = value
+        self._dirty = True
+    
+    def applied_ip(self, target: str) -> Optional[str]:
+        """IP đã áp dụng thành công gần nhất cho target"""
+        return self._data['targets'].get(target, {}).get('ip')
+    
+    def is_applied(self, target: str, ip: str) -> bool:
+        return self.applied_ip(target) == ip
+    
+    def old_ip_for(self, target: str, default: Optional[str]) -> Optional[str]:
+        """IP cũ cần gỡ khỏi target: IP target đang giữ, nếu chưa biết thì dùng default"""
+        return self.applied_ip(target) or default
+    
+    def mark_applied(self, target: str, ip: str):
+        with self._lock:
+            self._data['targets'][target] = {
+                'ip': ip,
+                'applied_at': datetime.now().isoformat(timespec='seconds')
+            }
+            self._dirty = True
+    
+    def forget_applied(self, ip: str):
+        """Bỏ đánh dấu các target đang ở IP này (dùng cho --force để áp dụng lại)"""
+        targets = self._data['targets']
+        for target in [t for t, entry in targets.items() if entry.get('ip') == ip]:
+            del targets[target]
+            self._dirty = True
+    
+    def discovered(self, key: str, selectors: str, ttl: float) -> Optional[List[str]]:
+        """Kết quả discovery đã cache cho key, nếu cùng selectors và chưa quá ttl giây"""
+        entry = self._data['discovery'].get(key)
+        if not entry or entry.get('selectors') != selectors:
+            return None
+        try:
+            age = (datetime.now() - datetime.fromisoformat(entry['resolved_at'])).total_seconds()
+        except (KeyError, TypeError, ValueError):
+            return None
+        if age > ttl:
+            return None
+        return list(entry.get('names', []))
+    
+    def set_discovered(self, key: str, selectors: str, names: List[str]):
+        self._data['discovery'][key] = {
+            'selectors': selectors,
+            'names': list(names),
+            'resolved_at': datetime.now().isoformat(timespec='seconds')
+        }
+        self._dirty = True
+    
+    def forget_discovered(self, key: Optional[str] = None):
+        """Bỏ cache discovery của key (None = tất cả) để lần sau resolve lại"""
+        discovery = self._data['discovery']
+        for name in [key] if key is not None else list(discovery):
+            if discovery.pop(name, None) is not None:
+                self._dirty = True
+    
+    def save(self, force: bool = False):
+        """Ghi trạng thái ra file: ghi file tạm cùng thư mục rồi os.replace"""
+        if not (self._dirty or force):
+            return
+        directory = os.path.dirname(os.path.abspath(self.path))
+        fd, tmp_path = tempfile.mkstemp(
+            dir=directory, prefix=f".{os.path.basename(self.path)}.", suffix='.tmp'
+        )
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(self._data, f, indent=2, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self._dirty = False
+
+
+class RunLock:
+    """
+    Khóa liên process để các lần chạy (cron mỗi phút) không chồng lên nhau.
+    Dùng flock trên lock file khi có fcntl, nếu không thì tạo file bằng O_EXCL.
+    Lock được coi là stale (và bị phá) khi process giữ lock đã chết hoặc giữ
+    quá stale_after giây.
+    """
+    
+    def __init__(self, path: str, logger: logging.Logger, stale_after: float = 3600):
+        self.path = path
+        self.logger = logger
+        self.stale_after = stale_after
+        self._fd = None
+    
+    def acquire(self, wait: bool = False, timeout: Optional[float] = None) -> bool:
+        """
+        Lấy lock. Nếu wait=True thì chờ process đang giữ lock xong
+        (tối đa timeout giây, None = chờ mãi)
+        Returns: True nếu lấy được lock
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            if self._try_acquire():
+                return True
+            if self._break_if_stale():
+                continue
+            if not wait or (deadline is not None and time.monotonic() >= deadline):
+                return False
+            time.sleep(0.5)
+    
+    def release(self):
+        if self._fd is None:
+            return
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        os.close(self._fd)
+        self._fd = None
+    
+    def _try_acquire(self) -> bool:
+        if fcntl is None:
+            try:
+                fd = os.open(self.path, os.O_CREAT | os.O_EXCL | os.O_RDWR, 0o644)
+            except FileExistsError:
+                return False
+        else:
+            fd = os.open(self.path, os.O_CREAT | os.O_RDWR, 0o644)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except OSError:
+                os.close(fd)
+                return False
+            # Lock file có thể vừa bị holder unlink (release) hoặc bị phá vì stale
+            try:
+                same_file = os.stat(self.path).st_ino == os.fstat(fd).st_ino
+            except FileNotFoundError:
+                same_file = False
+            if not same_file:
+                os.close(fd)
+                return False
+        
+        os.ftruncate(fd, 0)
+        os.write(fd, json.dumps({'pid': os.getpid(), 'acquired_at': time.time()}).encode())
+        self._fd = fd
+        return True
+    
+    def _holder(self) -> dict:
+        try:
+            with open(self.path, 'r') as f:
+                holder = json.load(f)
+            return holder if isinstance(holder, dict) else {}
+        except (OSError, ValueError):
+            return {}
+    
+    @staticmethod
+    def _pid_alive(pid: int) -> bool:
+        if os.name != 'posix':
+            return True
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+    
+    def _break_if_stale(self) -> bool:
+        """Xóa lock file nếu holder đã chết hoặc giữ lock quá lâu"""
+        holder = self._holder()
+        pid = holder.get('pid')
+        acquired_at = holder.get('acquired_at')
+        if not pid or acquired_at is None:
+            return False
+        
+        age = time.time() - acquired_at
+        if self._pid_alive(pid) and age < self.stale_after:
+            self.logger.debug(f"Lock {self.path} đang được giữ bởi PID {pid} ({age:.0f}s)")
+            return False
+        
+        self.logger.warning(f"⚠ Phá lock stale {self.path} (PID {pid}, {age:.0f}s)")
+        try:
+            os.unlink(self.path)
+        except FileNotFoundError:
+            pass
+        return True
 
 
 class IPService:
@@ -125,50 +512,344 @@ class IPService:
         "https://icanhazip.com"
     ]
     
-    def __init__(self, cache_file: str, logger: logging.Logger):
+    # Service không phải HTTP (dùng trong ip_detection.services), ví dụ:
+    #   dns://resolver1.opendns.com/myip.opendns.com?type=A
+    #   dns://ns1.google.com/o-o.myaddr.l.google.com?type=TXT
+    #   stun://stun.l.google.com:19302
+    DETECTORS = {
+        'http': '_fetch_http',
+        'https': '_fetch_http',
+        'dns': '_fetch_dns',
+        'stun': '_fetch_stun',
+    }
+    
+    DETECTION_MODES = ('sequential', 'race', 'quorum')
+    
+    # Chỉ IPv4: mọi target ghi IP dưới dạng IP/32
+    DNS_QUERY_TYPES = {'A': 1, 'TXT': 16}
+    STUN_MAGIC_COOKIE = 0x2112A442
+    
+    def __init__(
+        self,
+        cache_file: str,
+        logger: logging.Logger,
+        options: Optional[dict] = None
+    ):
         self.cache_file = cache_file
         self.logger = logger
+        self.state = StateStore(cache_file, logger)
+        options = options or {}
+        self.services = options.get('services', self.IP_SERVICES)
+        for service in self.services:
+            url = urlsplit(service)
+            if url.scheme not in self.DETECTORS:
+                raise ValueError(
+                    f"ip_detection.services không hỗ trợ: {service} "
+                    f"(hỗ trợ: {', '.join(sorted(self.DETECTORS))})"
+                )
+            if url.scheme == 'dns':
+                qtype = parse_qs(url.query).get('type', ['A'])[0].upper()
+                if qtype not in self.DNS_QUERY_TYPES:
+                    raise ValueError(
+                        f"ip_detection.services: type={qtype} không hỗ trợ trong {service} "
+                        f"(hỗ trợ: {', '.join(self.DNS_QUERY_TYPES)})"
+                    )
+        self.mode = options.get('mode', 'sequential')
+        if self.mode not in self.DETECTION_MODES:
+            raise ValueError(
+                f"ip_detection.mode không hợp lệ: {self.mode} "
+                f"(hỗ trợ: {', '.join(self.DETECTION_MODES)})"
+            )
+        self.timeout = options.get('timeout', 5)
+        self.session = self._build_session(options)
+        self.hedge_delay = options.get('hedge_delay', 0.0)
+        # Mặc định cần đa số service đồng ý
+        self.quorum = options.get('quorum', len(self.services) // 2 + 1)
+        if self.mode == 'quorum' and not 1 <= self.quorum <= len(self.services):
+            raise ValueError(
+                f"ip_detection.quorum phải nằm trong khoảng 1..{len(self.services)}"
+            )
+    
+    def _build_session(self, options: dict) -> requests.Session:
+        """
+        Tạo HTTP session dùng chung cho mọi lần phát hiện IP trong process:
+        giữ kết nối keep-alive tới từng service nên chỉ tốn DNS + TCP + TLS
+        handshake ở lần đầu
+        """
+        adapter = HTTPAdapter(
+            pool_connections=options.get('pool_connections', len(self.services)),
+            pool_maxsize=options.get('pool_maxsize', 2),
+            pool_block=options.get('pool_block', False)
+        )
+        session = requests.Session()
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        return session
+    
+    def close(self):
+        """Đóng các kết nối đang giữ trong pool"""
+        self.session.close()
     
     def get_current_ip(self) -> Optional[str]:
         """Lấy IP công cộng hiện tại từ các service"""
-        for service in self.IP_SERVICES:
+        if self.mode == 'race':
+            ip = self._get_ip_race()
+        elif self.mode == 'quorum':
+            ip = self._get_ip_quorum()
+        else:
+            ip = self._get_ip_sequential()
+        
+        if ip:
+            self.logger.info(f"✓ Phát hiện IP công cộng: {ip}")
+            return ip
+        
+        self.logger.error("✗ Không thể lấy IP công cộng từ các service")
+        return None
+    
+    def _fetch_ip(self, service: str) -> Optional[str]:
+        """Hỏi IP từ một service, trả về None nếu service trả lỗi"""
+        detector = getattr(self, self.DETECTORS[urlsplit(service).scheme])
+        answer = detector(service)
+        if answer is None:
+            return None
+        return self._validate_ip(service, answer)
+    
+    def _fetch_http(self, service: str) -> Optional[str]:
+        """Hỏi IP qua HTTP(S) ("what's my IP" service)"""
+        response = self.session.get(service, timeout=self.timeout)
+        if response.status_code == 200:
+            return response.text.strip()
+        self.logger.debug(f"Service {service} trả về HTTP {response.status_code}")
+        return None
+    
+    def _udp_exchange(self, host: str, port: int, payload: bytes, match) -> bytes:
+        """Gửi một datagram và chờ datagram trả lời thỏa `match` (một round-trip)"""
+        family, _, _, _, address = socket.getaddrinfo(host, port, type=socket.SOCK_DGRAM)[0]
+        with socket.socket(family, socket.SOCK_DGRAM) as sock:
+            sock.settimeout(self.timeout)
+            sock.sendto(payload, address)
+            while True:
+                data, _ = sock.recvfrom(2048)
+                if match(data):
+                    return data
+    
+    def _fetch_dns(self, service: str) -> Optional[str]:
+        """
+        Hỏi IP qua bản ghi "myip" của DNS resolver:
+        dns://RESOLVER[:PORT]/QNAME?type=A|TXT
+        """
+        url = urlsplit(service)
+        qname = url.path.strip('/')
+        qtype_name = parse_qs(url.query).get('type', ['A'])[0].upper()
+        qtype = self.DNS_QUERY_TYPES[qtype_name]
+        
+        query_id = int.from_bytes(os.urandom(2), 'big')
+        question = b''.join(
+            bytes([len(label)]) + label.encode('ascii') for label in qname.split('.')
+        ) + b'\x00' + struct.pack('!HH', qtype, 1)
+        # Header: id, flags (RD), qdcount=1
+        query = struct.pack('!HHHHHH', query_id, 0x0100, 1, 0, 0, 0) + question
+        
+        response = self._udp_exchange(
+            url.hostname, url.port or 53, query,
+            lambda data: len(data) >= 12 and struct.unpack('!H', data[:2])[0] == query_id
+        )
+        
+        _, flags, qdcount, ancount, _, _ = struct.unpack('!HHHHHH', response[:12])
+        if flags & 0x000F:
+            self.logger.debug(f"Service {service} trả về DNS rcode {flags & 0x000F}")
+            return None
+        
+        offset = 12
+        for _ in range(qdcount):
+            offset = self._skip_dns_name(response, offset) + 4
+        for _ in range(ancount):
+            offset = self._skip_dns_name(response, offset)
+            rtype, _, _, rdlength = struct.unpack('!HHIH', response[offset:offset + 10])
+            offset += 10
+            rdata = response[offset:offset + rdlength]
+            offset += rdlength
+            if rtype != qtype:
+                continue
+            if qtype_name == 'TXT':
+                return rdata[1:1 + rdata[0]].decode('ascii', 'replace')
+            return str(ipaddress.ip_address(rdata))
+        return None
+    
+    @staticmethod
+    def _skip_dns_name(message: bytes, offset: int) -> int:
+        """Bỏ qua một tên miền (có thể nén) trong DNS message"""
+        while True:
+            length = message[offset]
+            if length == 0:
+                return offset + 1
+            if length & 0xC0 == 0xC0:
+                return offset + 2
+            offset += length + 1
+    
+    def _fetch_stun(self, service: str) -> Optional[str]:
+        """Hỏi IP qua STUN Binding Request (RFC 5389): stun://HOST[:PORT]"""
+        url = urlsplit(service)
+        transaction_id = os.urandom(12)
+        request = struct.pack('!HHI', 0x0001, 0, self.STUN_MAGIC_COOKIE) + transaction_id
+        
+        response = self._udp_exchange(
+            url.hostname, url.port or 3478, request,
+            lambda data: len(data) >= 20 and data[8:20] == transaction_id
+        )
+        
+        msg_type, msg_length = struct.unpack('!HH', response[:4])
+        if msg_type != 0x0101:
+            self.logger.debug(f"Service {service} trả về STUN message 0x{msg_type:04x}")
+            return None
+        
+        mapped = None
+        offset = 20
+        end = 20 + msg_length
+        while offset + 4 <= end:
+            attr_type, attr_length = struct.unpack('!HH', response[offset:offset + 4])
+            value = response[offset + 4:offset + 4 + attr_length]
+            offset += 4 + attr_length + (-attr_length % 4)
+            
+            # Chỉ lấy địa chỉ IPv4 (family 0x01), bỏ qua IPv6
+            if attr_type == 0x0020 and value[1] == 0x01:  # XOR-MAPPED-ADDRESS
+                raw = struct.unpack('!I', value[4:8])[0] ^ self.STUN_MAGIC_COOKIE
+                return str(ipaddress.IPv4Address(raw))
+            if attr_type == 0x0001 and value[1] == 0x01 and mapped is None:  # MAPPED-ADDRESS (RFC 3489)
+                mapped = str(ipaddress.IPv4Address(value[4:8]))
+        if mapped is None:
+            self.logger.debug(f"Service {service} không trả về địa chỉ IPv4")
+        return mapped
+    
+    def _validate_ip(self, service: str, text: str) -> Optional[str]:
+        """
+        Chỉ chấp nhận câu trả lời là một địa chỉ IPv4 hợp lệ (captive portal,
+        proxy...). IPv6 bị loại vì các target đều ghi IP dưới dạng IP/32.
+        """
+        try:
+            address = ipaddress.ip_address(text.strip())
+        except ValueError:
+            self.logger.warning(f"⚠ Service {service} trả về nội dung không phải IP: {text[:60]!r}")
+            return None
+        if not isinstance(address, ipaddress.IPv4Address):
+            self.logger.warning(f"⚠ Service {service} trả về IPv6 {address}, chỉ hỗ trợ IPv4")
+            return None
+        return str(address)
+    
+    def _get_ip_sequential(self) -> Optional[str]:
+        """Thử lần lượt từng service, dừng ở service đầu tiên thành công"""
+        for service in self.services:
             try:
-                response = requests.get(service, timeout=5)
-                if response.status_code == 200:
-                    ip = response.text.strip()
-                    self.logger.info(f"✓ Phát hiện IP công cộng: {ip}")
+                ip = self._fetch_ip(service)
+                if ip:
                     return ip
             except Exception as e:
                 self.logger.debug(f"Service {service} thất bại: {e}")
                 continue
+        return None
+    
+    def _start_lookup(self, service: str, results: 'queue.Queue'):
+        """
+        Hỏi một service trên daemon thread, đẩy (service, ip, lỗi) vào results.
+        Daemon thread không giữ process lại khi thoát, nên service chậm/chết
+        không làm cron chờ tới hết timeout của nó.
+        """
+        def lookup():
+            try:
+                results.put((service, self._fetch_ip(service), None))
+            except Exception as e:
+                results.put((service, None, e))
         
-        self.logger.error("✗ Không thể lấy IP công cộng từ các service")
+        threading.Thread(target=lookup, name=f"ip-lookup {service}", daemon=True).start()
+    
+    def _get_ip_race(self) -> Optional[str]:
+        """
+        Gửi request tới các service song song (so le theo hedge_delay),
+        lấy kết quả hợp lệ đầu tiên và bỏ các request còn lại
+        """
+        remaining = list(self.services)
+        results: 'queue.Queue' = queue.Queue()
+        in_flight = 0
+        
+        while remaining or in_flight:
+            if remaining:
+                self._start_lookup(remaining.pop(0), results)
+                in_flight += 1
+                # Còn service chưa gửi: chỉ chờ hết hedge_delay rồi gửi tiếp
+                timeout = self.hedge_delay if remaining else None
+            else:
+                timeout = None
+            
+            try:
+                service, ip, error = results.get(timeout=timeout)
+            except queue.Empty:
+                continue
+            in_flight -= 1
+            if error is not None:
+                self.logger.debug(f"Service {service} thất bại: {error}")
+            elif ip:
+                self.logger.debug(f"Service {service} trả lời nhanh nhất")
+                return ip
+        return None
+    
+    def _get_ip_quorum(self) -> Optional[str]:
+        """
+        Hỏi song song tất cả service, chỉ chấp nhận IP khi có ít nhất
+        `quorum` service trả về cùng một địa chỉ
+        """
+        results: 'queue.Queue' = queue.Queue()
+        for service in self.services:
+            self._start_lookup(service, results)
+        votes: Dict[str, List[str]] = {}
+        
+        for _ in self.services:
+            service, ip, error = results.get()
+            if error is not None:
+                self.logger.debug(f"Service {service} thất bại: {error}")
+                continue
+            if not ip:
+                continue
+            votes.setdefault(ip, []).append(service)
+            if len(votes[ip]) >= self.quorum:
+                self.logger.debug(
+                    f"Đạt quorum {self.quorum}/{len(self.services)} cho {ip}: "
+                    f"{', '.join(votes[ip])}"
+                )
+                return ip
+        
+        if len(votes) > 1:
+            answers = "; ".join(f"{ip} ← {', '.join(services)}" for ip, services in votes.items())
+            self.logger.warning(f"⚠ Các service trả về IP khác nhau: {answers}")
+        self.logger.warning(
+            f"⚠ Không đạt quorum {self.quorum}/{len(self.services)}, bỏ qua lần cập nhật này"
+        )
         return None
     
     def get_cached_ip(self) -> Optional[str]:
         """Đọc IP đã lưu từ lần chạy trước"""
-        try:
-            with open(self.cache_file, 'r') as f:
-                ip = f.read().strip()
-                self.logger.debug(f"IP cached: {ip}")
-                return ip
-        except FileNotFoundError:
-            self.logger.debug("Không tìm thấy file cache IP")
-            return None
+        self.state.load()
+        ip = self.state.ip
+        if ip:
+            self.logger.debug(f"IP cached: {ip}")
+        return ip
     
     def save_ip(self, ip: str):
         """Lưu IP vào cache"""
-        with open(self.cache_file, 'w') as f:
-            f.write(ip)
+        self.state.ip = ip
+        self.state.save(force=True)
         self.logger.debug(f"Đã lưu IP vào cache: {ip}")
     
-    def check_ip_change(self) -> Tuple[Optional[str], Optional[str], bool]:
+    def check_ip_change(
+        self,
+        current_ip: Optional[str] = None
+    ) -> Tuple[Optional[str], Optional[str], bool]:
         """
-        Kiểm tra thay đổi IP
+        Kiểm tra thay đổi IP (bỏ qua bước hỏi service nếu đã biết current_ip)
         Returns: (cached_ip, current_ip, changed)
         """
         cached_ip = self.get_cached_ip()
-        current_ip = self.get_current_ip()
+        if current_ip is None:
+            current_ip = self.get_current_ip()
         
         if current_ip is None:
             return cached_ip, None, False
@@ -177,244 +858,1432 @@ class IPService:
         return cached_ip, current_ip, changed
 
 
+class NetlinkWatcher:
+    """
+    Theo dõi thay đổi địa chỉ IPv4 của một network interface qua rtnetlink
+    (chỉ Linux), dùng khi IP công cộng nằm trực tiếp trên interface (PPPoE,
+    VM có public NIC)
+    """
+    
+    RTMGRP_IPV4_IFADDR = 0x10
+    RTM_NEWADDR = 20
+    RTM_DELADDR = 21
+    RTM_GETADDR = 22
+    NLMSG_ERROR = 2
+    NLMSG_DONE = 3
+    NLM_F_REQUEST = 0x1
+    NLM_F_DUMP = 0x300
+    IFA_ADDRESS = 1
+    IFA_LOCAL = 2
+    
+    NLMSG_HEADER = struct.Struct('=IHHII')
+    IFADDRMSG = struct.Struct('=BBBBI')
+    RTATTR = struct.Struct('=HH')
+    
+    def __init__(self, interface: str, logger: logging.Logger):
+        if not hasattr(socket, 'AF_NETLINK'):
+            raise RuntimeError("Chế độ watch cần rtnetlink (chỉ hỗ trợ Linux)")
+        self.interface = interface
+        self.logger = logger
+        self.index = socket.if_nametoindex(interface)
+        self._events = socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE)
+        self._events.bind((0, self.RTMGRP_IPV4_IFADDR))
+        self._seq = 0
+    
+    def close(self):
+        self._events.close()
+    
+    def addresses(self) -> List[str]:
+        """Liệt kê địa chỉ IPv4 hiện tại của interface (RTM_GETADDR dump)"""
+        self._seq += 1
+        request = self.NLMSG_HEADER.pack(
+            self.NLMSG_HEADER.size + self.IFADDRMSG.size,
+            self.RTM_GETADDR,
+            self.NLM_F_REQUEST | self.NLM_F_DUMP,
+            self._seq,
+            0
+        ) + self.IFADDRMSG.pack(socket.AF_INET, 0, 0, 0, 0)
+        
+        found = []
+        with socket.socket(socket.AF_NETLINK, socket.SOCK_RAW, socket.NETLINK_ROUTE) as sock:
+            sock.sendto(request, (0, 0))
+            while True:
+                data = sock.recv(65536)
+                messages = self.parse_messages(data)
+                for msg_type, index, address in messages:
+                    if msg_type == self.RTM_NEWADDR and index == self.index:
+                        found.append(address)
+                if any(msg_type in (self.NLMSG_DONE, self.NLMSG_ERROR) for msg_type, _, _ in messages):
+                    return found
+    
+    def public_address(self) -> Optional[str]:
+        """Địa chỉ IPv4 công cộng đầu tiên trên interface, None nếu chỉ có IP private/NAT"""
+        for address in self.addresses():
+            if ipaddress.ip_address(address).is_global:
+                return address
+        return None
+    
+    def wait_for_change(self, timeout: Optional[float], stop_event: threading.Event) -> bool:
+        """
+        Chờ sự kiện RTM_NEWADDR/RTM_DELADDR trên interface.
+        Returns: True nếu có thay đổi, False nếu hết timeout hoặc được yêu cầu dừng
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while not stop_event.is_set():
+            tick = 1.0
+            if deadline is not None:
+                tick = min(tick, deadline - time.monotonic())
+                if tick <= 0:
+                    return False
+            readable, _, _ = select.select([self._events], [], [], tick)
+            if not readable:
+                continue
+            for msg_type, index, address in self.parse_messages(self._events.recv(65536)):
+                if msg_type in (self.RTM_NEWADDR, self.RTM_DELADDR) and index == self.index:
+                    self.logger.debug(f"Netlink: địa chỉ {address} trên {self.interface} thay đổi")
+                    return True
+        return False
+    
+    @classmethod
+    def parse_messages(cls, data: bytes) -> List[Tuple[int, int, Optional[str]]]:
+        """Tách buffer netlink thành các (msg_type, ifindex, địa chỉ IPv4)"""
+        messages = []
+        offset = 0
+        while offset + cls.NLMSG_HEADER.size <= len(data):
+            length, msg_type, _, _, _ = cls.NLMSG_HEADER.unpack_from(data, offset)
+            if length < cls.NLMSG_HEADER.size:
+                break
+            index = 0
+            address = None
+            if msg_type in (cls.RTM_NEWADDR, cls.RTM_DELADDR):
+                body = offset + cls.NLMSG_HEADER.size
+                family, _, _, _, index = cls.IFADDRMSG.unpack_from(data, body)
+                attrs = {}
+                attr_offset = body + cls.IFADDRMSG.size
+                while attr_offset + cls.RTATTR.size <= offset + length:
+                    attr_length, attr_type = cls.RTATTR.unpack_from(data, attr_offset)
+                    if attr_length < cls.RTATTR.size:
+                        break
+                    attrs[attr_type] = data[attr_offset + cls.RTATTR.size:attr_offset + attr_length]
+                    attr_offset += (attr_length + 3) & ~3
+                # Với PPP, IFA_LOCAL là địa chỉ của mình, IFA_ADDRESS là địa chỉ peer
+                raw = attrs.get(cls.IFA_LOCAL) or attrs.get(cls.IFA_ADDRESS)
+                if family == socket.AF_INET and raw and len(raw) == 4:
+                    address = socket.inet_ntoa(raw)
+            messages.append((msg_type, index, address))
+            offset += (length + 3) & ~3
+        return messages
+
+
+# Client SDK đã tạo (gRPC channel, discovery document đã parse, token) được
+# dùng lại trong cả process, kể cả giữa các vòng daemon và các GCPUpdater:
+# key = (loại client, nguồn credentials)
+_CLIENT_CACHE: Dict[Tuple[str, Optional[str]], object] = {}
+_CLIENT_CACHE_LOCK = threading.Lock()
+
+
 class GCPUpdater:
     """Google Cloud Platform IP updater"""
     
+    # Số tên rule tối đa trong một filter của lệnh list
+    LIST_FILTER_CHUNK = 50
+    
+    SQLADMIN_VERSION = 'v1beta4'
+    
+    # Các trường riêng của từng project, không kế thừa từ cấp gcp vào gcp.projects
+    PROJECT_KEYS = (
+        'project_id', 'projects', 'firewall_rules', 'firewall_selectors', 'sql_instances', 'address_groups'
+    )
+    
+    TOKEN_SCOPES = ['https://www.googleapis.com/auth/cloud-platform']
+    # Token đã cache chỉ được dùng nếu còn hạn ít nhất chừng này giây
+    TOKEN_MIN_REMAINING = 300
+    
+    # Số request tối đa trong một BatchHttpRequest
+    SQL_BATCH_SIZE = 50
+    
+    # Tiền tố tên authorized network do script tạo trong Cloud SQL
+    SQL_AUTO_IP_PREFIX = 'auto-ip-'
+    
+    # Các điều kiện của một selector (AND); các selector với nhau là OR
+    SELECTOR_KEYS = ('name_regex', 'name_prefix', 'network', 'target_tags', 'description_marker')
+    
     def __init__(self, config: dict, logger: logging.Logger, dry_run: bool = False):
         self.config = config
         self.logger = logger
         self.dry_run = dry_run
-        self.credentials = self._load_credentials()
+        self._credentials = None
+        self._credentials_loaded = False
+        # Thời gian (giây) theo giai đoạn, IPUpdater gộp vào báo cáo mỗi lần chạy
+        self.timings: Dict[str, float] = {}
+        # Credentials dùng chung giữa các project cùng identity (gcp.projects)
+        self._credentials_pool: Optional[Dict[Optional[str], object]] = None
+        self._credentials_pool_lock = threading.Lock()
+        self._projects: Optional[List['GCPUpdater']] = None
+    
+    @property
+    def credentials(self) -> Optional['service_account.Credentials']:
+        """GCP credentials, chỉ load (và import SDK) ở lần dùng đầu tiên"""
+        if not self._credentials_loaded:
+            if self._credentials_pool is not None:
+                with self._credentials_pool_lock:
+                    key = self._credentials_key()
+                    if key not in self._credentials_pool:
+                        self._credentials_pool[key] = self._timed_load_credentials()
+                    self._credentials = self._credentials_pool[key]
+            else:
+                self._credentials = self._timed_load_credentials()
+            self._credentials_loaded = True
+        return self._credentials
     
-    def _load_credentials(self) -> Optional[service_account.Credentials]:
+    def _timed_load_credentials(self):
+        start = time.perf_counter()
+        try:
+            return self._load_credentials()
+        finally:
+            self.timings['gcp.auth'] = time.perf_counter() - start
+    
+    @property
+    def projects(self) -> Optional[List['GCPUpdater']]:
+        """
+        Một GCPUpdater cho mỗi project khi cấu hình có gcp.projects (project_id
+        ở cấp gcp, nếu có, là project đầu tiên), None nếu chỉ có một project.
+        Project kế thừa các tùy chọn chung (credentials_file, max_workers, ...)
+        từ cấp gcp nhưng không kế thừa danh sách target.
+        """
+        if self._projects is None and self.config.get('projects'):
+            shared = {k: v for k, v in self.config.items() if k not in self.PROJECT_KEYS}
+            blocks = ([self.config] if 'project_id' in self.config else []) + self.config['projects']
+            pool = {}
+            self._projects = []
+            for block in blocks:
+                project = GCPUpdater(
+                    {**shared, **{k: v for k, v in block.items() if k != 'projects'}},
+                    self.logger,
+                    self.dry_run
+                )
+                project.timings = self.timings
+                project._credentials_pool = pool
+                project._credentials_pool_lock = self._credentials_pool_lock
+                self._projects.append(project)
+        return self._projects
+    
+    def _fan_out(self, method: str, *args) -> bool:
+        """
+        Gọi method trên từng project song song. Mỗi project độc lập: lỗi (kể
+        cả thiếu quyền) của một project không chặn các project khác.
+        """
+        projects = self.projects
+        workers = max(1, min(self.config.get('project_workers', 8), len(projects)))
+        
+        def call(project: 'GCPUpdater') -> bool:
+            try:
+                return getattr(project, method)(*args)
+            except Exception as e:
+                self.logger.error(f"✗ Lỗi GCP project {project.config.get('project_id')}: {e}")
+                return False
+        
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(call, projects))
+        
+        failed = [project.config.get('project_id') for project, ok in zip(projects, results) if not ok]
+        if failed:
+            self.logger.warning(f"⚠ GCP projects lỗi: {', '.join(failed)}")
+        return not failed
+    
+    def _load_credentials(self) -> Optional['service_account.Credentials']:
         """Load GCP credentials"""
-        if not GCP_AVAILABLE:
+        if not _sdk_available('GCP_AVAILABLE'):
             return None
         
+        service_account = _lazy_import('service_account')
         creds_file = self.config.get('credentials_file')
         if creds_file and os.path.exists(creds_file):
             try:
-                creds = service_account.Credentials.from_service_account_file(creds_file)
+                # Scope cloud-platform tường minh: client dùng chính object
+                # này (không tạo bản scoped mới) nên token đã cache có hiệu lực
+                creds = service_account.Credentials.from_service_account_file(
+                    creds_file, scopes=self.TOKEN_SCOPES
+                )
                 self.logger.debug(f"Loaded GCP credentials từ {creds_file}")
-                return creds
             except Exception as e:
                 self.logger.warning(f"Không thể load credentials từ {creds_file}: {e}")
+            else:
+                if self.config.get('token_cache_dir'):
+                    self._apply_token_cache(creds, creds_file)
+                return creds
         
         self.logger.debug("Sử dụng Application Default Credentials")
         return None
     
-    def update_firewall_rules(self, old_ip: Optional[str], new_ip: str) -> bool:
+    def _token_cache_path(self, creds_file: str) -> str:
+        """File cache token, đặt tên theo fingerprint (sha256) của file credentials"""
+        with open(creds_file, 'rb') as f:
+            fingerprint = hashlib.sha256(f.read()).hexdigest()[:32]
+        return os.path.join(os.path.expanduser(self.config['token_cache_dir']), f"{fingerprint}.json")
+    
+    def _apply_token_cache(self, creds, creds_file: str):
+        """
+        Dùng access token đã cache trên đĩa nếu còn hạn (bỏ qua lần đổi token
+        với OAuth endpoint), nếu không thì lấy token mới và ghi lại cache.
+        File cache chỉ owner đọc được (0600); file có quyền rộng hơn bị bỏ qua.
+        """
+        try:
+            path = self._token_cache_path(creds_file)
+            now = datetime.now(timezone.utc).replace(tzinfo=None)  # google-auth dùng UTC naive
+            try:
+                if os.stat(path).st_mode & 0o077:
+                    self.logger.warning(f"⚠ Bỏ qua token cache có quyền truy cập quá rộng: {path}")
+                else:
+                    with open(path, 'r', encoding='utf-8') as f:
+                        cached = json.load(f)
+                    expiry = datetime.fromisoformat(cached['expiry'])
+                    if expiry - now > timedelta(seconds=self.TOKEN_MIN_REMAINING):
+                        creds.token = cached['token']
+                        creds.expiry = expiry
+                        self.logger.debug(f"Dùng access token đã cache (hết hạn {expiry.isoformat()}Z)")
+                        return
+            except FileNotFoundError:
+                pass
+            except (OSError, ValueError, KeyError, TypeError) as e:
+                self.logger.debug(f"Token cache không đọc được ({e}), lấy token mới")
+            
+            auth_requests = _lazy_import('auth_requests')
+            creds.refresh(auth_requests.Request())
+            self._write_token_cache(path, creds)
+        except Exception as e:
+            self.logger.warning(f"⚠ Không dùng được token cache: {e}")
+    
+    def _write_token_cache(self, path: str, creds):
+        directory = os.path.dirname(path)
+        os.makedirs(directory, mode=0o700, exist_ok=True)
+        # mkstemp tạo file với quyền 0600
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix=".token.", suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump({'token': creds.token, 'expiry': creds.expiry.isoformat()}, f)
+            os.replace(tmp_path, path)
+        except BaseException:
+            os.unlink(tmp_path)
+            raise
+        self.logger.debug(f"Đã lưu access token vào cache {path}")
+    
+    def _credentials_key(self) -> Optional[str]:
+        """Nguồn credentials: đường dẫn file service account, None = ADC"""
+        creds_file = self.config.get('credentials_file')
+        if creds_file and os.path.exists(creds_file):
+            return os.path.abspath(creds_file)
+        return None
+    
+    def _client(self, kind: str, factory):
+        """Client đã cache theo (kind, credentials), tạo bằng factory ở lần đầu"""
+        key = (kind, self._credentials_key())
+        with _CLIENT_CACHE_LOCK:
+            if key not in _CLIENT_CACHE:
+                _CLIENT_CACHE[key] = factory()
+            else:
+                self.logger.debug(f"Dùng lại client {kind} đã khởi tạo")
+            return _CLIENT_CACHE[key]
+    
+    def _firewalls_client(self) -> 'compute_v1.FirewallsClient':
+        compute_v1 = _lazy_import('compute_v1')
+        
+        def build():
+            if self.credentials:
+                return compute_v1.FirewallsClient(credentials=self.credentials)
+            return compute_v1.FirewallsClient()
+        
+        return self._client('compute.firewalls', build)
+    
+    def _sqladmin_service(self):
+        """
+        Service sqladmin dựng từ discovery document đóng gói sẵn trong
+        google-api-python-client (static_discovery), không tải document mỗi lần.
+        Bản cũ không kèm document thì dùng bản cache trên đĩa (xem
+        _discovery_document).
+        """
+        discovery = _lazy_import('discovery')
+        
+        def build():
+            kwargs = {'credentials': self.credentials} if self.credentials else {}
+            try:
+                return discovery.build(
+                    'sqladmin', self.SQLADMIN_VERSION,
+                    static_discovery=True, cache_discovery=False, **kwargs
+                )
+            except Exception as e:
+                self.logger.debug(f"Không có discovery document đóng gói sẵn ({e}), dùng cache trên đĩa")
+            document = self._discovery_document('sqladmin', self.SQLADMIN_VERSION)
+            return discovery.build_from_document(document, **kwargs)
+        
+        # httplib2 (transport của googleapiclient) không thread-safe: mỗi
+        # project (chạy trong thread riêng khi có gcp.projects) một service
+        project_id = self.config.get('project_id')
+        return self._client(f"sqladmin.{self.SQLADMIN_VERSION}/{project_id}", build)
+    
+    def _discovery_document(self, api: str, version: str) -> str:
+        """Discovery document từ cache trên đĩa theo API và version, tải một lần nếu chưa có"""
+        cache_dir = self.config.get(
+            'discovery_cache_dir', os.path.join(os.path.expanduser('~'), '.cache', 'ip-updater')
+        )
+        path = os.path.join(cache_dir, f"{api}.{version}.json")
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            pass
+        
+        response = requests.get(
+            f"https://{api}.googleapis.com/$discovery/rest", params={'version': version}, timeout=30
+        )
+        response.raise_for_status()
+        document = response.text
+        
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=cache_dir, prefix=f".{api}.{version}.", suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            f.write(document)
+        os.replace(tmp_path, path)
+        self.logger.debug(f"Đã lưu discovery document {api} {version} vào {path}")
+        return document
+    
+    def update_firewall_rules(
+        self,
+        old_ip: Optional[str],
+        new_ip: str,
+        state: Optional[StateStore] = None
+    ) -> bool:
         """Cập nhật GCP Firewall Rules"""
-        if not GCP_AVAILABLE:
+        if not _sdk_available('GCP_AVAILABLE'):
             self.logger.warning("⊘ Google Cloud SDK chưa được cài đặt")
             return False
         
-        rules = self.config.get('firewall_rules', [])
-        if not rules:
+        if self.projects:
+            return self._fan_out('update_firewall_rules', old_ip, new_ip, state)
+        
+        if not self.config.get('firewall_rules') and not self.config.get('firewall_selectors'):
             self.logger.debug("Không có firewall rules để cập nhật")
             return True
         
         try:
-            if self.credentials:
-                client = compute_v1.FirewallsClient(credentials=self.credentials)
-            else:
-                client = compute_v1.FirewallsClient()
+            client = self._firewalls_client()
             
             project_id = self.config.get('project_id')
-            success_count = 0
+            rules, discovered_index, discovery_ok = self._resolve_firewall_rules(
+                client, project_id, state
+            )
             
+            pending_rules = []
             for rule_name in rules:
-                if self._update_single_firewall_rule(client, project_id, rule_name, old_ip, new_ip):
-                    success_count += 1
+                if state and state.is_applied(f"gcp.firewall/{project_id}/{rule_name}", new_ip):
+                    self.logger.debug(f"  Firewall rule {rule_name} đã ở IP {new_ip}, bỏ qua")
+                else:
+                    pending_rules.append(rule_name)
+            
+            # Đọc mọi rule cần xử lý bằng một (vài) lệnh list có filter thay
+            # cho một lệnh get mỗi rule (rule vừa discovery đã có sẵn); None
+            # nếu list không dùng được.
+            index = dict(discovered_index)
+            unread = [rule_name for rule_name in pending_rules if rule_name not in index]
+            listed = self._list_firewalls(client, project_id, unread) if unread else {}
+            if listed is not None:
+                index.update(listed)
+            missing = []
+            
+            def submit(rule_name: str):
+                target = f"gcp.firewall/{project_id}/{rule_name}"
+                rule_old_ip = state.old_ip_for(target, old_ip) if state else old_ip
+                if rule_name not in index:
+                    if listed is None:
+                        return self._submit_firewall_update(
+                            client, project_id, rule_name, rule_old_ip, new_ip
+                        )
+                    self.logger.warning(f"⚠ Không tìm thấy firewall rule: {rule_name}")
+                    missing.append(rule_name)
+                    return False
+                return self._submit_firewall_update(
+                    client, project_id, rule_name, rule_old_ip, new_ip, firewall=index[rule_name]
+                )
+            
+            # Giai đoạn 1: gửi tất cả update (song song có giới hạn) và gom operation.
+            # Giai đoạn 2: chờ mọi operation cùng lúc, GCP xử lý song song phía server.
+            workers = max(1, min(self.config.get('max_workers', 8), len(pending_rules) or 1))
+            with ThreadPoolExecutor(max_workers=workers) as executor:
+                submitted = dict(zip(pending_rules, executor.map(submit, pending_rules)))
+                results = {name: r for name, r in submitted.items() if isinstance(r, bool)}
+                operations = {name: r for name, r in submitted.items() if not isinstance(r, bool)}
+                results.update(self._wait_for_operations(
+                    operations,
+                    self.config.get('operation_timeout', 300),
+                    lambda pending: dict(zip(pending, executor.map(self._operation_done, pending.values()))),
+                    "GCP Firewall rule"
+                ))
+            
+            if state and not self.dry_run:
+                for rule_name, ok in results.items():
+                    if ok:
+                        state.mark_applied(f"gcp.firewall/{project_id}/{rule_name}", new_ip)
             
-            return success_count == len(rules)
+            # Rule đã cache từ discovery nhưng không còn tồn tại: resolve lại lần sau
+            if state and missing and self.config.get('firewall_selectors'):
+                state.forget_discovered(f"gcp.firewall/{project_id}")
+            
+            failed = [rule_name for rule_name, ok in results.items() if not ok]
+            if failed:
+                self.logger.warning(f"⚠ Firewall rules lỗi: {', '.join(failed)}")
+            return discovery_ok and not failed
             
         except Exception as e:
             self.logger.error(f"✗ Lỗi GCP Firewall: {e}")
             return False
     
-    def _update_single_firewall_rule(
+    def _resolve_firewall_rules(
+        self,
+        client: 'compute_v1.FirewallsClient',
+        project_id: str,
+        state: Optional[StateStore]
+    ) -> Tuple[List[str], Dict[str, object], bool]:
+        """
+        Danh sách rule cần cập nhật: gcp.firewall_rules cộng các rule khớp
+        gcp.firewall_selectors. Selector được resolve bằng một lệnh list (có
+        filter phía server khi được) và kết quả được cache trong state
+        discovery_ttl giây.
+        Returns: (tên rule, index tên -> Firewall của các rule vừa list, resolve thành công)
+        """
+        rules = list(self.config.get('firewall_rules', []))
+        selectors = self.config.get('firewall_selectors', [])
+        if not selectors:
+            return rules, {}, True
+        
+        key = f"gcp.firewall/{project_id}"
+        fingerprint = self._selectors_key(selectors)
+        cached = state.discovered(key, fingerprint, self.config.get('discovery_ttl', 3600)) if state else None
+        if cached is not None:
+            self.logger.debug(f"Dùng {len(cached)} firewall rules đã discovery (cache)")
+            return rules + [name for name in cached if name not in rules], {}, True
+        
+        compute_v1 = _lazy_import('compute_v1')
+        server_filter = self._selector_filter(selectors)
+        # Filter phía server dùng RE2: regex Python hợp lệ (ví dụ lookahead) có
+        # thể bị từ chối, khi đó list lại không filter (kết quả vẫn lọc cục bộ)
+        for list_filter in ([server_filter, None] if server_filter else [None]):
+            request = compute_v1.ListFirewallsRequest(project=project_id)
+            if list_filter:
+                request.filter = list_filter
+            try:
+                index = {
+                    firewall.name: firewall
+                    for firewall in client.list(request=request)
+                    if any(self._selector_matches(selector, firewall) for selector in selectors)
+                }
+                break
+            except Exception as e:
+                if list_filter:
+                    self.logger.debug(f"List có filter lỗi ({e}), list lại không filter")
+                    continue
+                self.logger.error(f"✗ Lỗi khi discovery firewall rules theo selector: {e}")
+                return rules, {}, False
+        
+        names = sorted(index)
+        self.logger.info(f"  Selector khớp {len(names)} firewall rules")
+        if state:
+            state.set_discovered(key, fingerprint, names)
+        return rules + [name for name in names if name not in rules], index, True
+    
+    @staticmethod
+    def _selectors_key(selectors: List[dict]) -> str:
+        """Hash của selectors: cache discovery mất hiệu lực khi cấu hình đổi"""
+        return hashlib.sha256(json.dumps(selectors, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+    
+    @staticmethod
+    def _selector_filter(selectors: List[dict]) -> Optional[str]:
+        """
+        Filter phía server (cú pháp regex `eq` của Compute API) để thu hẹp lệnh
+        list: theo tên khi mọi selector đều có điều kiện tên, thêm network khi
+        chỉ có một selector. Kết quả luôn được lọc lại cục bộ.
+        """
+        patterns = []
+        for selector in selectors:
+            if 'name_prefix' in selector:
+                patterns.append(re.escape(selector['name_prefix']) + '.*')
+            elif 'name_regex' in selector:
+                patterns.append(f".*(?:{selector['name_regex']}).*")
+            else:
+                return None
+        if any('"' in pattern for pattern in patterns):
+            return None
+        
+        clauses = [f'(name eq "{"|".join(f"(?:{p})" for p in patterns)}")']
+        network = selectors[0].get('network') if len(selectors) == 1 else None
+        if network and '"' not in network:
+            clauses.append(f'(network eq ".*/networks/{re.escape(network.rsplit("/", 1)[-1])}")')
+        return ' '.join(clauses)
+    
+    @staticmethod
+    def _selector_matches(selector: dict, firewall) -> bool:
+        """Firewall khớp mọi điều kiện của selector"""
+        name = firewall.name
+        if 'name_prefix' in selector and not name.startswith(selector['name_prefix']):
+            return False
+        if 'name_regex' in selector and not re.search(selector['name_regex'], name):
+            return False
+        if 'network' in selector:
+            network = selector['network']
+            if firewall.network != network and not firewall.network.endswith(f"/networks/{network}"):
+                return False
+        if 'target_tags' in selector and not set(selector['target_tags']) & set(firewall.target_tags):
+            return False
+        if 'description_marker' in selector and selector['description_marker'] not in (firewall.description or ''):
+            return False
+        return True
+    
+    def _list_firewalls(
+        self,
+        client: 'compute_v1.FirewallsClient',
+        project_id: str,
+        rule_names: List[str]
+    ) -> Optional[Dict[str, object]]:
+        """
+        Đọc các firewall rule theo tên bằng lệnh list có filter phía server
+        (chia nhóm để filter không quá dài, pager tự lấy các trang tiếp theo).
+        Returns: dict tên rule -> Firewall, None nếu list lỗi (dùng get từng rule)
+        """
+        compute_v1 = _lazy_import('compute_v1')
+        index = {}
+        try:
+            for start in range(0, len(rule_names), self.LIST_FILTER_CHUNK):
+                chunk = rule_names[start:start + self.LIST_FILTER_CHUNK]
+                request = compute_v1.ListFirewallsRequest(
+                    project=project_id,
+                    filter=" OR ".join(f'(name = "{name}")' for name in chunk)
+                )
+                for firewall in client.list(request=request):
+                    index[firewall.name] = firewall
+        except Exception as e:
+            self.logger.debug(f"Không list được firewall rules ({e}), đọc từng rule")
+            return None
+        
+        self.logger.debug(f"Đã đọc {len(index)}/{len(rule_names)} firewall rules bằng list")
+        return index
+    
+    def _submit_firewall_update(
         self, 
-        client: compute_v1.FirewallsClient,
+        client: 'compute_v1.FirewallsClient',
         project_id: str,
         rule_name: str,
         old_ip: Optional[str],
-        new_ip: str
+        new_ip: str,
+        firewall=None
+    ):
+        """
+        Gửi PATCH cho một firewall rule, không chờ operation hoàn tất.
+        Body chỉ gồm source_ranges (Firewall của Compute API không có
+        fingerprint); nếu rule đang bị thay đổi bởi công cụ khác (409/412)
+        thì đọc lại và thử lại.
+        firewall: bản đã đọc sẵn bằng _list_firewalls, None thì gọi get.
+        Returns: operation nếu đã gửi patch, True nếu không cần ghi, False nếu lỗi
+        """
+        compute_v1 = _lazy_import('compute_v1')
+        attempts = self.config.get('conflict_retries', 3) + 1
+        
+        for attempt in range(1, attempts + 1):
+            try:
+                if firewall is None:
+                    firewall = client.get(project=project_id, firewall=rule_name)
+                
+                old_cidr = f"{old_ip}/32" if old_ip else None
+                new_cidr = f"{new_ip}/32"
+                
+                source_ranges = list(firewall.source_ranges)
+                has_old = bool(old_cidr) and old_cidr != new_cidr and old_cidr in source_ranges
+                
+                # Rule đã có IP mới và không còn IP cũ: không cần ghi
+                if new_cidr in source_ranges and not has_old:
+                    self.logger.info(f"  IP {new_cidr} đã tồn tại trong rule {rule_name}")
+                    return True
+                
+                # Xóa IP cũ
+                if has_old:
+                    source_ranges.remove(old_cidr)
+                    self.logger.debug(f"  Xóa IP cũ: {old_cidr}")
+                
+                # Thêm IP mới
+                if new_cidr not in source_ranges:
+                    source_ranges.append(new_cidr)
+                    self.logger.debug(f"  Thêm IP mới: {new_cidr}")
+                
+                if self.dry_run:
+                    self.logger.info(f"[DRY-RUN] Sẽ cập nhật firewall rule: {rule_name}")
+                    return True
+                
+                return client.patch(
+                    project=project_id,
+                    firewall=rule_name,
+                    firewall_resource=compute_v1.Firewall(source_ranges=source_ranges)
+                )
+                
+            except Exception as e:
+                if self._is_conflict(e) and attempt < attempts:
+                    self.logger.debug(
+                        f"  Rule {rule_name} vừa bị thay đổi bởi nơi khác, thử lại lần {attempt}"
+                    )
+                    firewall = None
+                    continue
+                if "not found" in str(e).lower():
+                    self.logger.warning(f"⚠ Không tìm thấy firewall rule: {rule_name}")
+                else:
+                    self.logger.error(f"✗ Lỗi khi cập nhật rule {rule_name}: {e}")
+                return False
+    
+    @staticmethod
+    def _is_conflict(error: Exception) -> bool:
+        """Lỗi xung đột ghi đồng thời (409 Conflict / 412 Precondition Failed)"""
+        status = getattr(error, 'code', None)
+        if status is None and getattr(error, 'resp', None) is not None:
+            status = getattr(error.resp, 'status', None)
+        try:
+            return int(status) in (409, 412)
+        except (TypeError, ValueError):
+            return False
+    
+    def _wait_for_operations(
+        self,
+        operations: Dict[str, object],
+        timeout: float,
+        poll,
+        label: str
+    ) -> Dict[str, bool]:
+        """
+        Chờ nhiều long-running operation cùng lúc với một deadline chung,
+        poll trạng thái của tất cả mỗi vòng với khoảng chờ tăng dần.
+        poll(pending) trả về {tên: None nếu chưa xong, True nếu thành công,
+        exception nếu lỗi}
+        Returns: {tên: thành công}
+        """
+        results = {}
+        pending = dict(operations)
+        deadline = time.monotonic() + timeout
+        delay = 0.5
+        
+        while pending:
+            for name, done in poll(dict(pending)).items():
+                if done is None:
+                    continue
+                del pending[name]
+                if done is True:
+                    results[name] = True
+                    self.logger.info(f"✓ Đã cập nhật {label}: {name}")
+                else:
+                    results[name] = False
+                    self.logger.error(f"✗ Lỗi khi cập nhật {name}: {done}")
+            
+            if not pending:
+                break
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                for name in pending:
+                    results[name] = False
+                    self.logger.error(f"✗ Hết thời gian chờ operation của {name} ({timeout}s)")
+                break
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 1.5, 5.0)
+        
+        return results
+    
+    @staticmethod
+    def _operation_done(operation):
+        """
+        Poll một operation
+        Returns: None nếu chưa xong, True nếu thành công, exception nếu lỗi
+        """
+        try:
+            if not operation.done():
+                return None
+            operation.result()
+            return True
+        except Exception as e:
+            return e
+    
+    def update_address_groups(
+        self,
+        old_ip: Optional[str],
+        new_ip: str,
+        state: Optional[StateStore] = None
     ) -> bool:
-        """Cập nhật một firewall rule"""
+        """
+        Cập nhật các address group (gcp.address_groups) của Network Security
+        API. Rule của network firewall policy tham chiếu address group nên mỗi
+        lần đổi IP chỉ một lệnh update cho mỗi group, dù bao nhiêu rule dùng nó.
+        """
+        if not any(project.config.get('address_groups') for project in self.projects or [self]):
+            self.logger.debug("Không có address groups để cập nhật")
+            return True
+        
+        if not _sdk_available('NETWORK_SECURITY_AVAILABLE'):
+            self.logger.warning("⊘ google-cloud-network-security chưa được cài đặt")
+            return False
+        
+        if self.projects:
+            return self._fan_out('update_address_groups', old_ip, new_ip, state)
+        
+        try:
+            client = self._address_groups_client()
+            project_id = self.config.get('project_id')
+            
+            operations = {}
+            results = {}
+            for group in self.config['address_groups']:
+                target = f"gcp.address_group/{project_id}/{group['name']}"
+                if state and state.is_applied(target, new_ip):
+                    self.logger.debug(f"  Address group {group['name']} đã ở IP {new_ip}, bỏ qua")
+                    continue
+                
+                group_old_ip = state.old_ip_for(target, old_ip) if state else old_ip
+                submitted = self._submit_address_group_update(client, group, group_old_ip, new_ip)
+                if isinstance(submitted, bool):
+                    results[group['name']] = submitted
+                else:
+                    operations[group['name']] = submitted
+            
+            results.update(self._wait_for_operations(
+                operations,
+                self.config.get('operation_timeout', 300),
+                lambda pending: {name: self._operation_done(op) for name, op in pending.items()},
+                "GCP address group"
+            ))
+            
+            if state and not self.dry_run:
+                for name, ok in results.items():
+                    if ok:
+                        state.mark_applied(f"gcp.address_group/{project_id}/{name}", new_ip)
+            
+            failed = [name for name, ok in results.items() if not ok]
+            if failed:
+                self.logger.warning(f"⚠ Address groups lỗi: {', '.join(failed)}")
+            return not failed
+            
+        except Exception as e:
+            self.logger.error(f"✗ Lỗi GCP address groups: {e}")
+            return False
+    
+    def _address_group_name(self, group: dict) -> str:
+        """Tên đầy đủ projects/{project}/locations/{location}/addressGroups/{name}"""
+        return (
+            f"projects/{self.config.get('project_id')}/locations/{group.get('location', 'global')}"
+            f"/addressGroups/{group['name']}"
+        )
+    
+    def _address_groups_client(self):
+        network_security_v1 = _lazy_import('network_security_v1')
+        
+        def build():
+            if self.credentials:
+                return network_security_v1.AddressGroupServiceClient(credentials=self.credentials)
+            return network_security_v1.AddressGroupServiceClient()
+        
+        return self._client('networksecurity.address_groups', build)
+    
+    def _submit_address_group_update(self, client, group: dict, old_ip: Optional[str], new_ip: str):
+        """
+        Đổi IP cũ thành IP mới trong items của một address group bằng một
+        lệnh update (update_mask items), giữ nguyên các item khác; xung đột
+        (409/412) thì đọc lại và thử lại.
+        Returns: operation nếu đã gửi update, True nếu không cần ghi, False nếu lỗi
+        """
+        network_security_v1 = _lazy_import('network_security_v1')
+        field_mask_pb2 = _lazy_import('field_mask_pb2')
+        name = self._address_group_name(group)
+        old_cidr = f"{old_ip}/32" if old_ip else None
+        new_cidr = f"{new_ip}/32"
+        attempts = self.config.get('conflict_retries', 3) + 1
+        
+        for attempt in range(1, attempts + 1):
+            try:
+                items = list(client.get_address_group(name=name).items)
+                has_old = bool(old_cidr) and old_cidr != new_cidr and old_cidr in items
+                if new_cidr in items and not has_old:
+                    self.logger.info(f"  IP {new_cidr} đã tồn tại trong address group {group['name']}")
+                    return True
+                
+                if has_old:
+                    items.remove(old_cidr)
+                if new_cidr not in items:
+                    items.append(new_cidr)
+                
+                if self.dry_run:
+                    self.logger.info(f"[DRY-RUN] Sẽ cập nhật address group: {group['name']}")
+                    return True
+                
+                return client.update_address_group(
+                    address_group=network_security_v1.AddressGroup(name=name, items=items),
+                    update_mask=field_mask_pb2.FieldMask(paths=['items'])
+                )
+                
+            except Exception as e:
+                if self._is_conflict(e) and attempt < attempts:
+                    self.logger.debug(
+                        f"  Address group {group['name']} vừa bị thay đổi bởi nơi khác, thử lại lần {attempt}"
+                    )
+                    continue
+                self.logger.error(f"✗ Lỗi khi cập nhật address group {group['name']}: {e}")
+                return False
+    
+    def migrate_to_address_groups(self, ip: str) -> bool:
+        """
+        Chuyển đổi một lần: trong các rule của network firewall policy
+        (address_groups[].firewall_policies) đang chứa ip/32 trong
+        src_ip_ranges, thay CIDR đó bằng tham chiếu tới address group.
+        Firewall rule VPC kiểu cũ (firewall_rules) không tham chiếu được
+        address group nên chỉ được liệt kê để chuyển sang policy thủ công.
+        """
+        if self.projects:
+            return self._fan_out('migrate_to_address_groups', ip)
+        
+        project_id = self.config.get('project_id')
+        if self.config.get('firewall_rules'):
+            self.logger.warning(
+                f"⚠ Firewall rules VPC không dùng được address group, cần chuyển sang network "
+                f"firewall policy: {', '.join(self.config['firewall_rules'])}"
+            )
+        
+        groups = [g for g in self.config.get('address_groups', []) if g.get('firewall_policies')]
+        if not groups:
+            self.logger.info("Không có firewall policy nào cần chuyển sang address group")
+            return True
+        
         try:
-            firewall = client.get(project=project_id, firewall=rule_name)
-            
-            old_cidr = f"{old_ip}/32" if old_ip else None
-            new_cidr = f"{new_ip}/32"
-            
-            source_ranges = list(firewall.source_ranges)
-            
-            # Xóa IP cũ
-            if old_cidr and old_cidr in source_ranges:
-                source_ranges.remove(old_cidr)
-                self.logger.debug(f"  Xóa IP cũ: {old_cidr}")
-            
-            # Thêm IP mới
-            if new_cidr not in source_ranges:
-                source_ranges.append(new_cidr)
-                self.logger.debug(f"  Thêm IP mới: {new_cidr}")
-            else:
-                self.logger.info(f"  IP {new_cidr} đã tồn tại trong rule {rule_name}")
-                return True
-            
-            if self.dry_run:
-                self.logger.info(f"[DRY-RUN] Sẽ cập nhật firewall rule: {rule_name}")
-                return True
-            
-            # Cập nhật
-            firewall.source_ranges = source_ranges
-            operation = client.update(
-                project=project_id,
-                firewall=rule_name,
-                firewall_resource=firewall
+            compute_v1 = _lazy_import('compute_v1')
+            client = self._client(
+                'compute.network_firewall_policies',
+                lambda: compute_v1.NetworkFirewallPoliciesClient(
+                    **({'credentials': self.credentials} if self.credentials else {})
+                )
             )
-            operation.result()
+            cidr = f"{ip}/32"
+            operations = {}
+            for group in groups:
+                group_name = self._address_group_name(group)
+                for policy_name in group['firewall_policies']:
+                    policy = client.get(project=project_id, firewall_policy=policy_name)
+                    for rule in policy.rules:
+                        if cidr not in rule.match.src_ip_ranges:
+                            continue
+                        label = f"{policy_name}/{rule.priority}"
+                        rule.match.src_ip_ranges = [r for r in rule.match.src_ip_ranges if r != cidr]
+                        if group_name not in rule.match.src_address_groups:
+                            rule.match.src_address_groups = list(rule.match.src_address_groups) + [group_name]
+                        if self.dry_run:
+                            self.logger.info(f"[DRY-RUN] Sẽ chuyển rule {label}: {cidr} → {group['name']}")
+                            continue
+                        # priority chỉ truyền được qua request object, không có tham số riêng
+                        operations[label] = client.patch_rule(
+                            request=compute_v1.PatchRuleNetworkFirewallPolicyRequest(
+                                project=project_id,
+                                firewall_policy=policy_name,
+                                priority=rule.priority,
+                                firewall_policy_rule_resource=rule
+                            )
+                        )
             
-            self.logger.info(f"✓ Đã cập nhật GCP Firewall rule: {rule_name}")
-            return True
+            results = self._wait_for_operations(
+                operations,
+                self.config.get('operation_timeout', 300),
+                lambda pending: {label: self._operation_done(op) for label, op in pending.items()},
+                "firewall policy rule"
+            )
+            return all(results.values())
             
         except Exception as e:
-            if "not found" in str(e).lower():
-                self.logger.warning(f"⚠ Không tìm thấy firewall rule: {rule_name}")
-            else:
-                self.logger.error(f"✗ Lỗi khi cập nhật rule {rule_name}: {e}")
+            self.logger.error(f"✗ Lỗi chuyển firewall policy sang address group: {e}")
             return False
     
-    def update_cloud_sql(self, old_ip: Optional[str], new_ip: str) -> bool:
+    def update_cloud_sql(
+        self,
+        old_ip: Optional[str],
+        new_ip: str,
+        state: Optional[StateStore] = None
+    ) -> bool:
         """Cập nhật GCP Cloud SQL Authorized Networks"""
-        if not GOOGLE_API_AVAILABLE:
+        if not _sdk_available('GOOGLE_API_AVAILABLE'):
             self.logger.warning("⊘ Google API Python Client chưa được cài đặt")
             return False
         
+        if self.projects:
+            return self._fan_out('update_cloud_sql', old_ip, new_ip, state)
+        
         instances = self.config.get('sql_instances', [])
         if not instances:
             self.logger.debug("Không có Cloud SQL instances để cập nhật")
             return True
         
         try:
-            if self.credentials:
-                service = discovery.build('sqladmin', 'v1beta4', credentials=self.credentials)
-            else:
-                service = discovery.build('sqladmin', 'v1beta4')
+            service = self._sqladmin_service()
             
             project_id = self.config.get('project_id')
-            success_count = 0
             
+            pending = []
             for instance_name in instances:
-                if self._update_single_sql_instance(service, project_id, instance_name, old_ip, new_ip):
-                    success_count += 1
+                if state and state.is_applied(f"gcp.sql/{project_id}/{instance_name}", new_ip):
+                    self.logger.debug(f"  Cloud SQL {instance_name} đã ở IP {new_ip}, bỏ qua")
+                else:
+                    pending.append(instance_name)
+            
+            # Giai đoạn 1: đọc mọi instance bằng batch request và tính thay đổi.
+            # Giai đoạn 2: gửi mọi patch cùng lúc (batch), Cloud SQL xử lý song
+            # song. Instance bị đổi đồng thời (settingsVersion không khớp) được
+            # đọc lại và patch lại.
+            results = {}
+            operations = {}
+            attempts = self.config.get('conflict_retries', 3) + 1
+            for attempt in range(1, attempts + 1):
+                patches = {}
+                reads = self._execute_batch(service, {
+                    instance_name: service.instances().get(project=project_id, instance=instance_name)
+                    for instance_name in pending
+                })
+                for instance_name in pending:
+                    instance, error = reads[instance_name]
+                    if error is not None:
+                        results[instance_name] = False
+                        self._log_sql_error(instance_name, error)
+                        continue
+                    
+                    target = f"gcp.sql/{project_id}/{instance_name}"
+                    instance_old_ip = state.old_ip_for(target, old_ip) if state else old_ip
+                    body = self._sql_patch_body(instance, instance_name, instance_old_ip, new_ip)
+                    if body is None:
+                        results[instance_name] = True
+                    elif self.dry_run:
+                        self.logger.info(f"[DRY-RUN] Sẽ cập nhật Cloud SQL: {instance_name}")
+                        results[instance_name] = True
+                    else:
+                        patches[instance_name] = service.instances().patch(
+                            project=project_id,
+                            instance=instance_name,
+                            body=body
+                        )
+                
+                pending = []
+                for instance_name, (operation, error) in self._execute_batch(service, patches).items():
+                    if error is not None:
+                        if self._is_conflict(error) and attempt < attempts:
+                            self.logger.debug(
+                                f"  Cloud SQL {instance_name} vừa bị thay đổi bởi nơi khác, thử lại lần {attempt}"
+                            )
+                            pending.append(instance_name)
+                            continue
+                        results[instance_name] = False
+                        self._log_sql_error(instance_name, error)
+                    elif not operation or not operation.get('name') or operation.get('status') == 'DONE':
+                        results[instance_name] = True
+                        self.logger.info(f"✓ Đã cập nhật Cloud SQL: {instance_name}")
+                    else:
+                        operations[instance_name] = operation['name']
+                if not pending:
+                    break
             
-            return success_count == len(instances)
+            # Giai đoạn 3: chờ mọi operation với deadline chung
+            results.update(self._wait_for_operations(
+                operations,
+                self.config.get('operation_timeout', 300),
+                lambda pending_ops: self._poll_sql_operations(service, project_id, pending_ops),
+                "Cloud SQL"
+            ))
+            
+            if state and not self.dry_run:
+                for instance_name, ok in results.items():
+                    if ok:
+                        state.mark_applied(f"gcp.sql/{project_id}/{instance_name}", new_ip)
+            
+            failed = [instance_name for instance_name, ok in results.items() if not ok]
+            if failed:
+                self.logger.warning(f"⚠ Cloud SQL instances lỗi: {', '.join(failed)}")
+            return not failed
             
         except Exception as e:
             self.logger.error(f"✗ Lỗi Cloud SQL: {e}")
             return False
     
-    def _update_single_sql_instance(
+    def _sql_patch_body(
         self,
-        service,
-        project_id: str,
+        instance: dict,
         instance_name: str,
         old_ip: Optional[str],
         new_ip: str
-    ) -> bool:
-        """Cập nhật một Cloud SQL instance"""
-        try:
-            # Lấy instance hiện tại
-            instance = service.instances().get(
-                project=project_id,
-                instance=instance_name
-            ).execute()
-            
-            # Lấy authorized networks
-            settings = instance.get('settings', {})
-            ip_config = settings.get('ipConfiguration', {})
-            authorized_networks = ip_config.get('authorizedNetworks', [])
-            
-            # Xóa IP cũ
-            if old_ip:
-                authorized_networks = [
-                    net for net in authorized_networks 
-                    if net.get('value') not in [old_ip, f"{old_ip}/32"]
-                ]
-            
-            # Kiểm tra IP mới
-            ip_exists = any(
-                net.get('value') in [new_ip, f"{new_ip}/32"] 
-                for net in authorized_networks
-            )
-            
-            if not ip_exists:
-                new_entry = {
-                    'value': new_ip,
-                    'name': f'auto-ip-{datetime.now().strftime("%Y%m%d-%H%M%S")}'
-                }
-                authorized_networks.append(new_entry)
-            else:
-                self.logger.info(f"  IP {new_ip} đã tồn tại trong {instance_name}")
-                return True
-            
-            if self.dry_run:
-                self.logger.info(f"[DRY-RUN] Sẽ cập nhật Cloud SQL: {instance_name}")
-                return True
-            
-            # Cập nhật
-            ip_config['authorizedNetworks'] = authorized_networks
-            settings['ipConfiguration'] = ip_config
-            
-            service.instances().patch(
-                project=project_id,
-                instance=instance_name,
-                body={'settings': settings}
-            ).execute()
-            
-            self.logger.info(f"✓ Đã cập nhật Cloud SQL: {instance_name}")
-            return True
-            
-        except HttpError as e:
-            if e.resp.status == 404:
-                self.logger.warning(f"⚠ Không tìm thấy Cloud SQL instance: {instance_name}")
-            else:
-                self.logger.error(f"✗ Lỗi khi cập nhật {instance_name}: {e}")
+    ) -> Optional[dict]:
+        """
+        Tính body patch cho instance: chỉ authorized networks (gỡ IP cũ, thêm
+        IP mới) cùng settingsVersion đã đọc, để Cloud SQL từ chối patch nếu
+        settings vừa bị thay đổi ở nơi khác
+        Returns: body cần patch, None nếu IP mới đã có (không cần ghi)
+        """
+        settings = instance.get('settings', {})
+        authorized_networks = settings.get('ipConfiguration', {}).get('authorizedNetworks', [])
+        
+        # Xóa IP cũ
+        current_count = len(authorized_networks)
+        if old_ip and old_ip != new_ip:
+            authorized_networks = [
+                net for net in authorized_networks 
+                if net.get('value') not in [old_ip, f"{old_ip}/32"]
+            ]
+        
+        # Dọn các entry auto-ip-<tag>-* (do chính bản cài đặt này tạo) không
+        # còn là IP hiện tại, tích tụ sau khi mất file cache hoặc lần chạy lỗi.
+        # Entry của bản cài đặt khác (tag khác) dùng chung instance không bị gỡ.
+        tag = self._sql_auto_ip_tag()
+        if self.config.get('sql_compact_auto_ip', True):
+            cutoff = datetime.now() - timedelta(hours=self.config.get('sql_auto_ip_retention_hours', 0))
+            kept = [
+                net for net in authorized_networks if not self._is_stale_auto_ip(net, new_ip, cutoff, tag)
+            ]
+            if len(kept) != len(authorized_networks):
+                self.logger.debug(
+                    f"  Dọn {len(authorized_networks) - len(kept)} entry {self.SQL_AUTO_IP_PREFIX}{tag}-* cũ "
+                    f"trong {instance_name}"
+                )
+            authorized_networks = kept
+        removed_old = len(authorized_networks) != current_count
+        
+        # Kiểm tra IP mới
+        ip_exists = any(
+            net.get('value') in [new_ip, f"{new_ip}/32"] 
+            for net in authorized_networks
+        )
+        if ip_exists and not removed_old:
+            self.logger.info(f"  IP {new_ip} đã tồn tại trong {instance_name}")
+            return None
+        
+        if not ip_exists:
+            authorized_networks.append({
+                'value': new_ip,
+                'name': f'{self.SQL_AUTO_IP_PREFIX}{tag}-{datetime.now().strftime("%Y%m%d-%H%M%S")}'
+            })
+        patch_settings = {'ipConfiguration': {'authorizedNetworks': authorized_networks}}
+        if 'settingsVersion' in settings:
+            patch_settings['settingsVersion'] = settings['settingsVersion']
+        return {'settings': patch_settings}
+    
+    def _sql_auto_ip_tag(self) -> str:
+        """
+        Tag của bản cài đặt trong tên entry auto-ip-<tag>-YYYYmmdd-HHMMSS:
+        gcp.sql_auto_ip_tag, mặc định là hostname
+        """
+        tag = self.config.get('sql_auto_ip_tag')
+        if not tag:
+            tag = re.sub(r'[^A-Za-z0-9_.-]', '-', socket.gethostname().split('.')[0]) or 'host'
+        return tag
+    
+    @classmethod
+    def _is_stale_auto_ip(cls, network: dict, new_ip: str, cutoff: datetime, tag: str) -> bool:
+        """
+        Entry do bản cài đặt này tạo (tên auto-ip-<tag>-YYYYmmdd-HHMMSS), không
+        phải IP mới và được tạo trước cutoff. Entry đặt tên khác (thêm tay,
+        tag khác, tên cũ không có tag) không bao giờ bị gỡ.
+        """
+        match = re.fullmatch(
+            re.escape(f"{cls.SQL_AUTO_IP_PREFIX}{tag}-") + r'(\d{8}-\d{6})', network.get('name') or ''
+        )
+        if not match or network.get('value') in [new_ip, f"{new_ip}/32"]:
+            return False
+        try:
+            created_at = datetime.strptime(match.group(1), "%Y%m%d-%H%M%S")
+        except ValueError:
             return False
+        return created_at < cutoff
+    
+    def _log_sql_error(self, instance_name: str, error: Exception):
+        status = getattr(getattr(error, 'resp', None), 'status', None)
+        if status == 404:
+            self.logger.warning(f"⚠ Không tìm thấy Cloud SQL instance: {instance_name}")
+        else:
+            self.logger.error(f"✗ Lỗi khi cập nhật {instance_name}: {error}")
+    
+    def _execute_batch(
+        self,
+        service,
+        requests: Dict[str, object]
+    ) -> Dict[str, Tuple[Optional[dict], Optional[Exception]]]:
+        """
+        Gửi nhiều request của googleapiclient trong BatchHttpRequest (mỗi batch
+        tối đa SQL_BATCH_SIZE request). Request không nhận được kết quả từ
+        batch (batch lỗi) được gửi riêng từng cái.
+        Returns: {tên: (response, exception)}
+        """
+        results = {}
+        
+        def callback(request_id, response, exception):
+            results[request_id] = (response, exception)
+        
+        names = list(requests)
+        for start in range(0, len(names), self.SQL_BATCH_SIZE):
+            try:
+                batch = service.new_batch_http_request(callback=callback)
+                for name in names[start:start + self.SQL_BATCH_SIZE]:
+                    batch.add(requests[name], request_id=name)
+                batch.execute()
+            except Exception as e:
+                self.logger.debug(f"Batch request lỗi ({e}), gửi từng request")
+        
+        for name in names:
+            if name not in results:
+                try:
+                    results[name] = (requests[name].execute(), None)
+                except Exception as e:
+                    results[name] = (None, e)
+        return results
+    
+    def _poll_sql_operations(
+        self,
+        service,
+        project_id: str,
+        operations: Dict[str, str]
+    ) -> Dict[str, object]:
+        """Poll các operation Cloud SQL (một batch request mỗi vòng)"""
+        polled = self._execute_batch(service, {
+            instance_name: service.operations().get(project=project_id, operation=operation_name)
+            for instance_name, operation_name in operations.items()
+        })
+        results = {}
+        for instance_name, (operation, error) in polled.items():
+            if error is not None:
+                results[instance_name] = error
+            elif (operation or {}).get('status') != 'DONE':
+                results[instance_name] = None
+            elif operation.get('error'):
+                results[instance_name] = Exception(
+                    '; '.join(e.get('message', e.get('code', '')) for e in operation['error'].get('errors', []))
+                    or str(operation['error'])
+                )
+            else:
+                results[instance_name] = True
+        return results
 
 
 class AWSUpdater:
     """AWS IP updater"""
     
+    # Số lần thử lại modify_managed_prefix_list khi version đã đổi
+    PREFIX_LIST_RETRIES = 3
+    PREFIX_LIST_CONFLICT_CODES = ('PrefixListVersionMismatch', 'IncorrectState')
+    
     def __init__(self, config: dict, logger: logging.Logger, dry_run: bool = False):
         self.config = config
         self.logger = logger
         self.dry_run = dry_run
+        self._ec2 = None
     
-    def update_security_groups(self, old_ip: Optional[str], new_ip: str) -> bool:
-        """Cập nhật tất cả AWS Security Groups"""
-        if not AWS_AVAILABLE:
+    def update_security_groups(
+        self,
+        old_ip: Optional[str],
+        new_ip: str,
+        state: Optional[StateStore] = None
+    ) -> bool:
+        """Cập nhật tất cả AWS managed prefix lists và Security Groups"""
+        if not _sdk_available('AWS_AVAILABLE'):
             self.logger.warning("⊘ Boto3 (AWS SDK) chưa được cài đặt")
             return False
         
+        prefix_lists_success = self._update_prefix_lists(old_ip, new_ip, state)
+        
+        # Đọc trạng thái hiện tại của mọi security group cần cập nhật bằng
+        # một lệnh describe để chỉ gửi những thay đổi thực sự cần
+        pending_ids = [
+            sg['group_id']
+            for key, group_type in (('security_groups_ssh', 'SSH'), ('security_groups_mysql', 'MySQL'))
+            for sg in self.config.get(key, [])
+            if not (state and state.is_applied(self._target(sg['group_id'], group_type), new_ip))
+        ]
+        existing = self._describe_ingress(pending_ids) if pending_ids else {}
+        
         # Cập nhật SSH và MySQL security groups
         ssh_success = self._update_security_group_type(
             old_ip, new_ip, 
             self.config.get('security_groups_ssh', []),
             self.config.get('ports_ssh', []),
-            "SSH"
+            "SSH",
+            state,
+            existing
         )
         
         mysql_success = self._update_security_group_type(
             old_ip, new_ip,
             self.config.get('security_groups_mysql', []),
             self.config.get('ports_mysql', []),
-            "MySQL"
+            "MySQL",
+            state,
+            existing
         )
         
-        return ssh_success and mysql_success
+        return prefix_lists_success and ssh_success and mysql_success
+    
+    def _target(self, group_id: str, group_type: str) -> str:
+        return f"aws.sg/{self.config.get('region')}/{group_id}/{group_type}"
+    
+    def _update_prefix_lists(
+        self,
+        old_ip: Optional[str],
+        new_ip: str,
+        state: Optional[StateStore] = None
+    ) -> bool:
+        """
+        Cập nhật các managed prefix list (aws.prefix_lists). Security group
+        tham chiếu prefix list không cần sửa: mỗi lần đổi IP chỉ một lệnh
+        modify_managed_prefix_list cho mỗi list.
+        """
+        prefix_lists = self.config.get('prefix_lists', [])
+        if not prefix_lists:
+            return True
+        
+        try:
+            ec2 = self._ec2_client()
+            success_count = 0
+            
+            for prefix_list in prefix_lists:
+                prefix_list_id = prefix_list['prefix_list_id']
+                target = f"aws.pl/{self.config.get('region')}/{prefix_list_id}"
+                if state and state.is_applied(target, new_ip):
+                    self.logger.debug(f"  Prefix list {prefix_list_id} đã ở IP {new_ip}, bỏ qua")
+                    success_count += 1
+                    continue
+                
+                list_old_ip = state.old_ip_for(target, old_ip) if state else old_ip
+                if self._update_single_prefix_list(ec2, prefix_list, list_old_ip, new_ip):
+                    success_count += 1
+                    if state and not self.dry_run:
+                        state.mark_applied(target, new_ip)
+            
+            return success_count == len(prefix_lists)
+            
+        except Exception as e:
+            self.logger.error(f"✗ Lỗi AWS prefix lists: {e}")
+            return False
+    
+    def _update_single_prefix_list(
+        self,
+        ec2,
+        prefix_list: dict,
+        old_ip: Optional[str],
+        new_ip: str
+    ) -> bool:
+        """
+        Thêm IP mới và xóa IP cũ trong một lệnh modify_managed_prefix_list
+        với CurrentVersion vừa đọc; version đổi (người khác vừa sửa) thì đọc
+        lại và thử lại
+        """
+        ClientError = _lazy_import('ClientError')
+        prefix_list_id = prefix_list['prefix_list_id']
+        new_cidr = f"{new_ip}/32"
+        old_cidr = f"{old_ip}/32" if old_ip else None
+        
+        for attempt in range(self.PREFIX_LIST_RETRIES):
+            version, cidrs = self._read_prefix_list(ec2, prefix_list_id)
+            add_entries = [] if new_cidr in cidrs else [
+                {'Cidr': new_cidr, 'Description': prefix_list.get('description', '')}
+            ]
+            remove_entries = [{'Cidr': old_cidr}] if old_cidr != new_cidr and old_cidr in cidrs else []
+            if not add_entries and not remove_entries:
+                self.logger.info(f"✓ AWS prefix list {prefix_list_id} đã đúng, không cần ghi")
+                return True
+            
+            if self.dry_run:
+                self.logger.info(
+                    f"[DRY-RUN] Sẽ cập nhật prefix list {prefix_list_id}: {old_cidr} → {new_cidr}"
+                )
+                return True
+            
+            changes = {}
+            if add_entries:
+                changes['AddEntries'] = add_entries
+            if remove_entries:
+                changes['RemoveEntries'] = remove_entries
+            try:
+                ec2.modify_managed_prefix_list(
+                    PrefixListId=prefix_list_id, CurrentVersion=version, **changes
+                )
+                self.logger.info(f"✓ AWS prefix list {prefix_list_id}: {new_cidr}")
+                return True
+            except ClientError as e:
+                code = e.response.get('Error', {}).get('Code')
+                if code not in self.PREFIX_LIST_CONFLICT_CODES or attempt == self.PREFIX_LIST_RETRIES - 1:
+                    self.logger.error(f"✗ Lỗi cập nhật prefix list {prefix_list_id}: {e}")
+                    return False
+                self.logger.warning(f"⚠ Prefix list {prefix_list_id} vừa bị sửa ({code}), đọc lại")
+                time.sleep(0.5 * 2 ** attempt)
+        return False
+    
+    @staticmethod
+    def _read_prefix_list(ec2, prefix_list_id: str) -> Tuple[int, set]:
+        """Version hiện tại và các CIDR của prefix list ở đúng version đó"""
+        prefix_list = ec2.describe_managed_prefix_lists(PrefixListIds=[prefix_list_id])['PrefixLists'][0]
+        version = prefix_list['Version']
+        cidrs = set()
+        kwargs = {'PrefixListId': prefix_list_id, 'TargetVersion': version}
+        while True:
+            response = ec2.get_managed_prefix_list_entries(**kwargs)
+            cidrs.update(entry['Cidr'] for entry in response.get('Entries', []))
+            if not response.get('NextToken'):
+                return version, cidrs
+            kwargs['NextToken'] = response['NextToken']
+    
+    def _ec2_client(self):
+        """EC2 client, tạo một lần cho mỗi AWSUpdater"""
+        if self._ec2 is None:
+            boto3 = _lazy_import('boto3')
+            self._ec2 = boto3.client('ec2', region_name=self.config.get('region'))
+        return self._ec2
+    
+    def _describe_ingress(self, group_ids: List[str]) -> Dict[str, Dict[tuple, Optional[str]]]:
+        """
+        Các ingress rule hiện có của các security group, đọc bằng một lệnh
+        describe: {group_id: {(protocol, from_port, to_port, cidr): rule_id}}.
+        Chế độ update_mode "modify" dùng describe_security_group_rules để có
+        SecurityGroupRuleId, ngược lại describe_security_groups (rule_id None).
+        Lỗi (ví dụ một group không tồn tại) thì trả về {} và các group được
+        cập nhật không cần đọc trước.
+        """
+        group_ids = sorted(set(group_ids))
+        existing = {group_id: {} for group_id in group_ids}
+        try:
+            ec2 = self._ec2_client()
+            if self.config.get('update_mode') == 'modify':
+                kwargs = {'Filters': [{'Name': 'group-id', 'Values': group_ids}], 'MaxResults': 1000}
+                while True:
+                    response = ec2.describe_security_group_rules(**kwargs)
+                    for rule in response['SecurityGroupRules']:
+                        if rule.get('IsEgress') or not rule.get('CidrIpv4'):
+                            continue
+                        existing.setdefault(rule['GroupId'], {})[(
+                            str(rule.get('IpProtocol', '')).lower(),
+                            rule.get('FromPort'),
+                            rule.get('ToPort'),
+                            rule['CidrIpv4']
+                        )] = rule['SecurityGroupRuleId']
+                    if not response.get('NextToken'):
+                        break
+                    kwargs['NextToken'] = response['NextToken']
+                return existing
+            
+            response = ec2.describe_security_groups(GroupIds=group_ids)
+            existing = {}
+            for group in response['SecurityGroups']:
+                rules = existing.setdefault(group['GroupId'], {})
+                for permission in group.get('IpPermissions', []):
+                    for ip_range in permission.get('IpRanges', []):
+                        rules[(
+                            str(permission.get('IpProtocol', '')).lower(),
+                            permission.get('FromPort'),
+                            permission.get('ToPort'),
+                            ip_range.get('CidrIp')
+                        )] = None
+            return existing
+        except Exception as e:
+            self.logger.debug(f"Không đọc trước được security groups ({e}), cập nhật không so sánh")
+            return {}
+    
+    @staticmethod
+    def _rule_key(port_rule: dict, ip: str) -> tuple:
+        return (str(port_rule['protocol']).lower(), port_rule['port'], port_rule['port'], f"{ip}/32")
     
     def _update_security_group_type(
         self,
@@ -422,7 +2291,9 @@ class AWSUpdater:
         new_ip: str,
         security_groups: List[dict],
         ports: List[dict],
-        group_type: str
+        group_type: str,
+        state: Optional[StateStore] = None,
+        existing: Optional[Dict[str, Dict[tuple, Optional[str]]]] = None
     ) -> bool:
         """Cập nhật một loại security group (SSH/MySQL)"""
         if not security_groups:
@@ -430,12 +2301,24 @@ class AWSUpdater:
             return True
         
         try:
-            ec2 = boto3.client('ec2', region_name=self.config.get('region'))
+            ec2 = self._ec2_client()
             success_count = 0
             
             for sg in security_groups:
-                if self._update_single_security_group(ec2, sg, old_ip, new_ip, ports, group_type):
+                target = self._target(sg['group_id'], group_type)
+                if state and state.is_applied(target, new_ip):
+                    self.logger.debug(f"  Security group {sg['group_id']} đã ở IP {new_ip}, bỏ qua")
+                    success_count += 1
+                    continue
+                
+                sg_old_ip = state.old_ip_for(target, old_ip) if state else old_ip
+                if self._update_single_security_group(
+                    ec2, sg, sg_old_ip, new_ip, ports, group_type,
+                    (existing or {}).get(sg['group_id'])
+                ):
                     success_count += 1
+                    if state and not self.dry_run:
+                        state.mark_applied(target, new_ip)
             
             return success_count == len(security_groups)
             
@@ -450,18 +2333,50 @@ class AWSUpdater:
         old_ip: Optional[str],
         new_ip: str,
         ports: List[dict],
-        group_type: str
+        group_type: str,
+        existing: Optional[Dict[tuple, Optional[str]]] = None
     ) -> bool:
-        """Cập nhật một security group"""
+        """
+        Cập nhật một security group. existing: các rule hiện có (đọc trước
+        bằng _describe_ingress) để chỉ revoke/authorize phần thực sự khác;
+        None thì gửi đủ và dựa vào lỗi Duplicate/NotFound.
+        """
+        ClientError = _lazy_import('ClientError')
         group_id = sg['group_id']
+        revoke_ports = ports if old_ip else []
+        authorize_ports = ports
+        modify_ports = []
+        if existing is not None:
+            revoke_ports = [
+                p for p in revoke_ports if old_ip != new_ip and self._rule_key(p, old_ip) in existing
+            ]
+            authorize_ports = [p for p in ports if self._rule_key(p, new_ip) not in existing]
+            if not revoke_ports and not authorize_ports:
+                self.logger.info(f"✓ AWS Security Group {group_type} {group_id} đã đúng, không cần ghi")
+                return True
+            
+            # Chế độ modify: rule IP cũ được sửa tại chỗ thành IP mới
+            if self.config.get('update_mode') == 'modify':
+                modify_ports = [
+                    p for p in authorize_ports if p in revoke_ports and existing.get(self._rule_key(p, old_ip))
+                ]
+                revoke_ports = [p for p in revoke_ports if p not in modify_ports]
+                authorize_ports = [p for p in authorize_ports if p not in modify_ports]
         
         try:
+            # Sửa tại chỗ (không có khoảng trống truy cập), lỗi thì revoke/authorize
+            if modify_ports and not self._modify_rules(
+                ec2, group_id, old_ip, new_ip, modify_ports, existing, sg.get('description', '')
+            ):
+                revoke_ports = revoke_ports + modify_ports
+                authorize_ports = authorize_ports + modify_ports
+            
             # Xóa rules với IP cũ
-            if old_ip:
-                self._revoke_old_rules(ec2, group_id, old_ip, ports)
+            if revoke_ports:
+                self._revoke_old_rules(ec2, group_id, old_ip, revoke_ports)
             
             # Thêm rules với IP mới
-            self._authorize_new_rules(ec2, group_id, new_ip, ports, sg.get('description', ''))
+            self._authorize_new_rules(ec2, group_id, new_ip, authorize_ports, sg.get('description', ''))
             
             self.logger.info(f"✓ Đã cập nhật AWS Security Group {group_type}: {group_id}")
             return True
@@ -470,27 +2385,76 @@ class AWSUpdater:
             self.logger.error(f"✗ Lỗi khi cập nhật {group_type} {group_id}: {e}")
             return False
     
+    def _modify_rules(
+        self,
+        ec2,
+        group_id: str,
+        old_ip: str,
+        new_ip: str,
+        ports: List[dict],
+        existing: Dict[tuple, Optional[str]],
+        description: str
+    ) -> bool:
+        """
+        Đổi CIDR của các rule IP cũ thành IP mới bằng một lệnh
+        modify_security_group_rules cho cả group
+        Returns: False nếu EC2 từ chối (gọi revoke/authorize thay thế)
+        """
+        ClientError = _lazy_import('ClientError')
+        if self.dry_run:
+            for port_rule in ports:
+                self.logger.info(f"[DRY-RUN] Sẽ đổi rule {old_ip} → {new_ip}::{port_rule['port']}")
+            return True
+        
+        try:
+            ec2.modify_security_group_rules(
+                GroupId=group_id,
+                SecurityGroupRules=[
+                    {
+                        'SecurityGroupRuleId': existing[self._rule_key(port_rule, old_ip)],
+                        'SecurityGroupRule': {
+                            'IpProtocol': port_rule['protocol'],
+                            'FromPort': port_rule['port'],
+                            'ToPort': port_rule['port'],
+                            'CidrIpv4': f"{new_ip}/32",
+                            'Description': f"{port_rule['description']} - {description}"
+                        }
+                    }
+                    for port_rule in ports
+                ]
+            )
+        except ClientError as e:
+            self.logger.warning(f"  Không sửa được rule tại chỗ, dùng revoke/authorize: {e}")
+            return False
+        self.logger.debug(f"  Đã đổi rule các port {', '.join(str(p['port']) for p in ports)} sang {new_ip}")
+        return True
+    
     def _revoke_old_rules(self, ec2, group_id: str, old_ip: str, ports: List[dict]):
-        """Xóa rules với IP cũ"""
-        for port_rule in ports:
-            try:
-                if self.dry_run:
-                    self.logger.info(f"[DRY-RUN] Sẽ xóa rule {old_ip}::{port_rule['port']}")
-                    continue
-                
-                ec2.revoke_security_group_ingress(
-                    GroupId=group_id,
-                    IpPermissions=[{
-                        'IpProtocol': port_rule['protocol'],
-                        'FromPort': port_rule['port'],
-                        'ToPort': port_rule['port'],
-                        'IpRanges': [{'CidrIp': f"{old_ip}/32"}]
-                    }]
-                )
-                self.logger.debug(f"  Đã xóa rule cũ port {port_rule['port']}")
-            except ClientError as e:
-                if 'InvalidPermission.NotFound' not in str(e):
-                    self.logger.warning(f"  Không thể xóa rule cũ: {e}")
+        """Xóa rules với IP cũ (một lệnh revoke cho mọi port)"""
+        ClientError = _lazy_import('ClientError')
+        if self.dry_run:
+            for port_rule in ports:
+                self.logger.info(f"[DRY-RUN] Sẽ xóa rule {old_ip}::{port_rule['port']}")
+            return
+        if not ports:
+            return
+        
+        permissions = [
+            {
+                'IpProtocol': port_rule['protocol'],
+                'FromPort': port_rule['port'],
+                'ToPort': port_rule['port'],
+                'IpRanges': [{'CidrIp': f"{old_ip}/32"}]
+            }
+            for port_rule in ports
+        ]
+        try:
+            self._apply_permissions(
+                ec2.revoke_security_group_ingress, group_id, permissions, 'InvalidPermission.NotFound'
+            )
+            self.logger.debug(f"  Đã xóa rule cũ các port {', '.join(str(p['port']) for p in ports)}")
+        except ClientError as e:
+            self.logger.warning(f"  Không thể xóa rule cũ: {e}")
     
     def _authorize_new_rules(
         self, 
@@ -500,43 +2464,81 @@ class AWSUpdater:
         ports: List[dict],
         description: str
     ):
-        """Thêm rules với IP mới"""
-        for port_rule in ports:
-            try:
-                if self.dry_run:
-                    self.logger.info(f"[DRY-RUN] Sẽ thêm rule {new_ip}::{port_rule['port']}")
-                    continue
-                
-                ec2.authorize_security_group_ingress(
-                    GroupId=group_id,
-                    IpPermissions=[{
-                        'IpProtocol': port_rule['protocol'],
-                        'FromPort': port_rule['port'],
-                        'ToPort': port_rule['port'],
-                        'IpRanges': [{
-                            'CidrIp': f"{new_ip}/32",
-                            'Description': f"{port_rule['description']} - {description}"
-                        }]
-                    }]
-                )
-                self.logger.debug(f"  Đã thêm rule mới port {port_rule['port']}")
-            except ClientError as e:
-                if 'InvalidPermission.Duplicate' in str(e):
-                    self.logger.debug(f"  Rule đã tồn tại cho port {port_rule['port']}")
-                else:
-                    raise
+        """Thêm rules với IP mới (một lệnh authorize cho mọi port)"""
+        if self.dry_run:
+            for port_rule in ports:
+                self.logger.info(f"[DRY-RUN] Sẽ thêm rule {new_ip}::{port_rule['port']}")
+            return
+        if not ports:
+            return
+        
+        permissions = [
+            {
+                'IpProtocol': port_rule['protocol'],
+                'FromPort': port_rule['port'],
+                'ToPort': port_rule['port'],
+                'IpRanges': [{
+                    'CidrIp': f"{new_ip}/32",
+                    'Description': f"{port_rule['description']} - {description}"
+                }]
+            }
+            for port_rule in ports
+        ]
+        self._apply_permissions(
+            ec2.authorize_security_group_ingress, group_id, permissions, 'InvalidPermission.Duplicate'
+        )
+        self.logger.debug(f"  Đã thêm rule mới các port {', '.join(str(p['port']) for p in ports)}")
+    
+    def _apply_permissions(self, call, group_id: str, permissions: List[dict], tolerated: str):
+        """
+        Gửi mọi permission trong một lệnh EC2. EC2 từ chối cả lệnh nếu một
+        permission đã tồn tại (authorize) hoặc không tồn tại (revoke): khi đó
+        chia đôi danh sách để khoanh vùng permission gây lỗi (bỏ qua nó) và
+        gửi lại phần còn lại. Lỗi khác được raise.
+        """
+        ClientError = _lazy_import('ClientError')
+        try:
+            call(GroupId=group_id, IpPermissions=permissions)
+            return
+        except ClientError as e:
+            if tolerated not in str(e):
+                raise
+            if len(permissions) == 1:
+                port = permissions[0]['FromPort']
+                self.logger.debug(f"  Bỏ qua port {port} của {group_id} ({tolerated})")
+                return
+        
+        middle = len(permissions) // 2
+        self._apply_permissions(call, group_id, permissions[:middle], tolerated)
+        self._apply_permissions(call, group_id, permissions[middle:], tolerated)
 
 
 class IPUpdater:
     """Main IP updater orchestrator"""
     
-    def __init__(self, config_path: str, dry_run: bool = False, verbose: bool = False):
+    def __init__(
+        self,
+        config_path: str,
+        dry_run: bool = False,
+        verbose: bool = False,
+        wait_lock: bool = False
+    ):
         self.dry_run = dry_run
+        self.wait_lock = wait_lock
         self.logger = self._setup_logger(verbose)
         self.config = Config(config_path)
-        self.ip_service = IPService(self.config.ip_cache_file, self.logger)
+        self.ip_service = IPService(
+            self.config.ip_cache_file,
+            self.logger,
+            self.config.ip_detection
+        )
         self.gcp_updater = GCPUpdater(self.config.gcp, self.logger, dry_run)
         self.aws_updater = AWSUpdater(self.config.aws, self.logger, dry_run)
+        self._stop_event = threading.Event()
+        self.ip_changed = False
+        # Thời gian từng giai đoạn của lần chạy gần nhất (giây)
+        self.timings: Dict[str, float] = {}
+        self.gcp_updater.timings = self.timings
     
     def _setup_logger(self, verbose: bool) -> logging.Logger:
         """Setup logging configuration"""
@@ -562,11 +2564,52 @@ class IPUpdater:
         
         return logger
     
-    def run(self, force: bool = False) -> int:
+    def run(self, force: bool = False, current_ip: Optional[str] = None) -> int:
         """
         Chạy IP updater
         Returns: 0 nếu thành công, 1 nếu thất bại
         """
+        lock = self._acquire_lock()
+        if lock is None:
+            self.logger.info("⊘ Một lần chạy khác đang cập nhật, bỏ qua lần này")
+            return 0
+        
+        # Nếu đã chờ sau một lần chạy khác, trạng thái được đọc lại trong
+        # check_ip_change nên kết quả của lần chạy đó được dùng lại
+        self.timings.clear()
+        start = time.perf_counter()
+        try:
+            return self._run(force, current_ip)
+        finally:
+            lock.release()
+            self.timings['total'] = time.perf_counter() - start
+            self.logger.info(
+                "⏱ Thời gian: " + ", ".join(f"{phase} {seconds:.2f}s" for phase, seconds in self.timings.items())
+            )
+    
+    def _acquire_lock(self) -> Optional['RunLock']:
+        """Lấy run lock theo cấu hình lock; None nếu một lần chạy khác đang giữ"""
+        lock_config = self.config.lock
+        lock = RunLock(
+            lock_config.get('file', f"{self.config.ip_cache_file}.lock"),
+            self.logger,
+            lock_config.get('stale_after', 3600)
+        )
+        wait = self.wait_lock or lock_config.get('wait', False)
+        if not lock.acquire(wait=wait, timeout=lock_config.get('timeout', 300)):
+            return None
+        return lock
+    
+    def _timed(self, phase: str, func, *args):
+        """Gọi func(*args), ghi thời gian chạy vào timings[phase]"""
+        start = time.perf_counter()
+        try:
+            return func(*args)
+        finally:
+            self.timings[phase] = time.perf_counter() - start
+    
+    def _run(self, force: bool, current_ip: Optional[str]) -> int:
+        """Pipeline phát hiện IP và cập nhật các provider (đã giữ lock)"""
         self.logger.info("=" * 60)
         self.logger.info("IP UPDATER - BẮT ĐẦU")
         if self.dry_run:
@@ -574,7 +2617,8 @@ class IPUpdater:
         self.logger.info("=" * 60)
         
         # Kiểm tra thay đổi IP
-        cached_ip, current_ip, changed = self.ip_service.check_ip_change()
+        cached_ip, current_ip, changed = self._timed('ip', self.ip_service.check_ip_change, current_ip)
+        self.ip_changed = changed
         
         if current_ip is None:
             self.logger.error("✗ Không thể lấy IP công cộng. Dừng.")
@@ -592,18 +2636,32 @@ class IPUpdater:
         # Cập nhật cloud providers
         success = True
         
+        # Chỉ cập nhật những target chưa ở IP mới (lần trước lỗi giữa chừng)
+        state = self.ip_service.state
+        if force:
+            state.forget_applied(current_ip)
+            state.forget_discovered()
+        
         self.logger.info("\n--- Google Cloud Platform ---")
-        gcp_firewall_ok = self.gcp_updater.update_firewall_rules(cached_ip, current_ip)
-        gcp_sql_ok = self.gcp_updater.update_cloud_sql(cached_ip, current_ip)
-        success = success and gcp_firewall_ok and gcp_sql_ok
+        gcp_address_groups_ok = self._timed(
+            'gcp.address_groups', self.gcp_updater.update_address_groups, cached_ip, current_ip, state
+        )
+        gcp_firewall_ok = self._timed(
+            'gcp.firewall', self.gcp_updater.update_firewall_rules, cached_ip, current_ip, state
+        )
+        gcp_sql_ok = self._timed('gcp.sql', self.gcp_updater.update_cloud_sql, cached_ip, current_ip, state)
+        success = success and gcp_address_groups_ok and gcp_firewall_ok and gcp_sql_ok
         
         self.logger.info("\n--- Amazon Web Services ---")
-        aws_ok = self.aws_updater.update_security_groups(cached_ip, current_ip)
+        aws_ok = self._timed('aws', self.aws_updater.update_security_groups, cached_ip, current_ip, state)
         success = success and aws_ok
         
-        # Lưu IP mới
-        if not self.dry_run and success:
-            self.ip_service.save_ip(current_ip)
+        # Lưu IP mới (hoặc tiến độ từng target nếu còn lỗi)
+        if not self.dry_run:
+            if success:
+                self.ip_service.save_ip(current_ip)
+            else:
+                state.save()
         
         self.logger.info("\n" + "=" * 60)
         if success:
@@ -613,6 +2671,128 @@ class IPUpdater:
         self.logger.info("=" * 60)
         
         return 0 if success else 1
+    
+    def migrate_address_groups(self) -> int:
+        """
+        Chuyển đổi một lần sang address group: đưa IP hiện tại vào các address
+        group rồi thay CIDR của IP đã áp dụng trong các rule firewall policy
+        bằng tham chiếu tới group
+        Returns: 0 nếu thành công, 1 nếu thất bại
+        """
+        # Cùng lock với run(): không ghi đồng thời với một lần chạy cron
+        lock = self._acquire_lock()
+        if lock is None:
+            self.logger.error("✗ Một lần chạy khác đang cập nhật, thử lại sau")
+            return 1
+        
+        state = self.ip_service.state
+        try:
+            cached_ip = self.ip_service.get_cached_ip()
+            current_ip = self.ip_service.get_current_ip()
+            if current_ip is None:
+                self.logger.error("✗ Không thể lấy IP công cộng. Dừng.")
+                return 1
+            
+            if not self.gcp_updater.update_address_groups(cached_ip, current_ip, state):
+                self.logger.error("✗ Không cập nhật được address groups, chưa chuyển đổi rule")
+                return 1
+            ok = self.gcp_updater.migrate_to_address_groups(cached_ip or current_ip)
+            if ok:
+                self.logger.info("✓ Đã chuyển các rule firewall policy sang address group")
+            return 0 if ok else 1
+        finally:
+            if not self.dry_run:
+                state.save()
+            lock.release()
+    
+    def stop(self):
+        """Yêu cầu dừng chế độ daemon/watch (ví dụ khi nhận SIGTERM)"""
+        self._stop_event.set()
+    
+    def daemon(
+        self,
+        min_interval: float = 30,
+        max_interval: float = 900,
+        backoff_factor: float = 2.0
+    ) -> int:
+        """
+        Chế độ daemon: giữ process (SDK clients, HTTP session) luôn sẵn sàng
+        và kiểm tra IP theo lịch thích ứng: quay về min_interval ngay sau khi
+        IP đổi hoặc cập nhật lỗi, giãn dần theo backoff_factor khi IP ổn định
+        (tối đa max_interval)
+        """
+        self.logger.info(
+            f"🔁 Chế độ daemon: kiểm tra mỗi {min_interval}s → {max_interval}s"
+        )
+        interval = min_interval
+        exit_code = 0
+        
+        while not self._stop_event.is_set():
+            try:
+                exit_code = self.run()
+            except Exception as e:
+                self.logger.error(f"✗ Lỗi trong lần chạy daemon: {e}")
+                exit_code = 1
+            
+            if exit_code != 0 or self.ip_changed:
+                interval = min_interval
+            else:
+                interval = min(interval * backoff_factor, max_interval)
+            
+            self.logger.debug(f"Lần kiểm tra tiếp theo sau {interval:.0f}s")
+            self._stop_event.wait(interval)
+        
+        self.logger.info("Dừng chế độ daemon")
+        self.ip_service.close()
+        return exit_code
+    
+    def watch(self, interface: str, poll_interval: float = 300) -> int:
+        """
+        Chế độ watch: chạy pipeline mỗi khi địa chỉ IPv4 trên interface thay đổi
+        (sự kiện rtnetlink). Nếu interface chỉ có IP private/NAT thì quay về
+        hỏi IPService mỗi poll_interval giây. Lần chạy lỗi được thử lại với
+        khoảng chờ tăng dần (tối đa poll_interval) thay vì chờ sự kiện tiếp theo.
+        """
+        try:
+            watcher = NetlinkWatcher(interface, self.logger)
+        except (OSError, RuntimeError) as e:
+            self.logger.error(f"✗ Không thể theo dõi interface {interface}: {e}")
+            return 1
+        
+        self.logger.info(f"👀 Theo dõi thay đổi địa chỉ trên {interface}")
+        # Địa chỉ đã cập nhật thành công lần gần nhất
+        last_address = None
+        retry_delay = None
+        exit_code = 0
+        
+        try:
+            while not self._stop_event.is_set():
+                address = watcher.public_address()
+                if address is None:
+                    self.logger.debug(
+                        f"{interface} không có IP công cộng, hỏi IPService (polling {poll_interval}s)"
+                    )
+                    exit_code = self.run()
+                    last_address = None
+                    timeout = poll_interval
+                else:
+                    if exit_code != 0 or address != last_address:
+                        exit_code = self.run(current_ip=address)
+                    if exit_code == 0:
+                        last_address = address
+                        retry_delay = None
+                        timeout = None
+                    else:
+                        retry_delay = min(retry_delay * 2 if retry_delay else 30, poll_interval)
+                        timeout = retry_delay
+                        self.logger.warning(f"⚠ Cập nhật lỗi, thử lại sau {retry_delay:.0f}s")
+                watcher.wait_for_change(timeout, self._stop_event)
+        except KeyboardInterrupt:
+            self.logger.info("Dừng chế độ watch")
+        finally:
+            watcher.close()
+        
+        return exit_code
 
 
 def main():
@@ -627,6 +2807,9 @@ Examples:
   %(prog)s --dry-run                # Chạy thử không thay đổi thật
   %(prog)s --force                  # Buộc cập nhật kể cả IP không đổi
   %(prog)s --verbose                # Hiển thị log chi tiết
+  %(prog)s --daemon                 # Chạy liên tục với chu kỳ thích ứng
+  %(prog)s --watch ppp0             # Cập nhật ngay khi IP trên ppp0 thay đổi
+  %(prog)s --migrate-address-groups # Chuyển rule firewall policy sang address group
         """
     )
     
@@ -650,6 +2833,26 @@ Examples:
         action='store_true',
         help='Hiển thị log chi tiết (DEBUG level)'
     )
+    parser.add_argument(
+        '--wait-lock',
+        action='store_true',
+        help='Nếu một lần chạy khác đang giữ lock thì chờ nó xong thay vì thoát ngay'
+    )
+    parser.add_argument(
+        '--daemon',
+        action='store_true',
+        help='Chạy liên tục, kiểm tra IP theo chu kỳ thích ứng (dừng bằng SIGTERM)'
+    )
+    parser.add_argument(
+        '--watch',
+        metavar='INTERFACE',
+        help='Theo dõi thay đổi địa chỉ trên interface qua rtnetlink thay vì chạy một lần (Linux)'
+    )
+    parser.add_argument(
+        '--migrate-address-groups',
+        action='store_true',
+        help='Chuyển đổi một lần: thay IP trong các rule firewall policy bằng tham chiếu address group'
+    )
     parser.add_argument(
         '--version',
         action='version',
@@ -662,8 +2865,25 @@ Examples:
         updater = IPUpdater(
             config_path=args.config,
             dry_run=args.dry_run,
-            verbose=args.verbose
+            verbose=args.verbose,
+            wait_lock=args.wait_lock
         )
+        if args.migrate_address_groups:
+            sys.exit(updater.migrate_address_groups())
+        if args.daemon or args.watch:
+            signal.signal(signal.SIGTERM, lambda signum, frame: updater.stop())
+        if args.daemon:
+            daemon_config = updater.config.daemon
+            sys.exit(updater.daemon(
+                daemon_config.get('min_interval', 30),
+                daemon_config.get('max_interval', 900),
+                daemon_config.get('backoff_factor', 2.0)
+            ))
+        if args.watch:
+            sys.exit(updater.watch(
+                args.watch,
+                updater.config.watch.get('poll_interval', 300)
+            ))
         sys.exit(updater.run(force=args.force))
     except Exception as e:
         logging.error(f"Lỗi nghiêm trọng: {e}")
@@ -0,0 +1,135 @@
+#!/usr/bin/env python3
+"""
+Benchmark: pooled HTTP session của IPService vs requests.get mới mỗi lần
+
+Dựng một HTTPS server giả lập "what's my IP" trên 127.0.0.1 (cert tự ký
+bằng openssl), rồi đo độ trễ trung bình và số kết nối TCP/TLS server nhận
+được cho hai cách gọi.
+
+Chạy:
+    python3 benchmarks/bench_ip_session.py [--requests 200]
+"""
+
+import argparse
+import logging
+import os
+import shutil
+import ssl
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+
+import requests
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import auto_update_ip as mod  # noqa: E402
+
+
+class _IPHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    disable_nagle_algorithm = True
+    
+    def do_GET(self):
+        body = b"203.0.113.7"
+        self.send_response(200)
+        self.send_header('Content-Type', 'text/plain')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+    
+    def log_message(self, format, *args):
+        pass
+
+
+class _CountingServer(ThreadingHTTPServer):
+    daemon_threads = True
+    
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.connections = 0
+    
+    def get_request(self):
+        request = super().get_request()
+        self.connections += 1
+        return request
+
+
+def _make_cert(directory: str):
+    """Tạo cert tự ký cho localhost"""
+    cert = os.path.join(directory, 'cert.pem')
+    key = os.path.join(directory, 'key.pem')
+    subprocess.run(
+        [
+            'openssl', 'req', '-x509', '-newkey', 'rsa:2048', '-nodes',
+            '-keyout', key, '-out', cert, '-days', '1', '-subj', '/CN=localhost',
+            '-addext', 'subjectAltName=DNS:localhost,IP:127.0.0.1'
+        ],
+        check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL
+    )
+    return cert, key
+
+
+def _start_server(cert: str, key: str) -> _CountingServer:
+    server = _CountingServer(('127.0.0.1', 0), _IPHandler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(cert, key)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def _measure(server: _CountingServer, fetch, count: int):
+    server.connections = 0
+    start = time.perf_counter()
+    for _ in range(count):
+        if fetch() is None:
+            raise RuntimeError("Server giả lập không trả về IP")
+    elapsed = time.perf_counter() - start
+    return elapsed / count * 1000, server.connections
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--requests', type=int, default=200, help='Số request mỗi kịch bản')
+    args = parser.parse_args()
+    
+    if not shutil.which('openssl'):
+        sys.exit("Cần openssl để tạo cert tự ký cho server giả lập")
+    
+    with tempfile.TemporaryDirectory() as tmp:
+        cert, key = _make_cert(tmp)
+        server = _start_server(cert, key)
+        url = f"https://localhost:{server.server_address[1]}/"
+        
+        logger = logging.getLogger('bench')
+        logger.addHandler(logging.NullHandler())
+        service = mod.IPService(os.path.join(tmp, 'cache.txt'), logger, {'services': [url]})
+        service.session.verify = cert
+        # Không để REQUESTS_CA_BUNDLE trong môi trường ghi đè cert tự ký
+        service.session.trust_env = False
+        
+        def fresh_get():
+            with requests.Session() as session:
+                session.trust_env = False
+                return session.get(url, timeout=5, verify=cert).text
+        
+        fresh_ms, fresh_conns = _measure(server, fresh_get, args.requests)
+        pooled_ms, pooled_conns = _measure(
+            server, service._get_ip_sequential, args.requests
+        )
+        
+        service.close()
+        server.shutdown()
+    
+    print(f"{'Kịch bản':<28}{'ms/request':>12}{'kết nối TLS':>14}")
+    print(f"{'Session mới mỗi lần':<28}{fresh_ms:>12.2f}{fresh_conns:>14}")
+    print(f"{'IPService.session (pool)':<28}{pooled_ms:>12.2f}{pooled_conns:>14}")
+    print(f"Tăng tốc: {fresh_ms / pooled_ms:.1f}x")
+
+
+if __name__ == '__main__':
+    main()
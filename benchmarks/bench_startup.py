@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+"""
+Benchmark: thời gian khởi động (import) của auto_update_ip
+
+Dùng `python -X importtime` để đo thời gian import cumulative của module và
+kiểm tra không có SDK provider nào (google-cloud, googleapiclient, boto3)
+bị import ở thời điểm load. So sánh với chi phí import các SDK đó nếu
+chúng được import ngay từ đầu.
+
+Chạy:
+    python3 benchmarks/bench_startup.py [--runs 5] [--budget-ms 300]
+
+Exit code 1 nếu có SDK bị import khi load module hoặc vượt budget.
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+ROOT = Path(__file__).resolve().parent.parent
+
+SDK_PREFIXES = ('google.cloud', 'google.oauth2', 'googleapiclient', 'boto3', 'botocore')
+SDK_IMPORTS = "import boto3, google.cloud.compute_v1, google.oauth2.service_account, googleapiclient.discovery"
+
+
+def _importtime(code: str) -> dict:
+    """Chạy code với -X importtime, trả về {module: cumulative_us}"""
+    result = subprocess.run(
+        [sys.executable, '-X', 'importtime', '-c', code],
+        cwd=str(ROOT), capture_output=True, text=True, check=True
+    )
+    timings = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith('import time:') or '|' not in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        if cumulative.strip().isdigit():
+            timings[name.strip()] = int(cumulative)
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--runs', type=int, default=5, help='Số lần đo (lấy median)')
+    parser.add_argument('--budget-ms', type=float, default=None,
+                        help='Ngưỡng thời gian import tối đa của auto_update_ip (ms)')
+    args = parser.parse_args()
+    
+    samples = []
+    timings = {}
+    for _ in range(args.runs):
+        timings = _importtime("import auto_update_ip")
+        samples.append(timings['auto_update_ip'] / 1000)
+    startup_ms = statistics.median(samples)
+    
+    leaked = sorted(name for name in timings if name.startswith(SDK_PREFIXES))
+    heaviest = sorted(timings.items(), key=lambda item: item[1], reverse=True)[:10]
+    
+    print(f"import auto_update_ip: {startup_ms:.1f} ms (median {args.runs} lần)")
+    print("Các import nặng nhất (cumulative):")
+    for name, cumulative in heaviest:
+        print(f"  {cumulative / 1000:>8.1f} ms  {name}")
+    
+    try:
+        sdk_timings = _importtime(SDK_IMPORTS)
+        sdk_ms = sum(
+            cumulative for name, cumulative in sdk_timings.items()
+            if name in ('boto3', 'google.cloud.compute_v1',
+                        'google.oauth2.service_account', 'googleapiclient.discovery')
+        ) / 1000
+        print(f"Tham chiếu - import SDK ngay từ đầu: ~{sdk_ms:.1f} ms")
+    except subprocess.CalledProcessError:
+        print("Tham chiếu - SDK chưa được cài đặt đầy đủ, bỏ qua")
+    
+    failed = False
+    if leaked:
+        print(f"✗ SDK bị import khi load module: {', '.join(leaked)}")
+        failed = True
+    if args.budget_ms is not None and startup_ms > args.budget_ms:
+        print(f"✗ Vượt budget {args.budget_ms} ms")
+        failed = True
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
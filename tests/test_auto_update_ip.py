@@ -9,6 +9,7 @@ import pytest
 from unittest.mock import Mock, patch, MagicMock, call, mock_open
 from pathlib import Path
 import json
+import re
 from datetime import datetime
 
 # Import module
@@ -19,6 +20,20 @@ import auto_update_ip as mod
 # FIXTURES
 # ============================================================================
 
+@pytest.fixture(autouse=True)
+def _clear_client_cache():
+    """SDK clients are cached per process; every test starts without them"""
+    mod._CLIENT_CACHE.clear()
+    yield
+    mod._CLIENT_CACHE.clear()
+
+
+@pytest.fixture(autouse=True)
+def _isolated_cwd(tmp_path, monkeypatch):
+    """IPUpdater writes ip_update.log and lock files to cwd; keep them out of the repo"""
+    monkeypatch.chdir(tmp_path)
+
+
 @pytest.fixture
 def mock_config():
     """Complete mock configuration for all tests"""
@@ -55,6 +70,41 @@ def logger():
     return logger
 
 
+@pytest.fixture
+def udp_stub():
+    """Start a local UDP server answering each datagram with handler(data)"""
+    import socket
+    import threading
+    
+    servers = []
+    
+    def start(handler):
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        sock.bind(("127.0.0.1", 0))
+        sock.settimeout(0.2)
+        stop = threading.Event()
+        
+        def serve():
+            while not stop.is_set():
+                try:
+                    data, addr = sock.recvfrom(2048)
+                except socket.timeout:
+                    continue
+                sock.sendto(handler(data), addr)
+        
+        thread = threading.Thread(target=serve, daemon=True)
+        thread.start()
+        servers.append((sock, stop, thread))
+        return sock.getsockname()[1]
+    
+    yield start
+    
+    for sock, stop, thread in servers:
+        stop.set()
+        thread.join()
+        sock.close()
+
+
 @pytest.fixture
 def temp_config_file(tmp_path, mock_config):
     """Create temporary config file"""
@@ -204,7 +254,7 @@ class TestIPService:
     
     def test_get_current_ip_success(self, logger, tmp_path):
         """Test successful IP detection"""
-        with patch('requests.get') as mock_get:
+        with patch('requests.Session.get') as mock_get:
             mock_response = Mock()
             mock_response.status_code = 200
             mock_response.text = "192.168.1.100\n"
@@ -218,7 +268,7 @@ class TestIPService:
     
     def test_get_current_ip_all_services_fail(self, logger, tmp_path):
         """Test all services fail"""
-        with patch('requests.get', side_effect=Exception("Network error")):
+        with patch('requests.Session.get', side_effect=Exception("Network error")):
             service = mod.IPService(str(tmp_path / "cache.txt"), logger)
             ip = service.get_current_ip()
             
@@ -231,7 +281,7 @@ class TestIPService:
             Mock(status_code=200, text="10.0.0.1")
         ]
         
-        with patch('requests.get', side_effect=responses):
+        with patch('requests.Session.get', side_effect=responses):
             service = mod.IPService(str(tmp_path / "cache.txt"), logger)
             ip = service.get_current_ip()
             
@@ -271,7 +321,7 @@ class TestIPService:
         cache_file = tmp_path / "cache.txt"
         cache_file.write_text("1.2.3.4")
         
-        with patch('requests.get') as mock_get:
+        with patch('requests.Session.get') as mock_get:
             mock_get.return_value = Mock(status_code=200, text="1.2.3.4")
             
             service = mod.IPService(str(cache_file), logger)
@@ -286,7 +336,7 @@ class TestIPService:
         cache_file = tmp_path / "cache.txt"
         cache_file.write_text("1.2.3.4")
         
-        with patch('requests.get') as mock_get:
+        with patch('requests.Session.get') as mock_get:
             mock_get.return_value = Mock(status_code=200, text="5.6.7.8")
             
             service = mod.IPService(str(cache_file), logger)
@@ -298,7 +348,7 @@ class TestIPService:
     
     def test_check_ip_change_no_cached_ip(self, logger, tmp_path):
         """Test first run with no cached IP"""
-        with patch('requests.get') as mock_get:
+        with patch('requests.Session.get') as mock_get:
             mock_get.return_value = Mock(status_code=200, text="1.1.1.1")
             
             service = mod.IPService(str(tmp_path / "cache.txt"), logger)
@@ -313,13 +363,658 @@ class TestIPService:
         cache_file = tmp_path / "cache.txt"
         cache_file.write_text("1.2.3.4")
         
-        with patch('requests.get', side_effect=Exception("Network error")):
+        with patch('requests.Session.get', side_effect=Exception("Network error")):
             service = mod.IPService(str(cache_file), logger)
             cached, current, changed = service.check_ip_change()
             
             assert cached == "1.2.3.4"
             assert current is None
             assert changed is False
+    
+    def test_invalid_detection_mode(self, logger, tmp_path):
+        """Test unknown ip_detection.mode is rejected"""
+        with pytest.raises(ValueError, match="ip_detection.mode"):
+            mod.IPService(str(tmp_path / "cache.txt"), logger, {"mode": "bogus"})
+    
+    def test_race_mode_returns_fastest_valid_answer(self, logger, tmp_path):
+        """Test race mode returns first valid answer and ignores slow services"""
+        import threading
+        release = threading.Event()
+        
+        def fake_get(url, timeout):
+            if url == mod.IPService.IP_SERVICES[0]:
+                release.wait(2)
+                return Mock(status_code=200, text="9.9.9.9")
+            if url == mod.IPService.IP_SERVICES[1]:
+                raise Exception("Connection refused")
+            return Mock(status_code=200, text="10.0.0.1\n")
+        
+        with patch('requests.Session.get', side_effect=fake_get):
+            service = mod.IPService(str(tmp_path / "cache.txt"), logger, {"mode": "race"})
+            ip = service.get_current_ip()
+            release.set()
+        
+        assert ip == "10.0.0.1"
+    
+    def test_race_mode_all_services_fail(self, logger, tmp_path):
+        """Test race mode returns None when every service fails"""
+        with patch('requests.Session.get', return_value=Mock(status_code=503, text="")):
+            service = mod.IPService(str(tmp_path / "cache.txt"), logger, {"mode": "race"})
+            assert service.get_current_ip() is None
+    
+    def test_race_mode_hedge_delay_skips_late_services(self, logger, tmp_path):
+        """Test hedged race does not send later requests when first answers in time"""
+        with patch('requests.Session.get', return_value=Mock(status_code=200, text="1.1.1.1")) as mock_get:
+            service = mod.IPService(
+                str(tmp_path / "cache.txt"), logger, {"mode": "race", "hedge_delay": 1.0}
+            )
+            ip = service.get_current_ip()
+        
+        assert ip == "1.1.1.1"
+        assert mock_get.call_count == 1
+    
+    @pytest.mark.parametrize("options", [{"mode": "race"}, {"mode": "quorum", "quorum": 2}])
+    def test_straggler_does_not_delay_process_exit(self, options, tmp_path):
+        """Test a hung service does not keep the process alive after the answer is known"""
+        import subprocess
+        import time
+        code = f"""
+import logging, time
+from unittest.mock import Mock, patch
+import auto_update_ip as mod
+
+def fake_get(self, url, timeout):
+    if url == mod.IPService.IP_SERVICES[0]:
+        time.sleep(8)
+    return Mock(status_code=200, text="1.1.1.1")
+
+with patch('requests.Session.get', fake_get):
+    service = mod.IPService('cache.txt', logging.getLogger('test'), {options!r})
+    assert service.get_current_ip() == "1.1.1.1"
+"""
+        start = time.monotonic()
+        subprocess.run(
+            [sys.executable, '-c', code],
+            cwd=str(tmp_path),
+            env=dict(os.environ, PYTHONPATH=str(Path(mod.__file__).parent)),
+            check=True
+        )
+        assert time.monotonic() - start < 5
+    
+    def test_rejects_non_ip_response(self, logger, tmp_path):
+        """Test captive portal HTML is not accepted as an IP"""
+        responses = [
+            Mock(status_code=200, text="<html>Login required</html>"),
+            Mock(status_code=200, text="10.0.0.2\n")
+        ]
+        
+        with patch('requests.Session.get', side_effect=responses):
+            service = mod.IPService(str(tmp_path / "cache.txt"), logger)
+            ip = service.get_current_ip()
+        
+        assert ip == "10.0.0.2"
+    
+    def test_quorum_mode_accepts_agreed_ip(self, logger, tmp_path):
+        """Test quorum mode accepts IP when k services agree"""
+        answers = {
+            mod.IPService.IP_SERVICES[0]: "5.6.7.8",
+            mod.IPService.IP_SERVICES[1]: "10.10.10.10",
+            mod.IPService.IP_SERVICES[2]: "5.6.7.8",
+        }
+        
+        def fake_get(url, timeout):
+            return Mock(status_code=200, text=answers[url])
+        
+        with patch('requests.Session.get', side_effect=fake_get):
+            service = mod.IPService(
+                str(tmp_path / "cache.txt"), logger, {"mode": "quorum", "quorum": 2}
+            )
+            assert service.get_current_ip() == "5.6.7.8"
+    
+    def test_quorum_mode_disagreement_returns_none(self, logger, tmp_path):
+        """Test quorum mode refuses to pick an IP when services disagree"""
+        answers = {
+            mod.IPService.IP_SERVICES[0]: "5.6.7.8",
+            mod.IPService.IP_SERVICES[1]: "10.10.10.10",
+            mod.IPService.IP_SERVICES[2]: "<html>portal</html>",
+        }
+        
+        def fake_get(url, timeout):
+            return Mock(status_code=200, text=answers[url])
+        
+        with patch('requests.Session.get', side_effect=fake_get):
+            service = mod.IPService(str(tmp_path / "cache.txt"), logger, {"mode": "quorum"})
+            assert service.get_current_ip() is None
+    
+    def test_session_is_reused_across_detections(self, logger, tmp_path):
+        """Test one pooled session serves every detection in the process"""
+        with patch('requests.Session.get', return_value=Mock(status_code=200, text="1.1.1.1")):
+            service = mod.IPService(str(tmp_path / "cache.txt"), logger)
+            session = service.session
+            service.get_current_ip()
+            service.get_current_ip()
+        
+        assert service.session is session
+    
+    def test_session_pool_options(self, logger, tmp_path):
+        """Test pool size options are applied to the HTTPS adapter"""
+        service = mod.IPService(
+            str(tmp_path / "cache.txt"), logger,
+            {"pool_connections": 4, "pool_maxsize": 1, "pool_block": True}
+        )
+        adapter = service.session.get_adapter("https://api.ipify.org")
+        
+        assert adapter._pool_connections == 4
+        assert adapter._pool_maxsize == 1
+        assert adapter._pool_block is True
+        service.close()
+    
+    def test_unsupported_service_scheme(self, logger, tmp_path):
+        """Test unknown detector scheme is rejected"""
+        with pytest.raises(ValueError, match="ip_detection.services"):
+            mod.IPService(str(tmp_path / "cache.txt"), logger, {"services": ["ftp://example.com"]})
+    
+    @staticmethod
+    def _dns_reply(query, rtype, rdata):
+        """Build a DNS response echoing the question with one answer record"""
+        import struct
+        header = query[:2] + struct.pack('!HHHHH', 0x8180, 1, 1, 0, 0)
+        question = query[12:]
+        answer = b'\xc0\x0c' + struct.pack('!HHIH', rtype, 1, 60, len(rdata)) + rdata
+        return header + question + answer
+    
+    def test_dns_a_record_detector(self, logger, tmp_path, udp_stub):
+        """Test myip lookup via DNS A record against a local stub resolver"""
+        import socket
+        port = udp_stub(lambda q: self._dns_reply(q, 1, socket.inet_aton("198.51.100.4")))
+        
+        service = mod.IPService(
+            str(tmp_path / "cache.txt"), logger,
+            {"services": [f"dns://127.0.0.1:{port}/myip.opendns.com?type=A"]}
+        )
+        
+        assert service.get_current_ip() == "198.51.100.4"
+    
+    def test_dns_txt_record_detector(self, logger, tmp_path, udp_stub):
+        """Test myip lookup via DNS TXT record (o-o.myaddr style)"""
+        txt = b"203.0.113.9"
+        port = udp_stub(lambda q: self._dns_reply(q, 16, bytes([len(txt)]) + txt))
+        
+        service = mod.IPService(
+            str(tmp_path / "cache.txt"), logger,
+            {"services": [f"dns://127.0.0.1:{port}/o-o.myaddr.l.google.com?type=TXT"]}
+        )
+        
+        assert service.get_current_ip() == "203.0.113.9"
+    
+    @pytest.mark.parametrize("qtype", ["AAAA", "MX"])
+    def test_dns_unsupported_type_rejected(self, logger, tmp_path, qtype):
+        """Test DNS detectors with a non-IPv4 record type fail at construction"""
+        with pytest.raises(ValueError, match=f"type={qtype}"):
+            mod.IPService(
+                str(tmp_path / "cache.txt"), logger,
+                {"services": [f"dns://127.0.0.1/myip.opendns.com?type={qtype.lower()}"]}
+            )
+    
+    def test_ipv6_answer_rejected(self, logger, tmp_path):
+        """Test IPv6 answers are skipped since every target writes IP/32"""
+        responses = [
+            Mock(status_code=200, text="2001:db8::1\n"),
+            Mock(status_code=200, text="10.0.0.2\n")
+        ]
+        
+        with patch('requests.Session.get', side_effect=responses):
+            service = mod.IPService(str(tmp_path / "cache.txt"), logger)
+            assert service.get_current_ip() == "10.0.0.2"
+    
+    def test_dns_nxdomain(self, logger, tmp_path, udp_stub):
+        """Test DNS error rcode yields no IP"""
+        import struct
+        port = udp_stub(lambda q: q[:2] + struct.pack('!HHHHH', 0x8183, 1, 0, 0, 0) + q[12:])
+        
+        service = mod.IPService(
+            str(tmp_path / "cache.txt"), logger,
+            {"services": [f"dns://127.0.0.1:{port}/myip.example"]}
+        )
+        
+        assert service.get_current_ip() is None
+    
+    @staticmethod
+    def _stun_reply(request, ip):
+        """Build a STUN Binding success response with XOR-MAPPED-ADDRESS"""
+        import socket
+        import struct
+        cookie = 0x2112A442
+        addr = struct.unpack('!I', socket.inet_aton(ip))[0] ^ cookie
+        attr = struct.pack('!HHBBHI', 0x0020, 8, 0, 0x01, 54321 ^ (cookie >> 16), addr)
+        return struct.pack('!HHI', 0x0101, len(attr), cookie) + request[8:20] + attr
+    
+    def test_stun_detector(self, logger, tmp_path, udp_stub):
+        """Test STUN binding request against a local stub"""
+        port = udp_stub(lambda req: self._stun_reply(req, "192.0.2.77"))
+        
+        service = mod.IPService(
+            str(tmp_path / "cache.txt"), logger,
+            {"services": [f"stun://127.0.0.1:{port}"]}
+        )
+        
+        assert service.get_current_ip() == "192.0.2.77"
+    
+    def test_stun_ipv6_mapping_ignored(self, logger, tmp_path, udp_stub):
+        """Test an IPv6 XOR-MAPPED-ADDRESS yields no IP"""
+        import struct
+        
+        def reply(request):
+            attr = struct.pack('!HHBBH', 0x0020, 20, 0, 0x02, 0) + bytes(16)
+            return struct.pack('!HHI', 0x0101, len(attr), 0x2112A442) + request[8:20] + attr
+        
+        port = udp_stub(reply)
+        service = mod.IPService(
+            str(tmp_path / "cache.txt"), logger,
+            {"services": [f"stun://127.0.0.1:{port}"]}
+        )
+        
+        assert service.get_current_ip() is None
+    
+    def test_mixed_backends_quorum(self, logger, tmp_path, udp_stub):
+        """Test DNS, STUN and HTTP backends can be mixed in one quorum"""
+        import socket
+        dns_port = udp_stub(lambda q: self._dns_reply(q, 1, socket.inet_aton("192.0.2.77")))
+        stun_port = udp_stub(lambda req: self._stun_reply(req, "192.0.2.77"))
+        
+        with patch('requests.Session.get', return_value=Mock(status_code=200, text="10.9.9.9")):
+            service = mod.IPService(
+                str(tmp_path / "cache.txt"), logger,
+                {
+                    "mode": "quorum",
+                    "quorum": 2,
+                    "services": [
+                        "https://api.ipify.org",
+                        f"dns://127.0.0.1:{dns_port}/myip.opendns.com",
+                        f"stun://127.0.0.1:{stun_port}",
+                    ]
+                }
+            )
+            assert service.get_current_ip() == "192.0.2.77"
+    
+    def test_quorum_out_of_range(self, logger, tmp_path):
+        """Test quorum larger than number of services is rejected"""
+        with pytest.raises(ValueError, match="quorum"):
+            mod.IPService(str(tmp_path / "cache.txt"), logger, {"mode": "quorum", "quorum": 10})
+
+
+# ============================================================================
+# STATE STORE TESTS
+# ============================================================================
+
+class TestStateStore:
+    """Test structured per-target state store"""
+    
+    def test_reads_legacy_plain_text_cache(self, logger, tmp_path):
+        """Test old last_known_ip.txt format is read as the last applied IP"""
+        cache_file = tmp_path / "last_known_ip.txt"
+        cache_file.write_text("1.2.3.4\n")
+        
+        store = mod.StateStore(str(cache_file), logger)
+        store.load()
+        
+        assert store.ip == "1.2.3.4"
+        assert store.applied_ip("gcp.firewall/p/rule") is None
+        assert store.old_ip_for("gcp.firewall/p/rule", "1.2.3.4") == "1.2.3.4"
+    
+    def test_save_writes_json_atomically(self, logger, tmp_path):
+        """Test state is written as JSON with per-target timestamps and no temp leftovers"""
+        cache_file = tmp_path / "state.json"
+        store = mod.StateStore(str(cache_file), logger)
+        store.mark_applied("aws.sg/us-east-1/sg-1/SSH", "5.6.7.8")
+        store.ip = "5.6.7.8"
+        store.save()
+        
+        data = json.loads(cache_file.read_text())
+        assert data["ip"] == "5.6.7.8"
+        assert data["targets"]["aws.sg/us-east-1/sg-1/SSH"]["ip"] == "5.6.7.8"
+        assert "applied_at" in data["targets"]["aws.sg/us-east-1/sg-1/SSH"]
+        assert [p.name for p in tmp_path.iterdir()] == ["state.json"]
+        
+        reloaded = mod.StateStore(str(cache_file), logger)
+        reloaded.load()
+        assert reloaded.is_applied("aws.sg/us-east-1/sg-1/SSH", "5.6.7.8")
+    
+    def test_save_skips_when_unchanged(self, logger, tmp_path):
+        """Test save is a no-op when nothing was marked"""
+        cache_file = tmp_path / "state.json"
+        mod.StateStore(str(cache_file), logger).save()
+        
+        assert not cache_file.exists()
+    
+    def test_forget_applied(self, logger, tmp_path):
+        """Test forget_applied drops only targets at the given IP"""
+        store = mod.StateStore(str(tmp_path / "state.json"), logger)
+        store.mark_applied("a", "5.6.7.8")
+        store.mark_applied("b", "1.2.3.4")
+        
+        store.forget_applied("5.6.7.8")
+        
+        assert store.applied_ip("a") is None
+        assert store.applied_ip("b") == "1.2.3.4"
+    
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_firewall_reconciles_only_pending_rules(self, mock_client_class, mock_config, logger, tmp_path):
+        """Test rules already at the new IP are skipped and others use their own old IP"""
+        store = mod.StateStore(str(tmp_path / "state.json"), logger)
+        store.mark_applied("gcp.firewall/test-project/test-firewall-1", "5.6.7.8")
+        store.mark_applied("gcp.firewall/test-project/test-firewall-2", "9.9.9.9")
+        
+        mock_client = Mock()
+        mock_client_class.return_value = mock_client
+        firewall = Mock()
+        firewall.source_ranges = ["9.9.9.9/32"]
+        mock_client.get.return_value = firewall
+        
+        updater = mod.GCPUpdater(mock_config['gcp'], logger)
+        result = updater.update_firewall_rules("1.2.3.4", "5.6.7.8", store)
+        
+        assert result is True
+        mock_client.get.assert_called_once_with(project="test-project", firewall="test-firewall-2")
+        assert list(mock_client.patch.call_args.kwargs['firewall_resource'].source_ranges) == ["5.6.7.8/32"]
+        assert store.is_applied("gcp.firewall/test-project/test-firewall-2", "5.6.7.8")
+    
+    @patch('auto_update_ip.AWS_AVAILABLE', True)
+    @patch('auto_update_ip.boto3.client')
+    def test_failed_target_is_not_marked(self, mock_boto_client, mock_config, logger, tmp_path):
+        """Test a failing security group stays pending for the next run"""
+        from botocore.exceptions import ClientError
+        mock_ec2 = Mock()
+        mock_boto_client.return_value = mock_ec2
+        
+        def authorize(GroupId, IpPermissions):
+            if GroupId == "sg-mysql456":
+                raise ClientError({'Error': {'Code': 'UnauthorizedOperation'}}, 'authorize')
+        
+        mock_ec2.authorize_security_group_ingress.side_effect = authorize
+        store = mod.StateStore(str(tmp_path / "state.json"), logger)
+        
+        updater = mod.AWSUpdater(mock_config['aws'], logger)
+        assert updater.update_security_groups("1.2.3.4", "5.6.7.8", store) is False
+        
+        assert store.is_applied("aws.sg/us-east-1/sg-ssh123/SSH", "5.6.7.8")
+        assert store.applied_ip("aws.sg/us-east-1/sg-mysql456/MySQL") is None
+    
+    def test_dry_run_does_not_mark(self, mock_config, logger, tmp_path):
+        """Test dry-run never records applied targets"""
+        store = mod.StateStore(str(tmp_path / "state.json"), logger)
+        
+        with patch('auto_update_ip.boto3.client'):
+            updater = mod.AWSUpdater(mock_config['aws'], logger, dry_run=True)
+            updater.update_security_groups("1.2.3.4", "5.6.7.8", store)
+        
+        assert store.applied_ip("aws.sg/us-east-1/sg-ssh123/SSH") is None
+    
+    @patch.object(mod.IPService, 'get_current_ip', return_value="5.6.7.8")
+    def test_partial_failure_persists_progress(self, mock_get_ip, tmp_path, mock_config):
+        """Test run saves per-target progress on failure, keeping the old last IP"""
+        cache_file = tmp_path / "state.json"
+        cache_file.write_text("1.2.3.4")
+        mock_config['ip_cache_file'] = str(cache_file)
+        config_file = tmp_path / "config.json"
+        config_file.write_text(json.dumps(mock_config))
+        
+        def firewall(old_ip, new_ip, state):
+            state.mark_applied("gcp.firewall/test-project/test-firewall-1", new_ip)
+            return True
+        
+        with patch.object(mod.GCPUpdater, 'update_firewall_rules', side_effect=firewall), \
+             patch.object(mod.GCPUpdater, 'update_cloud_sql', return_value=False), \
+             patch.object(mod.AWSUpdater, 'update_security_groups', return_value=True):
+            assert mod.IPUpdater(str(config_file)).run() == 1
+        
+        data = json.loads(cache_file.read_text())
+        assert data["ip"] == "1.2.3.4"
+        assert data["targets"]["gcp.firewall/test-project/test-firewall-1"]["ip"] == "5.6.7.8"
+
+
+# ============================================================================
+# RUN LOCK TESTS
+# ============================================================================
+
+def _dead_pid():
+    """PID of a process that has already exited"""
+    import subprocess
+    proc = subprocess.Popen([sys.executable, "-c", "pass"])
+    proc.wait()
+    return proc.pid
+
+
+@pytest.fixture(params=["flock", "exclusive-create"])
+def lock_backend(request):
+    """Run lock tests with flock and with the O_EXCL fallback"""
+    if request.param == "flock":
+        if mod.fcntl is None:
+            pytest.skip("fcntl not available")
+        yield
+    else:
+        with patch.object(mod, 'fcntl', None):
+            yield
+
+
+class TestRunLock:
+    """Test single-flight cross-process run lock"""
+    
+    def test_second_acquire_fails_until_release(self, logger, tmp_path, lock_backend):
+        """Test overlapping acquire fails and succeeds after release"""
+        path = str(tmp_path / "run.lock")
+        first = mod.RunLock(path, logger)
+        second = mod.RunLock(path, logger)
+        
+        assert first.acquire()
+        assert not second.acquire()
+        
+        first.release()
+        assert not os.path.exists(path)
+        assert second.acquire()
+        second.release()
+    
+    def test_stale_lock_from_dead_process_is_broken(self, logger, tmp_path, lock_backend):
+        """Test lock held in the name of a dead PID is taken over"""
+        path = str(tmp_path / "run.lock")
+        holder = mod.RunLock(path, logger)
+        assert holder.acquire()
+        with open(path, 'w') as f:
+            json.dump({"pid": _dead_pid(), "acquired_at": 0}, f)
+        
+        other = mod.RunLock(path, logger)
+        assert other.acquire()
+        other.release()
+        holder.release()
+    
+    def test_old_lock_is_stale(self, logger, tmp_path, lock_backend):
+        """Test lock older than stale_after is broken even if the PID is alive"""
+        path = str(tmp_path / "run.lock")
+        holder = mod.RunLock(path, logger)
+        assert holder.acquire()
+        with open(path, 'w') as f:
+            json.dump({"pid": os.getpid(), "acquired_at": 0}, f)
+        
+        other = mod.RunLock(path, logger, stale_after=60)
+        assert other.acquire()
+        other.release()
+        holder.release()
+    
+    def test_wait_times_out(self, logger, tmp_path, lock_backend):
+        """Test waiting for a busy lock gives up after timeout"""
+        path = str(tmp_path / "run.lock")
+        holder = mod.RunLock(path, logger)
+        assert holder.acquire()
+        
+        assert not mod.RunLock(path, logger).acquire(wait=True, timeout=0.6)
+        holder.release()
+    
+    def test_wait_acquires_after_holder_releases(self, logger, tmp_path, lock_backend):
+        """Test a queued run gets the lock once the holder finishes"""
+        import threading
+        path = str(tmp_path / "run.lock")
+        holder = mod.RunLock(path, logger)
+        assert holder.acquire()
+        threading.Timer(0.3, holder.release).start()
+        
+        waiter = mod.RunLock(path, logger)
+        assert waiter.acquire(wait=True, timeout=5)
+        waiter.release()
+    
+    @patch.object(mod.IPService, 'check_ip_change')
+    def test_run_skips_when_another_run_holds_lock(self, mock_check_ip, tmp_path, mock_config):
+        """Test overlapping run exits immediately without doing any work"""
+        mock_config['ip_cache_file'] = str(tmp_path / "state.json")
+        config_file = tmp_path / "config.json"
+        config_file.write_text(json.dumps(mock_config))
+        
+        holder = mod.RunLock(str(tmp_path / "state.json.lock"), Mock())
+        assert holder.acquire()
+        try:
+            assert mod.IPUpdater(str(config_file)).run() == 0
+        finally:
+            holder.release()
+        
+        assert not mock_check_ip.called
+    
+    @patch.object(mod.IPService, 'get_current_ip', return_value="5.6.7.8")
+    def test_queued_run_reuses_holder_result(self, mock_get_ip, tmp_path, mock_config):
+        """Test a run queued behind the holder sees its saved IP and skips updates"""
+        import threading
+        state_file = tmp_path / "state.json"
+        state_file.write_text("1.2.3.4")
+        mock_config['ip_cache_file'] = str(state_file)
+        config_file = tmp_path / "config.json"
+        config_file.write_text(json.dumps(mock_config))
+        
+        holder = mod.RunLock(str(state_file) + ".lock", Mock())
+        assert holder.acquire()
+        
+        def finish_holder():
+            state_file.write_text(json.dumps({"ip": "5.6.7.8", "targets": {}}))
+            holder.release()
+        
+        threading.Timer(0.3, finish_holder).start()
+        
+        with patch.object(mod.GCPUpdater, 'update_firewall_rules') as mock_firewall:
+            updater = mod.IPUpdater(str(config_file), wait_lock=True)
+            assert updater.run() == 0
+        
+        assert not mock_firewall.called
+
+
+# ============================================================================
+# NETLINK WATCHER TESTS
+# ============================================================================
+
+def _rtnl_addr_message(msg_type, index, address, local=None):
+    """Build one RTM_NEWADDR/RTM_DELADDR netlink message"""
+    import socket
+    import struct
+    attrs = b''
+    for attr_type, value in ((1, address), (2, local)):
+        if value:
+            attrs += struct.pack('=HH', 8, attr_type) + socket.inet_aton(value)
+    body = struct.pack('=BBBBI', socket.AF_INET, 32, 0, 0, index) + attrs
+    return struct.pack('=IHHII', 16 + len(body), msg_type, 0, 0, 0) + body
+
+
+class TestNetlinkWatcher:
+    """Test rtnetlink address parsing and watch mode"""
+    
+    def test_parse_messages(self):
+        """Test parsing address messages, preferring IFA_LOCAL (PPP)"""
+        import struct
+        data = (
+            _rtnl_addr_message(20, 3, "10.0.0.1", local="203.0.113.5")
+            + _rtnl_addr_message(21, 4, "198.51.100.1")
+            + struct.pack('=IHHII', 16, 3, 0, 0, 0)
+        )
+        
+        messages = mod.NetlinkWatcher.parse_messages(data)
+        
+        assert messages == [(20, 3, "203.0.113.5"), (21, 4, "198.51.100.1"), (3, 0, None)]
+    
+    @pytest.mark.skipif(not hasattr(__import__('socket'), 'AF_NETLINK'), reason="Linux only")
+    def test_loopback_has_no_public_address(self, logger):
+        """Test dumping loopback addresses via rtnetlink"""
+        watcher = mod.NetlinkWatcher("lo", logger)
+        try:
+            assert "127.0.0.1" in watcher.addresses()
+            assert watcher.public_address() is None
+        finally:
+            watcher.close()
+    
+    @patch.object(mod, 'NetlinkWatcher')
+    @patch.object(mod.IPUpdater, 'run', return_value=0)
+    def test_watch_runs_only_on_address_change(self, mock_run, mock_watcher_class, temp_config_file):
+        """Test watch mode runs pipeline with interface IP and skips unchanged events"""
+        updater = mod.IPUpdater(temp_config_file)
+        watcher = mock_watcher_class.return_value
+        watcher.public_address.side_effect = ["203.0.113.5", "203.0.113.5", "203.0.113.6"]
+        
+        def wait_for_change(timeout, stop_event):
+            assert timeout is None
+            if watcher.wait_for_change.call_count == 3:
+                stop_event.set()
+            return True
+        
+        watcher.wait_for_change.side_effect = wait_for_change
+        
+        assert updater.watch("ppp0") == 0
+        assert mock_run.call_args_list == [
+            call(current_ip="203.0.113.5"),
+            call(current_ip="203.0.113.6"),
+        ]
+        assert watcher.close.called
+    
+    @patch.object(mod, 'NetlinkWatcher')
+    @patch.object(mod.IPUpdater, 'run', side_effect=[1, 1, 0])
+    def test_watch_retries_failed_update(self, mock_run, mock_watcher_class, temp_config_file):
+        """Test a failed run is retried at the same address with backoff until it succeeds"""
+        updater = mod.IPUpdater(temp_config_file)
+        watcher = mock_watcher_class.return_value
+        watcher.public_address.return_value = "203.0.113.5"
+        timeouts = []
+        
+        def wait_for_change(timeout, stop_event):
+            timeouts.append(timeout)
+            if len(timeouts) == 4:
+                stop_event.set()
+            return False
+        
+        watcher.wait_for_change.side_effect = wait_for_change
+        
+        assert updater.watch("ppp0", poll_interval=45) == 0
+        assert mock_run.call_args_list == [call(current_ip="203.0.113.5")] * 3
+        assert timeouts == [30, 45, None, None]
+    
+    @patch.object(mod, 'NetlinkWatcher')
+    @patch.object(mod.IPUpdater, 'run', return_value=0)
+    def test_watch_falls_back_to_polling_behind_nat(self, mock_run, mock_watcher_class, temp_config_file):
+        """Test watch mode polls IPService when interface only has private IPs"""
+        updater = mod.IPUpdater(temp_config_file)
+        watcher = mock_watcher_class.return_value
+        watcher.public_address.return_value = None
+        
+        def wait_for_change(timeout, stop_event):
+            assert timeout == 60
+            stop_event.set()
+            return False
+        
+        watcher.wait_for_change.side_effect = wait_for_change
+        
+        updater.watch("eth0", poll_interval=60)
+        
+        mock_run.assert_called_once_with()
+    
+    @patch.object(mod, 'NetlinkWatcher', side_effect=OSError("no such device"))
+    def test_watch_unknown_interface(self, mock_watcher_class, temp_config_file):
+        """Test watch mode fails cleanly on unknown interface"""
+        updater = mod.IPUpdater(temp_config_file)
+        
+        assert updater.watch("nope0") == 1
 
 
 # ============================================================================
@@ -391,7 +1086,10 @@ class TestGCPUpdater:
         
         updater = mod.GCPUpdater(config, logger)
         
-        assert mock_sa.Credentials.from_service_account_file.called
+        # Credentials are loaded lazily, on first use
+        assert not mock_sa.Credentials.from_service_account_file.called
+        assert updater.credentials is mock_creds
+        assert mock_sa.Credentials.from_service_account_file.call_count == 1
     
     @patch('auto_update_ip.GCP_AVAILABLE', False)
     def test_update_firewall_rules_gcp_not_available(self, mock_config, logger):
@@ -440,7 +1138,7 @@ class TestGCPUpdater:
         result = updater.update_firewall_rules("1.2.3.4", "5.6.7.8")
         
         # Should not call update in dry-run
-        assert not mock_client.update.called
+        assert not mock_client.patch.called
     
     @patch('auto_update_ip.GCP_AVAILABLE', True)
     @patch('auto_update_ip.service_account.Credentials.from_service_account_file')
@@ -486,7 +1184,7 @@ class TestGCPFirewallEdgeCases:
         
         mock_operation = Mock()
         mock_operation.result.return_value = None
-        mock_client.update.return_value = mock_operation
+        mock_client.patch.return_value = mock_operation
         
         with patch('auto_update_ip.service_account.Credentials.from_service_account_file') as mock_creds:
             mock_creds.return_value = Mock()
@@ -495,7 +1193,7 @@ class TestGCPFirewallEdgeCases:
             result = updater.update_firewall_rules("1.2.3.4", "5.6.7.8")
             
             assert result is True
-            assert mock_client.update.called
+            assert mock_client.patch.called
     
     @patch('auto_update_ip.GCP_AVAILABLE', True)
     @patch('auto_update_ip.compute_v1.FirewallsClient')
@@ -512,7 +1210,7 @@ class TestGCPFirewallEdgeCases:
         result = updater.update_firewall_rules("1.2.3.4", "5.6.7.8")
         
         assert result is True
-        assert not mock_client.update.called  # Should not update
+        assert not mock_client.patch.called  # Should not update
     
     @patch('auto_update_ip.GCP_AVAILABLE', True)
     @patch('auto_update_ip.compute_v1.FirewallsClient')
@@ -553,16 +1251,16 @@ class TestGCPFirewallEdgeCases:
         
         mock_operation = Mock()
         mock_operation.result.return_value = None
-        mock_client.update.return_value = mock_operation
+        mock_client.patch.return_value = mock_operation
         
         updater = mod.GCPUpdater(mock_config['gcp'], logger, dry_run=False)
         result = updater.update_firewall_rules("1.2.3.4", "5.6.7.8")
         
         assert result is True
-        assert mock_client.update.called
+        assert mock_client.patch.called
         
         # Verify the firewall.source_ranges was modified correctly
-        call_args = mock_client.update.call_args
+        call_args = mock_client.patch.call_args
         updated_firewall = call_args.kwargs['firewall_resource']
         assert "1.2.3.4/32" not in updated_firewall.source_ranges
         assert "5.6.7.8/32" in updated_firewall.source_ranges
@@ -587,7 +1285,7 @@ class TestGCPFirewallEdgeCases:
         
         mock_operation = Mock()
         mock_operation.result.return_value = None
-        mock_client.update.return_value = mock_operation
+        mock_client.patch.return_value = mock_operation
         
         updater = mod.GCPUpdater(mock_config['gcp'], logger, dry_run=False)
         result = updater.update_firewall_rules("1.2.3.4", "5.6.7.8")
@@ -596,92 +1294,611 @@ class TestGCPFirewallEdgeCases:
         assert result is False
 
 
-class TestGCPCloudSQLEdgeCases:
-    """Test GCP Cloud SQL edge cases and error paths"""
+class TestGCPFirewallConcurrency:
+    """Test bounded-concurrency firewall rule updates"""
     
-    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
-    @patch('auto_update_ip.discovery.build')
-    def test_cloud_sql_update_with_credentials(self, mock_build, mock_config, logger, tmp_path):
-        """Test Cloud SQL update using credentials file"""
-        creds_file = tmp_path / "creds.json"
-        creds_file.write_text('{"type": "service_account"}')
-        
-        config = mock_config['gcp'].copy()
-        config['credentials_file'] = str(creds_file)
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_rules_updated_concurrently_within_limit(self, mock_client_class, logger):
+        """Test rules run in parallel but never above max_workers"""
+        import threading
+        import time
+        
+        active = []
+        peak = []
+        guard = threading.Lock()
+        
+        def slow_get(project, firewall):
+            with guard:
+                active.append(firewall)
+                peak.append(len(active))
+            time.sleep(0.05)
+            with guard:
+                active.remove(firewall)
+            fw = Mock()
+            fw.source_ranges = []
+            return fw
         
-        mock_service = Mock()
-        mock_build.return_value = mock_service
+        mock_client = Mock()
+        mock_client_class.return_value = mock_client
+        mock_client.get.side_effect = slow_get
         
-        mock_instance = {
-            'settings': {
-                'ipConfiguration': {
-                    'authorizedNetworks': [{'value': '1.2.3.4', 'name': 'old-ip'}]
-                }
-            }
+        config = {
+            "project_id": "test",
+            "firewall_rules": [f"rule-{i}" for i in range(12)],
+            "max_workers": 4
         }
+        updater = mod.GCPUpdater(config, logger)
         
-        mock_service.instances().get().execute.return_value = mock_instance
-        mock_service.instances().patch().execute.return_value = {}
-        
-        with patch('auto_update_ip.service_account.Credentials.from_service_account_file') as mock_creds:
-            mock_creds.return_value = Mock()
-            
-            updater = mod.GCPUpdater(config, logger, dry_run=False)
-            result = updater.update_cloud_sql("1.2.3.4", "5.6.7.8")
-            
-            assert result is True
+        assert updater.update_firewall_rules("1.2.3.4", "5.6.7.8") is True
+        assert mock_client.patch.call_count == 12
+        assert 1 < max(peak) <= 4
     
-    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
-    @patch('auto_update_ip.discovery.build')
-    def test_cloud_sql_ip_already_exists(self, mock_build, mock_config, logger):
-        """Test Cloud SQL update when IP already exists"""
-        mock_service = Mock()
-        mock_build.return_value = mock_service
-        
-        mock_instance = {
-            'settings': {
-                'ipConfiguration': {
-                    'authorizedNetworks': [{'value': '5.6.7.8', 'name': 'existing'}]
-                }
-            }
-        }
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_per_rule_failures_reported(self, mock_client_class, logger, tmp_path):
+        """Test one failing rule fails the batch while others are still applied"""
+        def get(project, firewall):
+            if firewall == "rule-bad":
+                raise Exception("Permission denied")
+            fw = Mock()
+            fw.source_ranges = []
+            return fw
         
-        mock_service.instances().get().execute.return_value = mock_instance
+        mock_client = Mock()
+        mock_client_class.return_value = mock_client
+        mock_client.get.side_effect = get
+        store = mod.StateStore(str(tmp_path / "state.json"), logger)
         
-        updater = mod.GCPUpdater(mock_config['gcp'], logger, dry_run=False)
-        result = updater.update_cloud_sql("1.2.3.4", "5.6.7.8")
+        config = {"project_id": "p", "firewall_rules": ["rule-a", "rule-bad", "rule-b"]}
+        updater = mod.GCPUpdater(config, logger)
         
-        assert result is True
-        assert not mock_service.instances().patch.called
+        assert updater.update_firewall_rules("1.2.3.4", "5.6.7.8", store) is False
+        assert store.is_applied("gcp.firewall/p/rule-a", "5.6.7.8")
+        assert store.is_applied("gcp.firewall/p/rule-b", "5.6.7.8")
+        assert store.applied_ip("gcp.firewall/p/rule-bad") is None
+
+
+class TestGCPFirewallPatch:
+    """Test firewall rules are written with a minimal PATCH body"""
     
-    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
-    @patch('auto_update_ip.discovery.build')
-    @patch('auto_update_ip.HttpError')
-    def test_cloud_sql_instance_not_found(self, mock_http_error, mock_build, mock_config, logger):
-        """Test Cloud SQL update when instance not found (404)"""
-        mock_service = Mock()
-        mock_build.return_value = mock_service
+    @staticmethod
+    def _conflict(status):
+        error = Exception("Precondition failed")
+        error.code = status
+        return error
+    
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_patch_body_only_source_ranges(self, mock_client_class, logger):
+        """Test PATCH carries only source_ranges and update() is never used"""
+        mock_client = Mock()
+        mock_client_class.return_value = mock_client
+        mock_firewall = Mock()
+        mock_firewall.source_ranges = ["1.2.3.4/32", "10.0.0.0/8"]
+        mock_client.get.return_value = mock_firewall
         
-        from googleapiclient.errors import HttpError
-        mock_resp = Mock()
-        mock_resp.status = 404
-        error = HttpError(resp=mock_resp, content=b'Not found')
+        updater = mod.GCPUpdater({"project_id": "p", "firewall_rules": ["rule-a"]}, logger)
         
-        mock_service.instances().get().execute.side_effect = error
+        assert updater.update_firewall_rules("1.2.3.4", "5.6.7.8") is True
+        mock_client.update.assert_not_called()
+        body = mock_client.patch.call_args.kwargs['firewall_resource']
+        assert list(body.source_ranges) == ["10.0.0.0/8", "5.6.7.8/32"]
+        assert body == mod.compute_v1.Firewall(source_ranges=["10.0.0.0/8", "5.6.7.8/32"])
+    
+    @pytest.mark.parametrize("status", [409, 412])
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_conflict_rereads_and_retries(self, mock_client_class, logger, status):
+        """Test a concurrent-write conflict re-reads the rule and patches again"""
+        stale = Mock()
+        stale.source_ranges = ["1.2.3.4/32"]
+        fresh = Mock()
+        fresh.source_ranges = ["1.2.3.4/32", "9.9.9.9/32"]
         
-        updater = mod.GCPUpdater(mock_config['gcp'], logger, dry_run=False)
-        result = updater.update_cloud_sql("1.2.3.4", "5.6.7.8")
+        mock_client = Mock()
+        mock_client_class.return_value = mock_client
+        mock_client.get.side_effect = [stale, fresh]
+        mock_client.patch.side_effect = [self._conflict(status), Mock()]
         
-        assert result is False
-    
-    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
-    @patch('auto_update_ip.discovery.build')
-    def test_cloud_sql_other_http_error(self, mock_build, mock_config, logger):
-        """Test Cloud SQL update with other HTTP error"""
-        mock_service = Mock()
-        mock_build.return_value = mock_service
+        updater = mod.GCPUpdater({"project_id": "p", "firewall_rules": ["rule-a"]}, logger)
         
-        from googleapiclient.errors import HttpError
+        assert updater.update_firewall_rules("1.2.3.4", "5.6.7.8") is True
+        assert mock_client.get.call_count == 2
+        body = mock_client.patch.call_args.kwargs['firewall_resource']
+        assert list(body.source_ranges) == ["9.9.9.9/32", "5.6.7.8/32"]
+    
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_conflict_retries_exhausted(self, mock_client_class, logger):
+        """Test persistent conflicts give up after conflict_retries"""
+        mock_client = Mock()
+        mock_client_class.return_value = mock_client
+        mock_firewall = Mock()
+        mock_firewall.source_ranges = []
+        mock_client.get.return_value = mock_firewall
+        mock_client.patch.side_effect = self._conflict(412)
+        
+        config = {"project_id": "p", "firewall_rules": ["rule-a"], "conflict_retries": 2}
+        updater = mod.GCPUpdater(config, logger)
+        
+        assert updater.update_firewall_rules(None, "5.6.7.8") is False
+        assert mock_client.patch.call_count == 3
+
+
+class TestGCPFirewallBulkDiscovery:
+    """Test firewall rules are read with filtered list calls"""
+    
+    @staticmethod
+    def _firewall(name, source_ranges):
+        firewall = Mock()
+        firewall.name = name
+        firewall.source_ranges = source_ranges
+        return firewall
+    
+    @staticmethod
+    def _client(mock_client_class, firewalls):
+        mock_client = Mock()
+        mock_client_class.return_value = mock_client
+        
+        def list_firewalls(request):
+            return [fw for fw in firewalls if f'(name = "{fw.name}")' in request.filter]
+        
+        mock_client.list.side_effect = list_firewalls
+        return mock_client
+    
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_single_list_call_no_get(self, mock_client_class, logger):
+        """Test all rules come from one filtered list call"""
+        mock_client = self._client(mock_client_class, [
+            self._firewall("rule-a", ["1.2.3.4/32"]),
+            self._firewall("rule-b", []),
+            self._firewall("other", ["1.2.3.4/32"]),
+        ])
+        
+        config = {"project_id": "p", "firewall_rules": ["rule-a", "rule-b"]}
+        updater = mod.GCPUpdater(config, logger)
+        
+        assert updater.update_firewall_rules("1.2.3.4", "5.6.7.8") is True
+        assert mock_client.list.call_count == 1
+        request = mock_client.list.call_args.kwargs['request']
+        assert request.project == "p"
+        assert request.filter == '(name = "rule-a") OR (name = "rule-b")'
+        mock_client.get.assert_not_called()
+        patched = sorted(c.kwargs['firewall'] for c in mock_client.patch.call_args_list)
+        assert patched == ["rule-a", "rule-b"]
+    
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_local_diff(self, mock_client_class, logger):
+        """Test only rules whose ranges actually differ are written"""
+        mock_client = self._client(mock_client_class, [
+            self._firewall("up-to-date", ["10.0.0.0/8", "5.6.7.8/32"]),
+            self._firewall("both", ["1.2.3.4/32", "5.6.7.8/32"]),
+        ])
+        
+        config = {"project_id": "p", "firewall_rules": ["up-to-date", "both"]}
+        updater = mod.GCPUpdater(config, logger)
+        
+        assert updater.update_firewall_rules("1.2.3.4", "5.6.7.8") is True
+        assert mock_client.patch.call_count == 1
+        call_kwargs = mock_client.patch.call_args.kwargs
+        assert call_kwargs['firewall'] == "both"
+        assert list(call_kwargs['firewall_resource'].source_ranges) == ["5.6.7.8/32"]
+    
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_missing_rule_reported(self, mock_client_class, logger):
+        """Test a configured rule absent from the listing fails without a get"""
+        mock_client = self._client(mock_client_class, [self._firewall("rule-a", [])])
+        
+        config = {"project_id": "p", "firewall_rules": ["rule-a", "rule-gone"]}
+        updater = mod.GCPUpdater(config, logger)
+        
+        assert updater.update_firewall_rules(None, "5.6.7.8") is False
+        mock_client.get.assert_not_called()
+        assert mock_client.patch.call_count == 1
+    
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_filter_chunked(self, mock_client_class, logger):
+        """Test long rule lists are split across several filtered list calls"""
+        names = [f"rule-{i}" for i in range(5)]
+        mock_client = self._client(mock_client_class, [self._firewall(n, []) for n in names])
+        
+        updater = mod.GCPUpdater({"project_id": "p", "firewall_rules": names}, logger)
+        
+        with patch.object(mod.GCPUpdater, 'LIST_FILTER_CHUNK', 2):
+            assert updater.update_firewall_rules(None, "5.6.7.8") is True
+        assert mock_client.list.call_count == 3
+        assert mock_client.patch.call_count == 5
+    
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_list_failure_falls_back_to_get(self, mock_client_class, logger):
+        """Test a failing list (e.g. missing compute.firewalls.list) reads rules one by one"""
+        mock_client = Mock()
+        mock_client_class.return_value = mock_client
+        mock_client.list.side_effect = Exception("Permission denied")
+        mock_client.get.return_value = self._firewall("rule-a", [])
+        
+        updater = mod.GCPUpdater({"project_id": "p", "firewall_rules": ["rule-a"]}, logger)
+        
+        assert updater.update_firewall_rules(None, "5.6.7.8") is True
+        mock_client.get.assert_called_once_with(project="p", firewall="rule-a")
+        assert mock_client.patch.call_count == 1
+
+
+class TestGCPFirewallSelectors:
+    """Test selector-based firewall discovery and its cache"""
+    
+    SELECTORS = [{"name_prefix": "tf-allow-", "network": "vpc-a"}]
+    
+    @staticmethod
+    def _firewall(name, network="vpc-a", target_tags=(), description="", source_ranges=()):
+        firewall = Mock()
+        firewall.name = name
+        firewall.network = f"https://www.googleapis.com/compute/v1/projects/p/global/networks/{network}"
+        firewall.target_tags = list(target_tags)
+        firewall.description = description
+        firewall.source_ranges = list(source_ranges)
+        return firewall
+    
+    def _client(self, mock_client_class):
+        firewalls = [
+            self._firewall("tf-allow-ssh", source_ranges=["1.2.3.4/32"]),
+            self._firewall("tf-allow-db"),
+            self._firewall("tf-allow-other-vpc", network="vpc-b"),
+            self._firewall("manual-rule"),
+        ]
+        mock_client = Mock()
+        mock_client_class.return_value = mock_client
+        
+        def list_firewalls(request):
+            if 'name = "' in request.filter:
+                return [fw for fw in firewalls if f'(name = "{fw.name}")' in request.filter]
+            return firewalls
+        
+        mock_client.list.side_effect = list_firewalls
+        return mock_client
+    
+    @staticmethod
+    def _discovery_calls(mock_client):
+        return [c for c in mock_client.list.call_args_list if 'name = "' not in c.kwargs['request'].filter]
+    
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_selectors_resolved_with_one_list(self, mock_client_class, logger, tmp_path):
+        """Test matching rules are discovered in one list call and cached"""
+        mock_client = self._client(mock_client_class)
+        store = mod.StateStore(str(tmp_path / "state.json"), logger)
+        updater = mod.GCPUpdater({"project_id": "p", "firewall_selectors": self.SELECTORS}, logger)
+        
+        assert updater.update_firewall_rules("1.2.3.4", "5.6.7.8", store) is True
+        assert mock_client.list.call_count == 1
+        mock_client.get.assert_not_called()
+        patched = sorted(c.kwargs['firewall'] for c in mock_client.patch.call_args_list)
+        assert patched == ["tf-allow-db", "tf-allow-ssh"]
+        assert store.discovered("gcp.firewall/p", mod.GCPUpdater._selectors_key(self.SELECTORS), 3600) == ["tf-allow-db", "tf-allow-ssh"]
+    
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_cached_discovery_reused(self, mock_client_class, logger, tmp_path):
+        """Test a fresh cache skips discovery and reads only the cached rules"""
+        mock_client = self._client(mock_client_class)
+        store = mod.StateStore(str(tmp_path / "state.json"), logger)
+        updater = mod.GCPUpdater({"project_id": "p", "firewall_selectors": self.SELECTORS}, logger)
+        
+        updater.update_firewall_rules("1.2.3.4", "5.6.7.8", store)
+        store.save()
+        store = mod.StateStore(str(tmp_path / "state.json"), logger)
+        store.load()
+        mock_client.list.reset_mock()
+        
+        assert updater.update_firewall_rules("5.6.7.8", "9.9.9.9", store) is True
+        assert self._discovery_calls(mock_client) == []
+        assert mock_client.list.call_args.kwargs['request'].filter == (
+            '(name = "tf-allow-db") OR (name = "tf-allow-ssh")'
+        )
+    
+    @pytest.mark.parametrize("change", ["expired", "selectors", "force"])
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_cache_invalidated(self, mock_client_class, logger, tmp_path, change):
+        """Test expiry, edited selectors or forget_discovered trigger a new discovery"""
+        mock_client = self._client(mock_client_class)
+        store = mod.StateStore(str(tmp_path / "state.json"), logger)
+        config = {"project_id": "p", "firewall_selectors": self.SELECTORS, "discovery_ttl": 600}
+        mod.GCPUpdater(config, logger).update_firewall_rules("1.2.3.4", "5.6.7.8", store)
+        mock_client.list.reset_mock()
+        
+        if change == "expired":
+            store._data['discovery']["gcp.firewall/p"]['resolved_at'] = "2000-01-01T00:00:00"
+        elif change == "selectors":
+            config = dict(config, firewall_selectors=[{"name_prefix": "tf-allow-"}])
+        else:
+            store.forget_discovered()
+        
+        mod.GCPUpdater(config, logger).update_firewall_rules("5.6.7.8", "9.9.9.9", store)
+        assert len(self._discovery_calls(mock_client)) == 1
+    
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_deleted_cached_rule_drops_cache(self, mock_client_class, logger, tmp_path):
+        """Test a cached rule that no longer exists forces re-discovery next time"""
+        mock_client = self._client(mock_client_class)
+        store = mod.StateStore(str(tmp_path / "state.json"), logger)
+        config = {"project_id": "p", "firewall_selectors": self.SELECTORS}
+        store.set_discovered("gcp.firewall/p", mod.GCPUpdater._selectors_key(self.SELECTORS), ["tf-allow-gone"])
+        
+        assert mod.GCPUpdater(config, logger).update_firewall_rules(None, "5.6.7.8", store) is False
+        assert store._data['discovery'] == {}
+    
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_explicit_rules_merged(self, mock_client_class, logger):
+        """Test firewall_rules and selector matches are updated together once"""
+        mock_client = self._client(mock_client_class)
+        config = {
+            "project_id": "p",
+            "firewall_rules": ["manual-rule", "tf-allow-ssh"],
+            "firewall_selectors": self.SELECTORS
+        }
+        
+        assert mod.GCPUpdater(config, logger).update_firewall_rules("1.2.3.4", "5.6.7.8") is True
+        patched = sorted(c.kwargs['firewall'] for c in mock_client.patch.call_args_list)
+        assert patched == ["manual-rule", "tf-allow-db", "tf-allow-ssh"]
+    
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_discovery_failure(self, mock_client_class, logger):
+        """Test a failing discovery still updates explicit rules but reports failure"""
+        mock_client = Mock()
+        mock_client_class.return_value = mock_client
+        mock_client.list.side_effect = Exception("Permission denied")
+        firewall = self._firewall("manual-rule")
+        mock_client.get.return_value = firewall
+        config = {"project_id": "p", "firewall_rules": ["manual-rule"], "firewall_selectors": self.SELECTORS}
+        
+        assert mod.GCPUpdater(config, logger).update_firewall_rules(None, "5.6.7.8") is False
+        assert mock_client.patch.call_count == 1
+    
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_rejected_server_filter_falls_back_to_unfiltered_list(self, mock_client_class, logger):
+        """Test a regex RE2 rejects (lookahead) is resolved by an unfiltered list and local matching"""
+        mock_client = self._client(mock_client_class)
+        list_firewalls = mock_client.list.side_effect
+        
+        def list_rejecting_lookahead(request):
+            if '(?!' in request.filter:
+                raise Exception("400 Invalid value for field 'filter'")
+            return list_firewalls(request)
+        
+        mock_client.list.side_effect = list_rejecting_lookahead
+        selectors = [{"name_regex": "^tf-allow-(?!other)"}]
+        
+        updater = mod.GCPUpdater({"project_id": "p", "firewall_selectors": selectors}, logger)
+        assert updater.update_firewall_rules(None, "5.6.7.8") is True
+        discovery = self._discovery_calls(mock_client)
+        assert [bool(c.kwargs['request'].filter) for c in discovery] == [True, False]
+        patched = sorted(c.kwargs['firewall'] for c in mock_client.patch.call_args_list)
+        assert patched == ["tf-allow-db", "tf-allow-ssh"]
+    
+    def test_selector_matches(self):
+        """Test each selector condition and their AND combination"""
+        firewall = self._firewall("tf-allow-ssh", target_tags=["bastion"], description="managed-by: ip-updater")
+        matches = mod.GCPUpdater._selector_matches
+        
+        assert matches({"name_regex": "allow-(ssh|db)$"}, firewall)
+        assert matches({"network": "vpc-a", "target_tags": ["web", "bastion"]}, firewall)
+        assert matches({"network": firewall.network}, firewall)
+        assert matches({"description_marker": "managed-by: ip-updater"}, firewall)
+        assert not matches({"network": "vpc-b"}, firewall)
+        assert not matches({"name_prefix": "tf-", "target_tags": ["web"]}, firewall)
+        assert not matches({"description_marker": "other"}, firewall)
+    
+    def test_selector_filter(self):
+        """Test the server-side filter narrows by name and, for one selector, network"""
+        build = mod.GCPUpdater._selector_filter
+        
+        assert build(self.SELECTORS) == (
+            '(name eq "(?:tf\\-allow\\-.*)") (network eq ".*/networks/vpc\\-a")'
+        )
+        assert build([{"name_prefix": "a"}, {"name_regex": "b$"}]) == '(name eq "(?:a.*)|(?:.*(?:b$).*)")'
+        assert build([{"name_prefix": "a"}, {"target_tags": ["web"]}]) is None
+    
+    @pytest.mark.parametrize("selectors, message", [
+        ({"name_prefix": "a"}, "phải là array"),
+        ([{"labels": {"a": "b"}}], "không hỗ trợ"),
+        ([{"name_regex": "("}], "name_regex không hợp lệ"),
+        ([{}], "khác rỗng"),
+    ])
+    def test_validation(self, tmp_path, mock_config, selectors, message):
+        """Test malformed selectors are rejected when loading config"""
+        mock_config['gcp']['firewall_selectors'] = selectors
+        config_file = tmp_path / "config.json"
+        config_file.write_text(json.dumps(mock_config))
+        
+        with pytest.raises(ValueError, match=message):
+            mod.Config(str(config_file))
+
+
+class TestGCPOperationWaiting:
+    """Test submit-all-then-wait handling of GCP operations"""
+    
+    @staticmethod
+    def _client_with_operations(mock_client_class, operations, events):
+        mock_client = Mock()
+        mock_client_class.return_value = mock_client
+        
+        def get(project, firewall):
+            fw = Mock()
+            fw.source_ranges = []
+            return fw
+        
+        def update(project, firewall, firewall_resource):
+            events.append(("patch", firewall))
+            return operations[firewall]
+        
+        mock_client.get.side_effect = get
+        mock_client.patch.side_effect = update
+        return mock_client
+    
+    @staticmethod
+    def _operation(name, events, polls_until_done=1, error=None):
+        op = Mock()
+        calls = []
+        
+        def done():
+            calls.append(1)
+            events.append(("poll", name))
+            return len(calls) >= polls_until_done
+        
+        op.done.side_effect = done
+        if error:
+            op.result.side_effect = error
+        return op
+    
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    @patch('time.sleep')
+    def test_all_updates_submitted_before_waiting(self, mock_sleep, mock_client_class, logger):
+        """Test every update is issued before any operation is polled"""
+        events = []
+        operations = {
+            "rule-a": self._operation("rule-a", events, polls_until_done=3),
+            "rule-b": self._operation("rule-b", events, polls_until_done=1),
+        }
+        self._client_with_operations(mock_client_class, operations, events)
+        
+        updater = mod.GCPUpdater({"project_id": "p", "firewall_rules": ["rule-a", "rule-b"]}, logger)
+        
+        assert updater.update_firewall_rules("1.2.3.4", "5.6.7.8") is True
+        first_poll = next(i for i, event in enumerate(events) if event[0] == "poll")
+        assert all(event[0] == "poll" for event in events[first_poll:])
+        assert operations["rule-a"].done.call_count == 3
+        assert operations["rule-b"].done.call_count == 1
+        # Backoff between polling rounds
+        delays = [c.args[0] for c in mock_sleep.call_args_list]
+        assert delays == sorted(delays) and len(delays) == 2
+    
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_failed_operation_reported(self, mock_client_class, logger):
+        """Test an operation finishing with an error fails only its rule"""
+        events = []
+        operations = {
+            "rule-a": self._operation("rule-a", events),
+            "rule-b": self._operation("rule-b", events, error=Exception("quota exceeded")),
+        }
+        self._client_with_operations(mock_client_class, operations, events)
+        
+        updater = mod.GCPUpdater({"project_id": "p", "firewall_rules": ["rule-a", "rule-b"]}, logger)
+        
+        assert updater.update_firewall_rules("1.2.3.4", "5.6.7.8") is False
+    
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_shared_deadline(self, mock_client_class, logger):
+        """Test operations still running at the shared deadline count as failed"""
+        events = []
+        operations = {"rule-a": self._operation("rule-a", events, polls_until_done=10**6)}
+        self._client_with_operations(mock_client_class, operations, events)
+        
+        config = {"project_id": "p", "firewall_rules": ["rule-a"], "operation_timeout": 0.2}
+        updater = mod.GCPUpdater(config, logger)
+        
+        assert updater.update_firewall_rules("1.2.3.4", "5.6.7.8") is False
+
+
+class TestGCPCloudSQLEdgeCases:
+    """Test GCP Cloud SQL edge cases and error paths"""
+    
+    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build')
+    def test_cloud_sql_update_with_credentials(self, mock_build, mock_config, logger, tmp_path):
+        """Test Cloud SQL update using credentials file"""
+        creds_file = tmp_path / "creds.json"
+        creds_file.write_text('{"type": "service_account"}')
+        
+        config = mock_config['gcp'].copy()
+        config['credentials_file'] = str(creds_file)
+        
+        mock_service = Mock()
+        mock_build.return_value = mock_service
+        
+        mock_instance = {
+            'settings': {
+                'ipConfiguration': {
+                    'authorizedNetworks': [{'value': '1.2.3.4', 'name': 'old-ip'}]
+                }
+            }
+        }
+        
+        mock_service.instances().get().execute.return_value = mock_instance
+        mock_service.instances().patch().execute.return_value = {}
+        
+        with patch('auto_update_ip.service_account.Credentials.from_service_account_file') as mock_creds:
+            mock_creds.return_value = Mock()
+            
+            updater = mod.GCPUpdater(config, logger, dry_run=False)
+            result = updater.update_cloud_sql("1.2.3.4", "5.6.7.8")
+            
+            assert result is True
+    
+    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build')
+    def test_cloud_sql_ip_already_exists(self, mock_build, mock_config, logger):
+        """Test Cloud SQL update when IP already exists"""
+        mock_service = Mock()
+        mock_build.return_value = mock_service
+        
+        mock_instance = {
+            'settings': {
+                'ipConfiguration': {
+                    'authorizedNetworks': [{'value': '5.6.7.8', 'name': 'existing'}]
+                }
+            }
+        }
+        
+        mock_service.instances().get().execute.return_value = mock_instance
+        
+        updater = mod.GCPUpdater(mock_config['gcp'], logger, dry_run=False)
+        result = updater.update_cloud_sql("1.2.3.4", "5.6.7.8")
+        
+        assert result is True
+        assert not mock_service.instances().patch.called
+    
+    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build')
+    @patch('auto_update_ip.HttpError')
+    def test_cloud_sql_instance_not_found(self, mock_http_error, mock_build, mock_config, logger):
+        """Test Cloud SQL update when instance not found (404)"""
+        mock_service = Mock()
+        mock_build.return_value = mock_service
+        
+        from googleapiclient.errors import HttpError
+        mock_resp = Mock()
+        mock_resp.status = 404
+        error = HttpError(resp=mock_resp, content=b'Not found')
+        
+        mock_service.instances().get().execute.side_effect = error
+        
+        updater = mod.GCPUpdater(mock_config['gcp'], logger, dry_run=False)
+        result = updater.update_cloud_sql("1.2.3.4", "5.6.7.8")
+        
+        assert result is False
+    
+    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build')
+    def test_cloud_sql_other_http_error(self, mock_build, mock_config, logger):
+        """Test Cloud SQL update with other HTTP error"""
+        mock_service = Mock()
+        mock_build.return_value = mock_service
+        
+        from googleapiclient.errors import HttpError
         mock_resp = Mock()
         mock_resp.status = 500
         error = HttpError(resp=mock_resp, content=b'Server error')
@@ -708,76 +1925,918 @@ class TestGCPCloudSQLEdgeCases:
     
     @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
     @patch('auto_update_ip.discovery.build')
-    def test_cloud_sql_update_dry_run(self, mock_build, mock_config, logger):
-        """Test Cloud SQL update in dry-run mode"""
-        mock_service = Mock()
-        mock_build.return_value = mock_service
-        
-        mock_instance = {
-            'settings': {
-                'ipConfiguration': {
-                    'authorizedNetworks': [{'value': '1.2.3.4', 'name': 'old-ip'}]
-                }
-            }
-        }
+    def test_cloud_sql_update_dry_run(self, mock_build, mock_config, logger):
+        """Test Cloud SQL update in dry-run mode"""
+        mock_service = Mock()
+        mock_build.return_value = mock_service
+        
+        mock_instance = {
+            'settings': {
+                'ipConfiguration': {
+                    'authorizedNetworks': [{'value': '1.2.3.4', 'name': 'old-ip'}]
+                }
+            }
+        }
+        
+        mock_service.instances().get().execute.return_value = mock_instance
+        
+        updater = mod.GCPUpdater(mock_config['gcp'], logger, dry_run=True)
+        result = updater.update_cloud_sql("1.2.3.4", "5.6.7.8")
+        
+        assert result is True
+        # Should NOT call patch in dry-run mode
+        assert not mock_service.instances().patch.called
+    
+    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build')
+    def test_cloud_sql_update_actually_patches(self, mock_build, mock_config, logger):
+        """Test Cloud SQL actually calls patch API"""
+        mock_service = Mock()
+        mock_build.return_value = mock_service
+        
+        mock_instance = {
+            'settings': {
+                'ipConfiguration': {
+                    'authorizedNetworks': [{'value': '1.2.3.4', 'name': 'old-ip'}]
+                }
+            }
+        }
+        
+        mock_service.instances().get().execute.return_value = mock_instance
+        mock_service.instances().patch().execute.return_value = {}
+        
+        updater = mod.GCPUpdater(mock_config['gcp'], logger, dry_run=False)
+        result = updater.update_cloud_sql("1.2.3.4", "5.6.7.8")
+        
+        assert result is True
+        # Verify patch was called
+        assert mock_service.instances().patch.called
+        
+        # Verify the patch was called with correct parameters
+        call_args = mock_service.instances().patch.call_args
+        assert call_args.kwargs['project'] == mock_config['gcp']['project_id']
+        assert call_args.kwargs['instance'] in mock_config['gcp']['sql_instances']
+    
+    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build')
+    def test_cloud_sql_update_non_404_error(self, mock_build, mock_config, logger):
+        """Test Cloud SQL with non-404 HttpError"""
+        mock_service = Mock()
+        mock_build.return_value = mock_service
+        
+        from googleapiclient.errors import HttpError
+        mock_resp = Mock()
+        mock_resp.status = 403  # Forbidden, not 404
+        error = HttpError(resp=mock_resp, content=b'Access denied')
+        
+        mock_service.instances().get().execute.side_effect = error
+        
+        updater = mod.GCPUpdater(mock_config['gcp'], logger, dry_run=False)
+        result = updater.update_cloud_sql("1.2.3.4", "5.6.7.8")
+        
+        assert result is False
+
+
+class _FakeRequest:
+    """googleapiclient HttpRequest stand-in; counts direct (non-batch) executions"""
+    
+    def __init__(self, service, func):
+        self.service = service
+        self.func = func
+    
+    def execute(self):
+        self.service.direct_calls += 1
+        return self.func()
+
+
+class _FakeBatch:
+    """BatchHttpRequest stand-in delivering each response to the callback"""
+    
+    def __init__(self, service, callback):
+        self.service = service
+        self.callback = callback
+        self.requests = []
+    
+    def add(self, request, request_id):
+        self.requests.append((request_id, request))
+    
+    def execute(self):
+        self.service.batches.append([request_id for request_id, _ in self.requests])
+        if self.service.batch_error:
+            raise self.service.batch_error
+        for request_id, request in self.requests:
+            try:
+                self.callback(request_id, request.func(), None)
+            except Exception as e:
+                self.callback(request_id, None, e)
+
+
+class _FakeSQLService:
+    """Minimal sqladmin service: instances().get/patch, operations().get, batching"""
+    
+    def __init__(self, instances, polls_until_done=2, failing_operations=(), batch_error=None,
+                 concurrent_edits=None):
+        self.instances_data = instances
+        # Số lần một tool khác sửa instance ngay trước lệnh patch của chúng ta
+        self.concurrent_edits = dict(concurrent_edits or {})
+        self.polls_until_done = polls_until_done
+        self.failing_operations = set(failing_operations)
+        self.batch_error = batch_error
+        self.batches = []
+        self.direct_calls = 0
+        self.patched = {}
+        self.polls = {}
+    
+    def new_batch_http_request(self, callback):
+        return _FakeBatch(self, callback)
+    
+    def instances(self):
+        service = self
+        
+        class Instances:
+            def get(self, project, instance):
+                def read():
+                    if instance not in service.instances_data:
+                        from googleapiclient.errors import HttpError
+                        resp = Mock()
+                        resp.status = 404
+                        raise HttpError(resp=resp, content=b'Not found')
+                    return service.instances_data[instance]
+                return _FakeRequest(service, read)
+            
+            def patch(self, project, instance, body):
+                def write():
+                    settings = service.instances_data[instance]['settings']
+                    if service.concurrent_edits.get(instance):
+                        service.concurrent_edits[instance] -= 1
+                        settings['settingsVersion'] = str(int(settings['settingsVersion']) + 1)
+                    if 'settingsVersion' in settings and \
+                            body['settings'].get('settingsVersion') != settings['settingsVersion']:
+                        from googleapiclient.errors import HttpError
+                        resp = Mock()
+                        resp.status = 412
+                        raise HttpError(resp=resp, content=b'Precondition failed')
+                    service.patched[instance] = body
+                    return {'name': f"op-{instance}", 'status': 'PENDING'}
+                return _FakeRequest(service, write)
+        
+        return Instances()
+    
+    def operations(self):
+        service = self
+        
+        class Operations:
+            def get(self, project, operation):
+                def poll():
+                    service.polls[operation] = service.polls.get(operation, 0) + 1
+                    if service.polls[operation] < service.polls_until_done:
+                        return {'name': operation, 'status': 'RUNNING'}
+                    if operation in service.failing_operations:
+                        return {'name': operation, 'status': 'DONE',
+                                'error': {'errors': [{'message': 'quota exceeded'}]}}
+                    return {'name': operation, 'status': 'DONE'}
+                return _FakeRequest(service, poll)
+        
+        return Operations()
+
+
+class TestGCPCloudSQLConcurrency:
+    """Test batched Cloud SQL reads, concurrent patches and parallel waiting"""
+    
+    @staticmethod
+    def _instances(count, ip="1.2.3.4"):
+        return {
+            f"db-{i}": {'settings': {'ipConfiguration': {
+                'authorizedNetworks': [{'value': ip, 'name': 'office'}]
+            }}}
+            for i in range(count)
+        }
+    
+    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build')
+    @patch('time.sleep')
+    def test_fleet_batched_end_to_end(self, mock_sleep, mock_build, logger, tmp_path):
+        """Test 20 instances take one read batch, one patch batch and one batch per poll round"""
+        service = _FakeSQLService(self._instances(20), polls_until_done=3)
+        mock_build.return_value = service
+        store = mod.StateStore(str(tmp_path / "state.json"), logger)
+        names = [f"db-{i}" for i in range(20)]
+        
+        updater = mod.GCPUpdater({"project_id": "p", "sql_instances": names}, logger)
+        
+        assert updater.update_cloud_sql("1.2.3.4", "5.6.7.8", store) is True
+        assert service.direct_calls == 0
+        assert len(service.batches) == 2 + 3
+        assert all(sorted(batch) == sorted(names) for batch in service.batches)
+        assert sorted(service.patched) == sorted(names)
+        assert all(store.is_applied(f"gcp.sql/p/{name}", "5.6.7.8") for name in names)
+        # Một lần chờ giữa mỗi vòng poll, không phải mỗi instance
+        assert mock_sleep.call_count == 2
+    
+    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build')
+    def test_batches_chunked(self, mock_build, logger):
+        """Test large fleets are split into batches of SQL_BATCH_SIZE requests"""
+        service = _FakeSQLService(self._instances(5), polls_until_done=1)
+        mock_build.return_value = service
+        updater = mod.GCPUpdater({"project_id": "p", "sql_instances": list(service.instances_data)}, logger)
+        
+        with patch.object(mod.GCPUpdater, 'SQL_BATCH_SIZE', 2):
+            assert updater.update_cloud_sql(None, "5.6.7.8") is True
+        assert [len(batch) for batch in service.batches] == [2, 2, 1] * 3
+    
+    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build')
+    def test_per_instance_failures(self, mock_build, logger, tmp_path):
+        """Test a missing instance and a failed operation fail only themselves"""
+        service = _FakeSQLService(self._instances(3), polls_until_done=1, failing_operations=["op-db-1"])
+        mock_build.return_value = service
+        store = mod.StateStore(str(tmp_path / "state.json"), logger)
+        config = {"project_id": "p", "sql_instances": ["db-0", "db-1", "db-2", "db-gone"]}
+        
+        assert mod.GCPUpdater(config, logger).update_cloud_sql("1.2.3.4", "5.6.7.8", store) is False
+        assert store.is_applied("gcp.sql/p/db-0", "5.6.7.8")
+        assert store.is_applied("gcp.sql/p/db-2", "5.6.7.8")
+        assert store.applied_ip("gcp.sql/p/db-1") is None
+        assert store.applied_ip("gcp.sql/p/db-gone") is None
+    
+    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build')
+    def test_shared_deadline(self, mock_build, logger):
+        """Test operations still running at the shared deadline count as failed"""
+        service = _FakeSQLService(self._instances(2), polls_until_done=10**6)
+        mock_build.return_value = service
+        config = {"project_id": "p", "sql_instances": ["db-0", "db-1"], "operation_timeout": 0.2}
+        
+        assert mod.GCPUpdater(config, logger).update_cloud_sql("1.2.3.4", "5.6.7.8") is False
+    
+    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build')
+    def test_batch_failure_falls_back(self, mock_build, logger):
+        """Test a failing batch endpoint sends requests individually"""
+        service = _FakeSQLService(self._instances(2), polls_until_done=1, batch_error=Exception("batch disabled"))
+        mock_build.return_value = service
+        config = {"project_id": "p", "sql_instances": ["db-0", "db-1"]}
+        
+        assert mod.GCPUpdater(config, logger).update_cloud_sql("1.2.3.4", "5.6.7.8") is True
+        assert service.direct_calls == 6
+        assert sorted(service.patched) == ["db-0", "db-1"]
+    
+    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build')
+    def test_dry_run_reads_only(self, mock_build, logger):
+        """Test dry-run batches the reads but never patches"""
+        service = _FakeSQLService(self._instances(2))
+        mock_build.return_value = service
+        config = {"project_id": "p", "sql_instances": ["db-0", "db-1"]}
+        
+        assert mod.GCPUpdater(config, logger, dry_run=True).update_cloud_sql("1.2.3.4", "5.6.7.8") is True
+        assert service.patched == {}
+        assert len(service.batches) == 1
+
+
+class TestGCPCloudSQLPatchBody:
+    """Test the minimal Cloud SQL patch body and settingsVersion conflicts"""
+    
+    @staticmethod
+    def _instances():
+        return {"db-0": {'settings': {
+            'settingsVersion': '7',
+            'tier': 'db-custom-2-7680',
+            'backupConfiguration': {'enabled': True},
+            'ipConfiguration': {
+                'ipv4Enabled': True,
+                'authorizedNetworks': [
+                    {'value': '1.2.3.4', 'name': 'office'},
+                    {'value': '10.1.0.0/16', 'name': 'vpn'}
+                ]
+            }
+        }}}
+    
+    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build')
+    def test_body_only_networks_and_version(self, mock_build, logger):
+        """Test the patch carries only authorizedNetworks and settingsVersion"""
+        service = _FakeSQLService(self._instances(), polls_until_done=1)
+        mock_build.return_value = service
+        
+        updater = mod.GCPUpdater({"project_id": "p", "sql_instances": ["db-0"]}, logger)
+        
+        assert updater.update_cloud_sql("1.2.3.4", "5.6.7.8") is True
+        body = service.patched["db-0"]
+        assert set(body) == {'settings'}
+        assert set(body['settings']) == {'ipConfiguration', 'settingsVersion'}
+        assert body['settings']['settingsVersion'] == '7'
+        assert list(body['settings']['ipConfiguration']) == ['authorizedNetworks']
+        values = [net['value'] for net in body['settings']['ipConfiguration']['authorizedNetworks']]
+        assert values == ['10.1.0.0/16', '5.6.7.8']
+    
+    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build')
+    def test_version_conflict_rereads_and_retries(self, mock_build, logger):
+        """Test a concurrent settings change re-reads the instance and patches again"""
+        service = _FakeSQLService(self._instances(), polls_until_done=1, concurrent_edits={"db-0": 2})
+        mock_build.return_value = service
+        
+        updater = mod.GCPUpdater({"project_id": "p", "sql_instances": ["db-0"]}, logger)
+        
+        assert updater.update_cloud_sql("1.2.3.4", "5.6.7.8") is True
+        assert service.patched["db-0"]['settings']['settingsVersion'] == '9'
+        # 3 lần đọc + 3 lần patch + 1 lần poll
+        assert len(service.batches) == 7
+    
+    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build')
+    def test_version_conflict_retries_exhausted(self, mock_build, logger):
+        """Test persistent conflicts give up after conflict_retries"""
+        service = _FakeSQLService(self._instances(), concurrent_edits={"db-0": 10})
+        mock_build.return_value = service
+        config = {"project_id": "p", "sql_instances": ["db-0"], "conflict_retries": 1}
+        
+        assert mod.GCPUpdater(config, logger).update_cloud_sql("1.2.3.4", "5.6.7.8") is False
+        assert service.patched == {}
+        assert service.concurrent_edits["db-0"] == 8
+    
+    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build')
+    def test_stale_ip_removed_when_new_present(self, mock_build, logger):
+        """Test an instance holding both IPs gets the old one removed"""
+        instances = self._instances()
+        instances["db-0"]['settings']['ipConfiguration']['authorizedNetworks'].append(
+            {'value': '5.6.7.8', 'name': 'auto-ip-x'}
+        )
+        service = _FakeSQLService(instances, polls_until_done=1)
+        mock_build.return_value = service
+        
+        updater = mod.GCPUpdater({"project_id": "p", "sql_instances": ["db-0"]}, logger)
+        
+        assert updater.update_cloud_sql("1.2.3.4", "5.6.7.8") is True
+        values = [net['value'] for net in service.patched["db-0"]['settings']['ipConfiguration']['authorizedNetworks']]
+        assert values == ['10.1.0.0/16', '5.6.7.8']
+
+
+class TestGCPCloudSQLCompaction:
+    """Test this installation's stale auto-ip-* authorized networks are compacted in the same patch"""
+    
+    CONFIG = {"project_id": "p", "sql_instances": ["db-0"], "sql_auto_ip_tag": "office"}
+    
+    @staticmethod
+    def _name(hours_ago, tag="office"):
+        from datetime import datetime, timedelta
+        stamp = (datetime.now() - timedelta(hours=hours_ago)).strftime('%Y%m%d-%H%M%S')
+        return f"auto-ip-{tag}-{stamp}" if tag else f"auto-ip-{stamp}"
+    
+    def _service(self, networks):
+        return _FakeSQLService(
+            {"db-0": {'settings': {'ipConfiguration': {'authorizedNetworks': networks}}}},
+            polls_until_done=1
+        )
+    
+    @staticmethod
+    def _patched_values(service):
+        return [net['value'] for net in service.patched["db-0"]['settings']['ipConfiguration']['authorizedNetworks']]
+    
+    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build')
+    def test_stale_entries_removed_in_single_patch(self, mock_build, logger):
+        """Test every stale auto-ip entry goes away while manual entries stay"""
+        service = self._service([
+            {'value': '9.9.9.1', 'name': self._name(72)},
+            {'value': '9.9.9.2', 'name': self._name(48)},
+            {'value': '1.2.3.4', 'name': self._name(24)},
+            {'value': '9.9.9.3', 'name': 'auto-ip-manual-vpn'},
+            {'value': '10.0.0.0/8', 'name': 'office'},
+        ])
+        mock_build.return_value = service
+        
+        updater = mod.GCPUpdater(self.CONFIG, logger)
+        
+        assert updater.update_cloud_sql(None, "5.6.7.8") is True
+        assert self._patched_values(service) == ['9.9.9.3', '10.0.0.0/8', '5.6.7.8']
+        assert len(service.batches) == 3
+    
+    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build')
+    def test_retention_window(self, mock_build, logger):
+        """Test entries younger than the retention window are kept"""
+        service = self._service([
+            {'value': '9.9.9.1', 'name': self._name(72)},
+            {'value': '9.9.9.2', 'name': self._name(2)},
+        ])
+        mock_build.return_value = service
+        config = {**self.CONFIG, "sql_auto_ip_retention_hours": 24}
+        
+        assert mod.GCPUpdater(config, logger).update_cloud_sql(None, "5.6.7.8") is True
+        assert self._patched_values(service) == ['9.9.9.2', '5.6.7.8']
+    
+    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build')
+    def test_compacts_when_new_ip_present(self, mock_build, logger):
+        """Test an instance already at the new IP is still patched to drop stale entries"""
+        service = self._service([
+            {'value': '9.9.9.1', 'name': self._name(72)},
+            {'value': '5.6.7.8', 'name': self._name(1)},
+        ])
+        mock_build.return_value = service
+        
+        updater = mod.GCPUpdater(self.CONFIG, logger)
+        
+        assert updater.update_cloud_sql(None, "5.6.7.8") is True
+        assert self._patched_values(service) == ['5.6.7.8']
+    
+    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build')
+    def test_compaction_disabled(self, mock_build, logger):
+        """Test sql_compact_auto_ip=false leaves auto-ip entries alone"""
+        service = self._service([{'value': '9.9.9.1', 'name': self._name(72)}])
+        mock_build.return_value = service
+        config = {**self.CONFIG, "sql_compact_auto_ip": False}
+        
+        assert mod.GCPUpdater(config, logger).update_cloud_sql(None, "5.6.7.8") is True
+        assert self._patched_values(service) == ['9.9.9.1', '5.6.7.8']
+    
+    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build')
+    def test_foreign_entries_survive(self, mock_build, logger):
+        """Test entries of other installations and untagged legacy entries are never compacted"""
+        service = self._service([
+            {'value': '9.9.9.1', 'name': self._name(72)},
+            {'value': '9.9.9.2', 'name': self._name(72, tag="branch")},
+            {'value': '9.9.9.3', 'name': self._name(72, tag="office-b")},
+            {'value': '9.9.9.4', 'name': self._name(72, tag=None)},
+        ])
+        mock_build.return_value = service
+        
+        assert mod.GCPUpdater(self.CONFIG, logger).update_cloud_sql(None, "5.6.7.8") is True
+        assert self._patched_values(service) == ['9.9.9.2', '9.9.9.3', '9.9.9.4', '5.6.7.8']
+    
+    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build')
+    @patch('auto_update_ip.socket.gethostname', return_value="db-admin.corp.example")
+    def test_tag_defaults_to_hostname(self, mock_hostname, mock_build, logger):
+        """Test new entries carry the short hostname when no tag is configured"""
+        service = self._service([])
+        mock_build.return_value = service
+        
+        assert mod.GCPUpdater({"project_id": "p", "sql_instances": ["db-0"]}, logger).update_cloud_sql(
+            None, "5.6.7.8"
+        ) is True
+        name = service.patched["db-0"]['settings']['ipConfiguration']['authorizedNetworks'][0]['name']
+        assert re.fullmatch(r"auto-ip-db-admin-\d{8}-\d{6}", name)
+    
+    def test_invalid_tag_rejected(self, tmp_path, mock_config):
+        """Test a tag with characters outside [A-Za-z0-9_.-] is rejected"""
+        mock_config['gcp']['sql_auto_ip_tag'] = "office/1"
+        config_file = tmp_path / "config.json"
+        config_file.write_text(json.dumps(mock_config))
+        
+        with pytest.raises(ValueError, match="sql_auto_ip_tag"):
+            mod.Config(str(config_file))
+    
+    def test_negative_retention_rejected(self, tmp_path, mock_config):
+        """Test a negative retention window is rejected when loading config"""
+        mock_config['gcp']['sql_auto_ip_retention_hours'] = -1
+        config_file = tmp_path / "config.json"
+        config_file.write_text(json.dumps(mock_config))
+        
+        with pytest.raises(ValueError, match="sql_auto_ip_retention_hours"):
+            mod.Config(str(config_file))
+
+
+class TestGCPClientCache:
+    """Test SDK clients are built once per process and credentials"""
+    
+    @staticmethod
+    def _firewall_client(mock_client_class):
+        mock_client = Mock()
+        mock_client.list.return_value = []
+        mock_client_class.return_value = mock_client
+        return mock_client
+    
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_firewalls_client_reused(self, mock_client_class, logger):
+        """Test repeated runs and new GCPUpdater instances share one client"""
+        self._firewall_client(mock_client_class)
+        config = {"project_id": "p", "firewall_rules": ["rule-a"]}
+        
+        mod.GCPUpdater(config, logger).update_firewall_rules(None, "5.6.7.8")
+        updater = mod.GCPUpdater(config, logger)
+        updater.update_firewall_rules(None, "5.6.7.8")
+        updater.update_firewall_rules(None, "9.9.9.9")
+        
+        assert mock_client_class.call_count == 1
+    
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    @patch('auto_update_ip.service_account.Credentials.from_service_account_file')
+    def test_client_per_credentials(self, mock_creds, mock_client_class, logger, tmp_path):
+        """Test different credentials files get separate clients"""
+        self._firewall_client(mock_client_class)
+        mock_creds.side_effect = lambda path: Mock(name=path)
+        for name in ("a.json", "b.json"):
+            (tmp_path / name).write_text('{"type": "service_account"}')
+            config = {"project_id": "p", "firewall_rules": ["r"], "credentials_file": str(tmp_path / name)}
+            mod.GCPUpdater(config, logger).update_firewall_rules(None, "5.6.7.8")
+            mod.GCPUpdater(config, logger).update_firewall_rules(None, "5.6.7.8")
+        
+        assert mock_client_class.call_count == 2
+        # Lần dùng lại client không cần load credentials
+        assert mock_creds.call_count == 2
+    
+    @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build')
+    def test_sqladmin_static_discovery_built_once(self, mock_build, logger):
+        """Test sqladmin comes from the bundled discovery document, built once"""
+        mock_build.return_value = _FakeSQLService({"db-0": {'settings': {}}}, polls_until_done=1)
+        config = {"project_id": "p", "sql_instances": ["db-0"]}
         
-        mock_service.instances().get().execute.return_value = mock_instance
-        
-        updater = mod.GCPUpdater(mock_config['gcp'], logger, dry_run=True)
-        result = updater.update_cloud_sql("1.2.3.4", "5.6.7.8")
+        mod.GCPUpdater(config, logger).update_cloud_sql(None, "5.6.7.8")
+        mod.GCPUpdater(config, logger).update_cloud_sql(None, "9.9.9.9")
         
-        assert result is True
-        # Should NOT call patch in dry-run mode
-        assert not mock_service.instances().patch.called
+        mock_build.assert_called_once()
+        assert mock_build.call_args.args == ('sqladmin', 'v1beta4')
+        assert mock_build.call_args.kwargs['static_discovery'] is True
     
     @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
+    @patch('auto_update_ip.discovery.build_from_document')
     @patch('auto_update_ip.discovery.build')
-    def test_cloud_sql_update_actually_patches(self, mock_build, mock_config, logger):
-        """Test Cloud SQL actually calls patch API"""
-        mock_service = Mock()
-        mock_build.return_value = mock_service
-        
-        mock_instance = {
-            'settings': {
-                'ipConfiguration': {
-                    'authorizedNetworks': [{'value': '1.2.3.4', 'name': 'old-ip'}]
-                }
-            }
-        }
+    @patch('requests.get')
+    def test_discovery_document_disk_cache(self, mock_get, mock_build, mock_from_doc, logger, tmp_path):
+        """Test without a bundled document it is downloaded once and then read from disk"""
+        mock_build.side_effect = Exception("UnknownApiNameOrVersion: sqladmin v1beta4")
+        mock_get.return_value.text = '{"name": "sqladmin"}'
+        mock_from_doc.return_value = _FakeSQLService({"db-0": {'settings': {}}}, polls_until_done=1)
+        config = {"project_id": "p", "sql_instances": ["db-0"], "discovery_cache_dir": str(tmp_path / "cache")}
+        
+        mod.GCPUpdater(config, logger).update_cloud_sql(None, "5.6.7.8")
+        mod._CLIENT_CACHE.clear()  # process mới
+        mod.GCPUpdater(config, logger).update_cloud_sql(None, "9.9.9.9")
+        
+        assert mock_get.call_count == 1
+        assert (tmp_path / "cache" / "sqladmin.v1beta4.json").read_text() == '{"name": "sqladmin"}'
+        assert [c.args[0] for c in mock_from_doc.call_args_list] == ['{"name": "sqladmin"}'] * 2
+
+
+class TestGCPTokenCache:
+    """Test the opt-in on-disk OAuth access-token cache"""
+    
+    @pytest.fixture
+    def creds_file(self, tmp_path):
+        path = tmp_path / "sa.json"
+        path.write_text('{"type": "service_account", "client_email": "a@p.iam"}')
+        return path
+    
+    @staticmethod
+    def _credentials(token="fresh-token", lifetime=3600):
+        from datetime import datetime, timedelta, timezone
+        creds = Mock()
+        creds.token = None
+        creds.expiry = None
+        
+        def refresh(request):
+            creds.token = token
+            creds.expiry = datetime.now(timezone.utc).replace(tzinfo=None) + timedelta(seconds=lifetime)
+        
+        creds.refresh.side_effect = refresh
+        return creds
+    
+    def _load(self, logger, creds_file, cache_dir, creds):
+        config = {"project_id": "p", "credentials_file": str(creds_file)}
+        if cache_dir:
+            config["token_cache_dir"] = str(cache_dir)
+        with patch('auto_update_ip.service_account.Credentials.from_service_account_file',
+                   return_value=creds) as mock_from_file, \
+                patch('auto_update_ip.auth_requests.Request'):
+            updater = mod.GCPUpdater(config, logger)
+            assert updater.credentials is creds
+        assert mock_from_file.call_args.kwargs['scopes'] == mod.GCPUpdater.TOKEN_SCOPES
+        return updater
+    
+    @pytest.mark.skipif(os.name != 'posix', reason="POSIX file modes")
+    def test_miss_fetches_and_stores_private_token(self, logger, creds_file, tmp_path):
+        """Test a cache miss refreshes once and writes an owner-only cache file"""
+        creds = self._credentials()
+        cache_dir = tmp_path / "tokens"
+        
+        self._load(logger, creds_file, cache_dir, creds)
+        
+        creds.refresh.assert_called_once()
+        (cache_file,) = list(cache_dir.iterdir())
+        assert json.loads(cache_file.read_text())['token'] == "fresh-token"
+        assert cache_file.stat().st_mode & 0o777 == 0o600
+        assert cache_dir.stat().st_mode & 0o777 == 0o700
+    
+    def test_hit_skips_token_exchange(self, logger, creds_file, tmp_path):
+        """Test a later run within the token lifetime reuses the cached token"""
+        cache_dir = tmp_path / "tokens"
+        self._load(logger, creds_file, cache_dir, self._credentials())
+        
+        creds = self._credentials(token="unused")
+        self._load(logger, creds_file, cache_dir, creds)
+        
+        creds.refresh.assert_not_called()
+        assert creds.token == "fresh-token"
+    
+    def test_nearly_expired_token_refreshed(self, logger, creds_file, tmp_path):
+        """Test a cached token close to expiry is replaced"""
+        cache_dir = tmp_path / "tokens"
+        self._load(logger, creds_file, cache_dir, self._credentials(token="old", lifetime=60))
+        
+        creds = self._credentials(token="new")
+        self._load(logger, creds_file, cache_dir, creds)
+        
+        creds.refresh.assert_called_once()
+        (cache_file,) = list(cache_dir.iterdir())
+        assert json.loads(cache_file.read_text())['token'] == "new"
+    
+    def test_keyed_by_credentials_fingerprint(self, logger, creds_file, tmp_path):
+        """Test a different credentials file never sees another key's token"""
+        cache_dir = tmp_path / "tokens"
+        self._load(logger, creds_file, cache_dir, self._credentials())
+        
+        other = tmp_path / "other.json"
+        other.write_text('{"type": "service_account", "client_email": "b@p.iam"}')
+        creds = self._credentials(token="other-token")
+        self._load(logger, other, cache_dir, creds)
+        
+        creds.refresh.assert_called_once()
+        assert len(list(cache_dir.iterdir())) == 2
+    
+    @pytest.mark.skipif(os.name != 'posix', reason="POSIX file modes")
+    def test_loose_permissions_ignored(self, logger, creds_file, tmp_path):
+        """Test a group/world-readable cache file is not trusted"""
+        cache_dir = tmp_path / "tokens"
+        self._load(logger, creds_file, cache_dir, self._credentials())
+        (cache_file,) = list(cache_dir.iterdir())
+        cache_file.chmod(0o644)
+        
+        creds = self._credentials(token="new")
+        self._load(logger, creds_file, cache_dir, creds)
+        
+        creds.refresh.assert_called_once()
+    
+    def test_disabled_by_default(self, logger, creds_file):
+        """Test no token_cache_dir means no eager refresh and no file"""
+        creds = self._credentials()
+        self._load(logger, creds_file, None, creds)
+        
+        creds.refresh.assert_not_called()
+    
+    def test_refresh_failure_not_fatal(self, logger, creds_file, tmp_path):
+        """Test an OAuth error while filling the cache still returns credentials"""
+        creds = self._credentials()
+        creds.refresh.side_effect = Exception("invalid_grant")
+        
+        self._load(logger, creds_file, tmp_path / "tokens", creds)
+
+
+class TestGCPMultiProject:
+    """Test gcp.projects fan-out with per-project isolation"""
+    
+    CONFIG = {
+        "project_id": "p-main",
+        "firewall_rules": ["main-rule"],
+        "projects": [
+            {"project_id": "p-a", "firewall_rules": ["a-rule"], "sql_instances": ["a-db"]},
+            {"project_id": "p-b", "firewall_rules": ["b-rule-1", "b-rule-2"]},
+        ]
+    }
+    
+    @staticmethod
+    def _firewall_client(mock_client_class, get=None):
+        mock_client = Mock()
+        mock_client_class.return_value = mock_client
+        mock_client.list.side_effect = Exception("use get")
         
-        mock_service.instances().get().execute.return_value = mock_instance
-        mock_service.instances().patch().execute.return_value = {}
+        def default_get(project, firewall):
+            fw = Mock()
+            fw.source_ranges = []
+            return fw
         
-        updater = mod.GCPUpdater(mock_config['gcp'], logger, dry_run=False)
-        result = updater.update_cloud_sql("1.2.3.4", "5.6.7.8")
+        mock_client.get.side_effect = get or default_get
+        return mock_client
+    
+    @staticmethod
+    def _patched(mock_client):
+        return sorted((c.kwargs['project'], c.kwargs['firewall']) for c in mock_client.patch.call_args_list)
+    
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_each_project_gets_only_its_rules(self, mock_client_class, logger):
+        """Test target lists are per project while the top-level project is included"""
+        mock_client = self._firewall_client(mock_client_class)
         
-        assert result is True
-        # Verify patch was called
-        assert mock_service.instances().patch.called
+        assert mod.GCPUpdater(self.CONFIG, logger).update_firewall_rules(None, "5.6.7.8") is True
+        assert self._patched(mock_client) == [
+            ("p-a", "a-rule"), ("p-b", "b-rule-1"), ("p-b", "b-rule-2"), ("p-main", "main-rule")
+        ]
+        # Cùng identity (ADC): một client cho mọi project
+        assert mock_client_class.call_count == 1
+    
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_projects_run_concurrently(self, mock_client_class, logger):
+        """Test projects are processed in parallel"""
+        import threading
+        import time
+        active, peak = set(), []
+        guard = threading.Lock()
+        
+        def slow_get(project, firewall):
+            with guard:
+                active.add(project)
+                peak.append(len(active))
+            time.sleep(0.05)
+            with guard:
+                active.discard(project)
+            fw = Mock()
+            fw.source_ranges = []
+            return fw
+        
+        self._firewall_client(mock_client_class, slow_get)
+        
+        assert mod.GCPUpdater(self.CONFIG, logger).update_firewall_rules(None, "5.6.7.8") is True
+        assert max(peak) > 1
+    
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    def test_project_failure_isolated(self, mock_client_class, logger, tmp_path):
+        """Test a permission error in one project does not stop the others"""
+        def get(project, firewall):
+            if project == "p-a":
+                raise Exception("403 Permission denied")
+            fw = Mock()
+            fw.source_ranges = []
+            return fw
+        
+        mock_client = self._firewall_client(mock_client_class, get)
+        store = mod.StateStore(str(tmp_path / "state.json"), logger)
+        
+        assert mod.GCPUpdater(self.CONFIG, logger).update_firewall_rules(None, "5.6.7.8", store) is False
+        assert ("p-b", "b-rule-2") in self._patched(mock_client)
+        assert store.is_applied("gcp.firewall/p-b/b-rule-1", "5.6.7.8")
+        assert store.is_applied("gcp.firewall/p-main/main-rule", "5.6.7.8")
+        assert store.applied_ip("gcp.firewall/p-a/a-rule") is None
+    
+    @patch('auto_update_ip.GCP_AVAILABLE', True)
+    @patch('auto_update_ip.compute_v1.FirewallsClient')
+    @patch('auto_update_ip.service_account.Credentials.from_service_account_file')
+    def test_credentials_shared_per_identity(self, mock_creds, mock_client_class, logger, tmp_path):
+        """Test projects sharing a credentials file load it and build clients once"""
+        self._firewall_client(mock_client_class)
+        mock_creds.side_effect = lambda path, scopes=None: Mock(name=path)
+        shared, own = tmp_path / "shared.json", tmp_path / "own.json"
+        shared.write_text('{"type": "service_account"}')
+        own.write_text('{"type": "service_account", "client_email": "x"}')
+        config = {
+            "credentials_file": str(shared),
+            "projects": [
+                {"project_id": "p-1", "firewall_rules": ["r"]},
+                {"project_id": "p-2", "firewall_rules": ["r"]},
+                {"project_id": "p-3", "firewall_rules": ["r"], "credentials_file": str(own)},
+            ]
+        }
         
-        # Verify the patch was called with correct parameters
-        call_args = mock_service.instances().patch.call_args
-        assert call_args.kwargs['project'] == mock_config['gcp']['project_id']
-        assert call_args.kwargs['instance'] in mock_config['gcp']['sql_instances']
+        assert mod.GCPUpdater(config, logger).update_firewall_rules(None, "5.6.7.8") is True
+        assert sorted(c.args[0] for c in mock_creds.call_args_list) == sorted([str(shared), str(own)])
+        assert mock_client_class.call_count == 2
     
     @patch('auto_update_ip.GOOGLE_API_AVAILABLE', True)
     @patch('auto_update_ip.discovery.build')
-    def test_cloud_sql_update_non_404_error(self, mock_build, mock_config, logger):
-        """Test Cloud SQL with non-404 HttpError"""
-        mock_service = Mock()
-        mock_build.return_value = mock_service
-        
-        from googleapiclient.errors import HttpError
-        mock_resp = Mock()
-        mock_resp.status = 403  # Forbidden, not 404
-        error = HttpError(resp=mock_resp, content=b'Access denied')
+    def test_cloud_sql_fan_out(self, mock_build, logger):
+        """Test each project updates its own instances with its own sqladmin service"""
+        services = []
+        
+        def build(*args, **kwargs):
+            services.append(_FakeSQLService(
+                {"a-db": {'settings': {}}, "b-db": {'settings': {}}}, polls_until_done=1
+            ))
+            return services[-1]
+        
+        mock_build.side_effect = build
+        config = {"projects": [
+            {"project_id": "p-a", "sql_instances": ["a-db"]},
+            {"project_id": "p-b", "sql_instances": ["b-db"]},
+        ]}
+        
+        assert mod.GCPUpdater(config, logger).update_cloud_sql(None, "5.6.7.8") is True
+        assert sorted(name for service in services for name in service.patched) == ["a-db", "b-db"]
+        assert len(services) == 2
+    
+    @pytest.mark.parametrize("gcp, message", [
+        ({"projects": [{"firewall_rules": ["r"]}]}, "thiếu 'project_id'"),
+        ({"project_id": "p", "projects": [{"project_id": "p"}]}, "trùng project_id"),
+        ({"projects": [{"project_id": "p", "firewall_selectors": [{"bogus": 1}]}]}, "không hỗ trợ"),
+        ({"projects": []}, "gcp.project_id"),
+        ({"sql_instances": ["db"], "projects": [{"project_id": "p"}]}, "gcp.sql_instances cần gcp.project_id"),
+    ])
+    def test_validation(self, tmp_path, mock_config, gcp, message):
+        """Test malformed project lists are rejected when loading config"""
+        mock_config['gcp'] = gcp
+        config_file = tmp_path / "config.json"
+        config_file.write_text(json.dumps(mock_config))
         
-        mock_service.instances().get().execute.side_effect = error
+        with pytest.raises(ValueError, match=message):
+            mod.Config(str(config_file))
+    
+    def test_projects_without_top_level_project_id(self, tmp_path, mock_config):
+        """Test a config listing only projects is valid"""
+        mock_config['gcp'] = {"projects": [{"project_id": "p-a"}, {"project_id": "p-b"}]}
+        config_file = tmp_path / "config.json"
+        config_file.write_text(json.dumps(mock_config))
         
-        updater = mod.GCPUpdater(mock_config['gcp'], logger, dry_run=False)
-        result = updater.update_cloud_sql("1.2.3.4", "5.6.7.8")
+        assert len(mod.Config(str(config_file)).gcp['projects']) == 2
+
+
+class TestGCPAddressGroups:
+    """Test address groups are updated once regardless of referencing rules"""
+    
+    CONFIG = {
+        "project_id": "p",
+        "address_groups": [{"name": "office", "firewall_policies": ["corp-policy"]}]
+    }
+    GROUP = "projects/p/locations/global/addressGroups/office"
+    
+    @staticmethod
+    def _client(mock_network_security, items):
+        client = Mock()
+        mock_network_security.AddressGroupServiceClient.return_value = client
+        client.get_address_group.return_value = Mock(items=items)
+        client.update_address_group.return_value = Mock(**{'done.return_value': True})
+        return client
+    
+    @patch('auto_update_ip.NETWORK_SECURITY_AVAILABLE', True)
+    @patch('auto_update_ip.network_security_v1', create=True)
+    def test_single_update_swaps_item(self, mock_network_security, logger):
+        """Test the old CIDR is replaced by the new one in one items update"""
+        client = self._client(mock_network_security, ["1.2.3.4/32", "10.0.0.0/8"])
+        
+        assert mod.GCPUpdater(self.CONFIG, logger).update_address_groups("1.2.3.4", "5.6.7.8") is True
+        client.get_address_group.assert_called_once_with(name=self.GROUP)
+        mock_network_security.AddressGroup.assert_called_once_with(
+            name=self.GROUP, items=["10.0.0.0/8", "5.6.7.8/32"]
+        )
+        client.update_address_group.assert_called_once()
+        assert list(client.update_address_group.call_args.kwargs['update_mask'].paths) == ['items']
+    
+    @patch('auto_update_ip.NETWORK_SECURITY_AVAILABLE', True)
+    @patch('auto_update_ip.network_security_v1', create=True)
+    def test_up_to_date_group_not_written(self, mock_network_security, logger, tmp_path):
+        """Test a group already holding only the new CIDR is recorded without a write"""
+        client = self._client(mock_network_security, ["5.6.7.8/32"])
+        store = mod.StateStore(str(tmp_path / "state.json"), logger)
+        
+        assert mod.GCPUpdater(self.CONFIG, logger).update_address_groups("1.2.3.4", "5.6.7.8", store) is True
+        client.update_address_group.assert_not_called()
+        assert store.is_applied("gcp.address_group/p/office", "5.6.7.8")
+    
+    @patch('auto_update_ip.NETWORK_SECURITY_AVAILABLE', False)
+    def test_no_address_groups_needs_no_sdk(self, logger):
+        """Test configs without address groups succeed without the Network Security SDK"""
+        assert mod.GCPUpdater({"project_id": "p"}, logger).update_address_groups(None, "5.6.7.8") is True
+    
+    @patch('auto_update_ip.NETWORK_SECURITY_AVAILABLE', True)
+    @patch('auto_update_ip.network_security_v1', create=True)
+    def test_update_error_reported(self, mock_network_security, logger):
+        """Test a failed update fails the group"""
+        client = self._client(mock_network_security, ["1.2.3.4/32"])
+        client.update_address_group.side_effect = Exception("permission denied")
+        
+        assert mod.GCPUpdater(self.CONFIG, logger).update_address_groups("1.2.3.4", "5.6.7.8") is False
+    
+    @patch('auto_update_ip.compute_v1.NetworkFirewallPoliciesClient', autospec=True)
+    def test_migration_replaces_cidr_with_group(self, mock_client_class, logger):
+        """Test policy rules holding the IP are rewritten to reference the address group"""
+        compute_v1 = mod.compute_v1
+        client = mock_client_class.return_value
+        client.get.return_value = compute_v1.FirewallPolicy(rules=[
+            compute_v1.FirewallPolicyRule(priority=1000, match=compute_v1.FirewallPolicyRuleMatcher(
+                src_ip_ranges=["1.2.3.4/32", "10.0.0.0/8"]
+            )),
+            compute_v1.FirewallPolicyRule(priority=2000, match=compute_v1.FirewallPolicyRuleMatcher(
+                src_ip_ranges=["192.168.0.0/16"]
+            )),
+        ])
+        client.patch_rule.return_value = Mock(**{'done.return_value': True})
+        
+        assert mod.GCPUpdater(self.CONFIG, logger).migrate_to_address_groups("1.2.3.4") is True
+        client.get.assert_called_once_with(project="p", firewall_policy="corp-policy")
+        client.patch_rule.assert_called_once()
+        request = client.patch_rule.call_args.kwargs['request']
+        assert isinstance(request, compute_v1.PatchRuleNetworkFirewallPolicyRequest)
+        assert (request.project, request.firewall_policy, request.priority) == ("p", "corp-policy", 1000)
+        assert list(request.firewall_policy_rule_resource.match.src_ip_ranges) == ["10.0.0.0/8"]
+        assert list(request.firewall_policy_rule_resource.match.src_address_groups) == [self.GROUP]
+    
+    def test_address_group_name_required(self, tmp_path, mock_config):
+        """Test address groups without a name are rejected"""
+        mock_config['gcp']['address_groups'] = [{"location": "global"}]
+        config_file = tmp_path / "config.json"
+        config_file.write_text(json.dumps(mock_config))
         
-        assert result is False
+        with pytest.raises(ValueError, match="address_groups"):
+            mod.Config(str(config_file))
 
 
 # ============================================================================
@@ -935,6 +2994,387 @@ class TestAWSSecurityGroupsEdgeCases:
         assert result is False
 
 
+class TestAWSBatchedPermissions:
+    """Test one authorize/revoke call per security group with bisection on conflicts"""
+    
+    PORTS = [{"protocol": "tcp", "port": port, "description": f"p{port}"} for port in (22, 80, 443, 3306, 5432, 6379)]
+    
+    def _config(self):
+        return {
+            "region": "us-east-1",
+            "security_groups_ssh": [{"group_id": "sg-1", "description": "Office"}],
+            "ports_ssh": self.PORTS
+        }
+    
+    @staticmethod
+    def _ec2(existing_new=(), existing_old=None):
+        """EC2 stand-in rejecting a whole request like the real API"""
+        from botocore.exceptions import ClientError
+        ec2 = Mock()
+        authorized = set(existing_new)
+        present_old = set(p['port'] for p in TestAWSBatchedPermissions.PORTS) if existing_old is None \
+            else set(existing_old)
+        
+        def authorize(GroupId, IpPermissions):
+            ports = {perm['FromPort'] for perm in IpPermissions}
+            if ports & authorized:
+                raise ClientError({'Error': {'Code': 'InvalidPermission.Duplicate'}}, 'AuthorizeSecurityGroupIngress')
+            authorized.update(ports)
+        
+        def revoke(GroupId, IpPermissions):
+            ports = {perm['FromPort'] for perm in IpPermissions}
+            if ports - present_old:
+                raise ClientError({'Error': {'Code': 'InvalidPermission.NotFound'}}, 'RevokeSecurityGroupIngress')
+            present_old.difference_update(ports)
+        
+        ec2.authorize_security_group_ingress.side_effect = authorize
+        ec2.revoke_security_group_ingress.side_effect = revoke
+        ec2.authorized = authorized
+        ec2.present_old = present_old
+        return ec2
+    
+    @patch('auto_update_ip.AWS_AVAILABLE', True)
+    @patch('auto_update_ip.boto3.client')
+    def test_one_call_each_for_all_ports(self, mock_boto_client, logger):
+        """Test six ports cost one revoke and one authorize"""
+        ec2 = self._ec2()
+        mock_boto_client.return_value = ec2
+        
+        assert mod.AWSUpdater(self._config(), logger).update_security_groups("1.2.3.4", "5.6.7.8") is True
+        assert ec2.revoke_security_group_ingress.call_count == 1
+        assert ec2.authorize_security_group_ingress.call_count == 1
+        permissions = ec2.authorize_security_group_ingress.call_args.kwargs['IpPermissions']
+        assert [perm['FromPort'] for perm in permissions] == [22, 80, 443, 3306, 5432, 6379]
+        assert permissions[0]['IpRanges'] == [{'CidrIp': '5.6.7.8/32', 'Description': 'p22 - Office'}]
+    
+    @patch('auto_update_ip.AWS_AVAILABLE', True)
+    @patch('auto_update_ip.boto3.client')
+    def test_duplicate_narrowed_down(self, mock_boto_client, logger):
+        """Test an already-present permission is isolated and the rest authorized"""
+        ec2 = self._ec2(existing_new=[3306])
+        mock_boto_client.return_value = ec2
+        
+        assert mod.AWSUpdater(self._config(), logger).update_security_groups("1.2.3.4", "5.6.7.8") is True
+        assert ec2.authorized == {22, 80, 443, 3306, 5432, 6379}
+        assert ec2.authorize_security_group_ingress.call_count < len(self.PORTS)
+    
+    @patch('auto_update_ip.AWS_AVAILABLE', True)
+    @patch('auto_update_ip.boto3.client')
+    def test_not_found_narrowed_down(self, mock_boto_client, logger):
+        """Test missing old permissions are skipped while the others are revoked"""
+        ec2 = self._ec2(existing_old=[22, 443])
+        mock_boto_client.return_value = ec2
+        
+        assert mod.AWSUpdater(self._config(), logger).update_security_groups("1.2.3.4", "5.6.7.8") is True
+        assert ec2.present_old == set()
+        assert ec2.authorize_security_group_ingress.call_count == 1
+    
+    @patch('auto_update_ip.AWS_AVAILABLE', True)
+    @patch('auto_update_ip.boto3.client')
+    def test_other_error_during_bisection_fails(self, mock_boto_client, logger):
+        """Test a real error surfacing while narrowing still fails the group"""
+        from botocore.exceptions import ClientError
+        ec2 = self._ec2()
+        mock_boto_client.return_value = ec2
+        
+        def authorize(GroupId, IpPermissions):
+            if len(IpPermissions) > 1:
+                raise ClientError({'Error': {'Code': 'InvalidPermission.Duplicate'}}, 'Authorize')
+            if IpPermissions[0]['FromPort'] == 443:
+                raise ClientError({'Error': {'Code': 'RulesPerSecurityGroupLimitExceeded'}}, 'Authorize')
+        
+        ec2.authorize_security_group_ingress.side_effect = authorize
+        
+        assert mod.AWSUpdater(self._config(), logger).update_security_groups("1.2.3.4", "5.6.7.8") is False
+
+
+class TestAWSPlannedDiff:
+    """Test security groups are read once up front and only real diffs are written"""
+    
+    CONFIG = {
+        "region": "us-east-1",
+        "security_groups_ssh": [{"group_id": "sg-ssh", "description": "Office"}],
+        "security_groups_mysql": [{"group_id": "sg-db", "description": "Office"}],
+        "ports_ssh": [{"protocol": "tcp", "port": 22, "description": "SSH"},
+                      {"protocol": "tcp", "port": 80, "description": "HTTP"}],
+        "ports_mysql": [{"protocol": "tcp", "port": 3306, "description": "MySQL"}]
+    }
+    
+    @staticmethod
+    def _group(group_id, rules):
+        permissions = [
+            {'IpProtocol': 'tcp', 'FromPort': port, 'ToPort': port,
+             'IpRanges': [{'CidrIp': f"{ip}/32"}], 'Ipv6Ranges': []}
+            for port, ip in rules
+        ]
+        return {'GroupId': group_id, 'IpPermissions': permissions}
+    
+    def _ec2(self, mock_boto_client, groups):
+        ec2 = Mock()
+        ec2.describe_security_groups.return_value = {'SecurityGroups': groups}
+        mock_boto_client.return_value = ec2
+        return ec2
+    
+    @patch('auto_update_ip.AWS_AVAILABLE', True)
+    @patch('auto_update_ip.boto3.client')
+    def test_up_to_date_groups_cost_zero_writes(self, mock_boto_client, logger):
+        """Test groups already holding exactly the new IP are not written"""
+        ec2 = self._ec2(mock_boto_client, [
+            self._group("sg-ssh", [(22, "5.6.7.8"), (80, "5.6.7.8")]),
+            self._group("sg-db", [(3306, "5.6.7.8"), (3306, "10.0.0.1")]),
+        ])
+        
+        assert mod.AWSUpdater(self.CONFIG, logger).update_security_groups("1.2.3.4", "5.6.7.8") is True
+        ec2.describe_security_groups.assert_called_once_with(GroupIds=["sg-db", "sg-ssh"])
+        ec2.revoke_security_group_ingress.assert_not_called()
+        ec2.authorize_security_group_ingress.assert_not_called()
+        assert mock_boto_client.call_count == 1
+    
+    @patch('auto_update_ip.AWS_AVAILABLE', True)
+    @patch('auto_update_ip.boto3.client')
+    def test_only_real_diffs_written(self, mock_boto_client, logger):
+        """Test only present old rules are revoked and only missing new rules authorized"""
+        ec2 = self._ec2(mock_boto_client, [
+            self._group("sg-ssh", [(22, "1.2.3.4"), (80, "5.6.7.8")]),
+            self._group("sg-db", []),
+        ])
+        
+        assert mod.AWSUpdater(self.CONFIG, logger).update_security_groups("1.2.3.4", "5.6.7.8") is True
+        revoke = ec2.revoke_security_group_ingress.call_args_list
+        assert [(c.kwargs['GroupId'], [p['FromPort'] for p in c.kwargs['IpPermissions']]) for c in revoke] == [
+            ("sg-ssh", [22])
+        ]
+        authorize = ec2.authorize_security_group_ingress.call_args_list
+        assert [(c.kwargs['GroupId'], [p['FromPort'] for p in c.kwargs['IpPermissions']]) for c in authorize] == [
+            ("sg-ssh", [22]), ("sg-db", [3306])
+        ]
+    
+    @patch('auto_update_ip.AWS_AVAILABLE', True)
+    @patch('auto_update_ip.boto3.client')
+    def test_describe_failure_falls_back(self, mock_boto_client, logger):
+        """Test a failing describe still updates every group without a plan"""
+        from botocore.exceptions import ClientError
+        ec2 = Mock()
+        ec2.describe_security_groups.side_effect = ClientError(
+            {'Error': {'Code': 'InvalidGroup.NotFound'}}, 'DescribeSecurityGroups'
+        )
+        mock_boto_client.return_value = ec2
+        
+        assert mod.AWSUpdater(self.CONFIG, logger).update_security_groups("1.2.3.4", "5.6.7.8") is True
+        assert ec2.authorize_security_group_ingress.call_count == 2
+        assert ec2.revoke_security_group_ingress.call_count == 2
+    
+    @patch('auto_update_ip.AWS_AVAILABLE', True)
+    @patch('auto_update_ip.boto3.client')
+    def test_applied_groups_not_described(self, mock_boto_client, logger, tmp_path):
+        """Test groups already applied in the state file are neither read nor written"""
+        ec2 = self._ec2(mock_boto_client, [self._group("sg-db", [])])
+        store = mod.StateStore(str(tmp_path / "state.json"), logger)
+        store.mark_applied("aws.sg/us-east-1/sg-ssh/SSH", "5.6.7.8")
+        
+        assert mod.AWSUpdater(self.CONFIG, logger).update_security_groups("1.2.3.4", "5.6.7.8", store) is True
+        ec2.describe_security_groups.assert_called_once_with(GroupIds=["sg-db"])
+        
+        store.mark_applied("aws.sg/us-east-1/sg-db/MySQL", "5.6.7.8")
+        ec2.describe_security_groups.reset_mock()
+        mod.AWSUpdater(self.CONFIG, logger).update_security_groups("1.2.3.4", "5.6.7.8", store)
+        ec2.describe_security_groups.assert_not_called()
+
+
+class TestAWSModifyRules:
+    """Test update_mode "modify" rewrites old-IP rules in place"""
+    
+    CONFIG = {
+        "region": "us-east-1",
+        "update_mode": "modify",
+        "security_groups_ssh": [{"group_id": "sg-ssh", "description": "Office"}],
+        "ports_ssh": [{"protocol": "tcp", "port": 22, "description": "SSH"},
+                      {"protocol": "tcp", "port": 80, "description": "HTTP"}]
+    }
+    
+    @staticmethod
+    def _rules(rules):
+        return [
+            {'SecurityGroupRuleId': rule_id, 'GroupId': 'sg-ssh', 'IsEgress': False,
+             'IpProtocol': 'tcp', 'FromPort': port, 'ToPort': port, 'CidrIpv4': f"{ip}/32"}
+            for rule_id, port, ip in rules
+        ]
+    
+    def _ec2(self, mock_boto_client, rules):
+        ec2 = Mock()
+        ec2.describe_security_group_rules.return_value = {'SecurityGroupRules': self._rules(rules)}
+        mock_boto_client.return_value = ec2
+        return ec2
+    
+    @patch('auto_update_ip.AWS_AVAILABLE', True)
+    @patch('auto_update_ip.boto3.client')
+    def test_old_rules_modified_in_one_call(self, mock_boto_client, logger):
+        """Test all old-IP rules of a group are rewritten by one modify request"""
+        ec2 = self._ec2(mock_boto_client, [("sgr-22", 22, "1.2.3.4"), ("sgr-80", 80, "1.2.3.4")])
+        
+        assert mod.AWSUpdater(self.CONFIG, logger).update_security_groups("1.2.3.4", "5.6.7.8") is True
+        ec2.describe_security_group_rules.assert_called_once_with(
+            Filters=[{'Name': 'group-id', 'Values': ['sg-ssh']}], MaxResults=1000
+        )
+        ec2.modify_security_group_rules.assert_called_once()
+        kwargs = ec2.modify_security_group_rules.call_args.kwargs
+        assert kwargs['GroupId'] == "sg-ssh"
+        assert kwargs['SecurityGroupRules'][0] == {
+            'SecurityGroupRuleId': "sgr-22",
+            'SecurityGroupRule': {'IpProtocol': 'tcp', 'FromPort': 22, 'ToPort': 22,
+                                  'CidrIpv4': "5.6.7.8/32", 'Description': "SSH - Office"}
+        }
+        assert [r['SecurityGroupRuleId'] for r in kwargs['SecurityGroupRules']] == ["sgr-22", "sgr-80"]
+        ec2.revoke_security_group_ingress.assert_not_called()
+        ec2.authorize_security_group_ingress.assert_not_called()
+    
+    @patch('auto_update_ip.AWS_AVAILABLE', True)
+    @patch('auto_update_ip.boto3.client')
+    def test_missing_old_rule_falls_back_to_authorize(self, mock_boto_client, logger):
+        """Test ports without an old-IP rule are authorized normally"""
+        ec2 = self._ec2(mock_boto_client, [("sgr-22", 22, "1.2.3.4")])
+        
+        assert mod.AWSUpdater(self.CONFIG, logger).update_security_groups("1.2.3.4", "5.6.7.8") is True
+        modified = ec2.modify_security_group_rules.call_args.kwargs['SecurityGroupRules']
+        assert [r['SecurityGroupRuleId'] for r in modified] == ["sgr-22"]
+        ec2.revoke_security_group_ingress.assert_not_called()
+        authorized = ec2.authorize_security_group_ingress.call_args.kwargs['IpPermissions']
+        assert [p['FromPort'] for p in authorized] == [80]
+    
+    @patch('auto_update_ip.AWS_AVAILABLE', True)
+    @patch('auto_update_ip.boto3.client')
+    def test_modify_error_falls_back_to_revoke_authorize(self, mock_boto_client, logger):
+        """Test a rejected modify request is replaced by revoke and authorize"""
+        ec2 = self._ec2(mock_boto_client, [("sgr-22", 22, "1.2.3.4"), ("sgr-80", 80, "1.2.3.4")])
+        ec2.modify_security_group_rules.side_effect = mod.ClientError(
+            {'Error': {'Code': 'UnauthorizedOperation', 'Message': 'denied'}}, 'ModifySecurityGroupRules'
+        )
+        
+        assert mod.AWSUpdater(self.CONFIG, logger).update_security_groups("1.2.3.4", "5.6.7.8") is True
+        revoked = ec2.revoke_security_group_ingress.call_args.kwargs['IpPermissions']
+        authorized = ec2.authorize_security_group_ingress.call_args.kwargs['IpPermissions']
+        assert [p['FromPort'] for p in revoked] == [22, 80]
+        assert [p['FromPort'] for p in authorized] == [22, 80]
+    
+    @patch('auto_update_ip.AWS_AVAILABLE', True)
+    @patch('auto_update_ip.boto3.client')
+    def test_dry_run_makes_no_writes(self, mock_boto_client, logger):
+        """Test dry-run logs the modify without calling EC2 writes"""
+        ec2 = self._ec2(mock_boto_client, [("sgr-22", 22, "1.2.3.4"), ("sgr-80", 80, "1.2.3.4")])
+        
+        updater = mod.AWSUpdater(self.CONFIG, logger, dry_run=True)
+        assert updater.update_security_groups("1.2.3.4", "5.6.7.8") is True
+        ec2.modify_security_group_rules.assert_not_called()
+        ec2.authorize_security_group_ingress.assert_not_called()
+    
+    def test_invalid_update_mode_rejected(self, tmp_path, mock_config):
+        """Test an unknown aws.update_mode fails config validation"""
+        mock_config['aws']['update_mode'] = "swap"
+        config_file = tmp_path / "config.json"
+        config_file.write_text(json.dumps(mock_config))
+        
+        with pytest.raises(ValueError, match="update_mode"):
+            mod.Config(str(config_file))
+
+
+
+class TestAWSPrefixList:
+    """Test managed prefix lists are updated with one versioned modify call"""
+    
+    CONFIG = {
+        "region": "us-east-1",
+        "prefix_lists": [{"prefix_list_id": "pl-office", "description": "Office"}]
+    }
+    
+    def _ec2(self, mock_boto_client, cidrs, version=7):
+        ec2 = Mock()
+        ec2.describe_managed_prefix_lists.return_value = {
+            'PrefixLists': [{'PrefixListId': 'pl-office', 'Version': version}]
+        }
+        ec2.get_managed_prefix_list_entries.return_value = {'Entries': [{'Cidr': c} for c in cidrs]}
+        mock_boto_client.return_value = ec2
+        return ec2
+    
+    @patch('auto_update_ip.AWS_AVAILABLE', True)
+    @patch('auto_update_ip.boto3.client')
+    def test_single_modify_swaps_entries(self, mock_boto_client, logger):
+        """Test the old CIDR is removed and the new one added in one call"""
+        ec2 = self._ec2(mock_boto_client, ["1.2.3.4/32", "10.0.0.0/8"])
+        
+        assert mod.AWSUpdater(self.CONFIG, logger).update_security_groups("1.2.3.4", "5.6.7.8") is True
+        ec2.modify_managed_prefix_list.assert_called_once_with(
+            PrefixListId="pl-office", CurrentVersion=7,
+            AddEntries=[{'Cidr': "5.6.7.8/32", 'Description': "Office"}],
+            RemoveEntries=[{'Cidr': "1.2.3.4/32"}]
+        )
+        ec2.get_managed_prefix_list_entries.assert_called_once_with(PrefixListId="pl-office", TargetVersion=7)
+        ec2.revoke_security_group_ingress.assert_not_called()
+        ec2.authorize_security_group_ingress.assert_not_called()
+    
+    @patch('auto_update_ip.AWS_AVAILABLE', True)
+    @patch('auto_update_ip.boto3.client')
+    def test_up_to_date_list_not_written(self, mock_boto_client, logger):
+        """Test a list already holding only the new CIDR costs no write"""
+        ec2 = self._ec2(mock_boto_client, ["5.6.7.8/32"])
+        
+        assert mod.AWSUpdater(self.CONFIG, logger).update_security_groups("1.2.3.4", "5.6.7.8") is True
+        ec2.modify_managed_prefix_list.assert_not_called()
+    
+    @patch('auto_update_ip.time.sleep')
+    @patch('auto_update_ip.AWS_AVAILABLE', True)
+    @patch('auto_update_ip.boto3.client')
+    def test_version_conflict_rereads_and_retries(self, mock_boto_client, mock_sleep, logger):
+        """Test a version mismatch re-reads the list and retries with the new version"""
+        ec2 = self._ec2(mock_boto_client, ["1.2.3.4/32"])
+        ec2.describe_managed_prefix_lists.side_effect = [
+            {'PrefixLists': [{'PrefixListId': 'pl-office', 'Version': 7}]},
+            {'PrefixLists': [{'PrefixListId': 'pl-office', 'Version': 8}]},
+        ]
+        ec2.modify_managed_prefix_list.side_effect = [
+            mod.ClientError({'Error': {'Code': 'PrefixListVersionMismatch', 'Message': 'v'}},
+                            'ModifyManagedPrefixList'),
+            {},
+        ]
+        
+        assert mod.AWSUpdater(self.CONFIG, logger).update_security_groups("1.2.3.4", "5.6.7.8") is True
+        versions = [c.kwargs['CurrentVersion'] for c in ec2.modify_managed_prefix_list.call_args_list]
+        assert versions == [7, 8]
+    
+    @patch('auto_update_ip.AWS_AVAILABLE', True)
+    @patch('auto_update_ip.boto3.client')
+    def test_other_errors_fail_without_retry(self, mock_boto_client, logger):
+        """Test a non-conflict error fails the list and is recorded as not applied"""
+        ec2 = self._ec2(mock_boto_client, ["1.2.3.4/32"])
+        ec2.modify_managed_prefix_list.side_effect = mod.ClientError(
+            {'Error': {'Code': 'PrefixListMaxEntriesExceeded', 'Message': 'full'}}, 'ModifyManagedPrefixList'
+        )
+        
+        assert mod.AWSUpdater(self.CONFIG, logger).update_security_groups("1.2.3.4", "5.6.7.8") is False
+        ec2.modify_managed_prefix_list.assert_called_once()
+    
+    @patch('auto_update_ip.AWS_AVAILABLE', True)
+    @patch('auto_update_ip.boto3.client')
+    def test_applied_list_skipped_from_state(self, mock_boto_client, logger, tmp_path):
+        """Test a list already applied in the state store is not read again"""
+        ec2 = self._ec2(mock_boto_client, ["1.2.3.4/32"])
+        store = mod.StateStore(str(tmp_path / "state.json"), logger)
+        
+        updater = mod.AWSUpdater(self.CONFIG, logger)
+        assert updater.update_security_groups("1.2.3.4", "5.6.7.8", store) is True
+        ec2.describe_managed_prefix_lists.reset_mock()
+        assert updater.update_security_groups("1.2.3.4", "5.6.7.8", store) is True
+        ec2.describe_managed_prefix_lists.assert_not_called()
+    
+    def test_prefix_list_id_required(self, tmp_path, mock_config):
+        """Test prefix list entries without prefix_list_id are rejected"""
+        mock_config['aws']['prefix_lists'] = [{"description": "Office"}]
+        config_file = tmp_path / "config.json"
+        config_file.write_text(json.dumps(mock_config))
+        
+        with pytest.raises(ValueError, match="prefix_list_id"):
+            mod.Config(str(config_file))
+
+
 # ============================================================================
 # IP UPDATER ORCHESTRATOR TESTS
 # ============================================================================
@@ -942,6 +3382,70 @@ class TestAWSSecurityGroupsEdgeCases:
 class TestIPUpdater:
     """Test IPUpdater main orchestrator"""
     
+    @patch.object(mod.IPService, 'check_ip_change', return_value=("1.2.3.4", "5.6.7.8", True))
+    @patch.object(mod.IPService, 'save_ip')
+    @patch.object(mod.GCPUpdater, 'update_cloud_sql', return_value=True)
+    @patch.object(mod.AWSUpdater, 'update_security_groups', return_value=True)
+    def test_run_timing_report(self, mock_aws, mock_sql, mock_save, mock_check, temp_config_file):
+        """Test each run records per-phase timings, including GCP auth when loaded"""
+        updater = mod.IPUpdater(temp_config_file)
+        with patch.object(mod.GCPUpdater, 'update_firewall_rules',
+                          side_effect=lambda *args: updater.gcp_updater.credentials is None):
+            updater.run()
+        
+        assert set(updater.timings) == {
+            'ip', 'gcp.auth', 'gcp.address_groups', 'gcp.firewall', 'gcp.sql', 'aws', 'total'
+        }
+        assert updater.timings['total'] >= updater.timings['gcp.firewall'] >= updater.timings['gcp.auth']
+        
+        mock_check.return_value = ("5.6.7.8", "5.6.7.8", False)
+        updater.run()
+        assert set(updater.timings) == {'ip', 'total'}
+    
+    @patch.object(mod.GCPUpdater, 'update_address_groups')
+    def test_migrate_address_groups_respects_run_lock(self, mock_update, tmp_path, mock_config):
+        """Test migration refuses to run while another run holds the lock"""
+        mock_config['ip_cache_file'] = str(tmp_path / "state.json")
+        config_file = tmp_path / "config.json"
+        config_file.write_text(json.dumps(mock_config))
+        
+        holder = mod.RunLock(str(tmp_path / "state.json.lock"), Mock())
+        assert holder.acquire()
+        try:
+            assert mod.IPUpdater(str(config_file)).migrate_address_groups() == 1
+        finally:
+            holder.release()
+        
+        mock_update.assert_not_called()
+    
+    @patch.object(mod.IPService, 'get_current_ip', return_value="5.6.7.8")
+    @patch.object(mod.GCPUpdater, 'migrate_to_address_groups', return_value=True)
+    def test_migrate_address_groups_records_state(
+        self, mock_migrate, mock_get_ip, tmp_path, mock_config, logger
+    ):
+        """Test migration passes the state store, saves it and releases the lock"""
+        state_file = tmp_path / "state.json"
+        state_file.write_text("1.2.3.4")
+        mock_config['ip_cache_file'] = str(state_file)
+        config_file = tmp_path / "config.json"
+        config_file.write_text(json.dumps(mock_config))
+        
+        def update(old_ip, new_ip, state):
+            state.mark_applied("gcp.address_group/p/office", new_ip)
+            return True
+        
+        with patch.object(mod.GCPUpdater, 'update_address_groups', side_effect=update) as mock_update:
+            assert mod.IPUpdater(str(config_file)).migrate_address_groups() == 0
+        
+        assert mock_update.call_args.args[:2] == ("1.2.3.4", "5.6.7.8")
+        mock_migrate.assert_called_once_with("1.2.3.4")
+        saved = mod.StateStore(str(state_file), logger)
+        saved.load()
+        assert saved.is_applied("gcp.address_group/p/office", "5.6.7.8")
+        lock = mod.RunLock(str(tmp_path / "state.json.lock"), Mock())
+        assert lock.acquire()
+        lock.release()
+    
     def test_init(self, temp_config_file):
         """Test IPUpdater initialization"""
         updater = mod.IPUpdater(temp_config_file, dry_run=False, verbose=False)
@@ -1114,6 +3618,74 @@ class TestIPUpdater:
             assert not mock_save.called  # Should NOT save in dry-run
 
 
+class TestDaemonMode:
+    """Test long-running daemon mode with adaptive polling interval"""
+    
+    def test_adaptive_interval(self, temp_config_file):
+        """Test interval backs off while stable and resets after change or failure"""
+        updater = mod.IPUpdater(temp_config_file)
+        outcomes = iter([(0, True), (0, False), (0, False), (0, False), (1, False), (0, False)])
+        
+        def fake_run():
+            code, changed = next(outcomes)
+            updater.ip_changed = changed
+            return code
+        
+        waits = []
+        
+        def fake_wait(interval):
+            waits.append(interval)
+            if len(waits) == 6:
+                updater.stop()
+        
+        with patch.object(updater, 'run', side_effect=fake_run), \
+             patch.object(updater._stop_event, 'wait', side_effect=fake_wait):
+            updater.daemon(min_interval=10, max_interval=35, backoff_factor=2)
+        
+        assert waits == [10, 20, 35, 35, 10, 20]
+    
+    def test_run_exception_does_not_kill_daemon(self, temp_config_file):
+        """Test unexpected error in one iteration is treated as failure"""
+        updater = mod.IPUpdater(temp_config_file)
+        
+        waits = []
+        
+        def fake_wait(interval):
+            waits.append(interval)
+            if len(waits) == 2:
+                updater.stop()
+        
+        with patch.object(updater, 'run', side_effect=[Exception("boom"), 0]) as mock_run, \
+             patch.object(updater._stop_event, 'wait', side_effect=fake_wait):
+            exit_code = updater.daemon(min_interval=1, max_interval=4)
+        
+        assert exit_code == 0
+        assert mock_run.call_count == 2
+        assert waits == [1, 2]
+    
+    def test_invalid_daemon_config(self, tmp_path, mock_config):
+        """Test daemon interval validation"""
+        mock_config['daemon'] = {"min_interval": 60, "max_interval": 30}
+        config_file = tmp_path / "config.json"
+        config_file.write_text(json.dumps(mock_config))
+        
+        with pytest.raises(ValueError, match="min_interval"):
+            mod.Config(str(config_file))
+    
+    @patch('signal.signal')
+    @patch.object(mod.IPUpdater, 'daemon', return_value=0)
+    def test_daemon_argument_installs_sigterm_handler(self, mock_daemon, mock_signal, temp_config_file):
+        """Test --daemon wires SIGTERM to a clean stop"""
+        import signal
+        with patch('sys.argv', ['auto_update_ip.py', '--daemon', '--config', temp_config_file]):
+            with pytest.raises(SystemExit) as exc_info:
+                mod.main()
+        
+        assert exc_info.value.code == 0
+        mock_daemon.assert_called_once_with(30, 900, 2.0)
+        assert mock_signal.call_args.args[0] == signal.SIGTERM
+
+
 # ============================================================================
 # MAIN FUNCTION TESTS
 # ============================================================================
@@ -1204,6 +3776,56 @@ class TestImportErrorHandling:
         assert hasattr(mod, 'IPUpdater')
 
 
+class TestLazyImports:
+    """Test provider SDKs are only imported when a configured provider needs them"""
+    
+    SDK_PREFIXES = ('google.cloud', 'google.oauth2', 'googleapiclient', 'boto3', 'botocore')
+    
+    def _run_python(self, cwd, code, *args):
+        import subprocess
+        # Run from a temp dir: IPUpdater writes ip_update.log and the lock file to cwd
+        env = dict(os.environ, PYTHONPATH=str(Path(mod.__file__).parent))
+        return subprocess.run(
+            [sys.executable, *args, '-c', code],
+            cwd=str(cwd),
+            env=env,
+            capture_output=True,
+            text=True,
+            check=True
+        )
+    
+    def test_import_does_not_load_sdks(self, tmp_path):
+        """Test importing the module loads no provider SDK (python -X importtime)"""
+        result = self._run_python(tmp_path, "import auto_update_ip", "-X", "importtime")
+        imported = [line.split('|')[-1].strip() for line in result.stderr.splitlines() if '|' in line]
+        
+        assert 'auto_update_ip' in imported
+        assert not [name for name in imported if name.startswith(self.SDK_PREFIXES)]
+    
+    def test_unchanged_ip_run_does_not_load_sdks(self, temp_config_file, tmp_path):
+        """Test the 'IP unchanged' fast path never imports provider SDKs"""
+        code = f"""
+import sys
+from unittest.mock import patch
+import auto_update_ip as mod
+with patch.object(mod.IPService, 'check_ip_change', return_value=('1.2.3.4', '1.2.3.4', False)):
+    assert mod.IPUpdater({temp_config_file!r}).run() == 0
+loaded = [m for m in sys.modules if m.startswith({self.SDK_PREFIXES!r})]
+assert not loaded, loaded
+"""
+        self._run_python(tmp_path, code)
+    
+    def test_lazy_attribute_access(self):
+        """Test SDK attributes are still reachable on the module"""
+        if not mod.AWS_AVAILABLE:
+            pytest.skip("boto3 not installed")
+        import boto3
+        assert mod.boto3 is boto3
+        
+        with pytest.raises(AttributeError):
+            mod.not_a_real_attribute
+
+
 class TestMainEntryPoint:
     """Test the __main__ entry point"""
     